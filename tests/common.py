@@ -1,4 +1,5 @@
 
+import atexit
 import hashlib
 import inspect
 import json
@@ -16,6 +17,12 @@ import twotone.twotone as twotone
 
 current_path = os.path.dirname(os.path.abspath(__file__))
 
+# Keep persistent data (probe cache, CRF search cache, library index, processing journal) of tests
+# away from user's one and start each test run with empty caches.
+cache_home = tempfile.mkdtemp(prefix = "twotone_tests_cache_")
+os.environ["XDG_CACHE_HOME"] = cache_home
+atexit.register(shutil.rmtree, cache_home, ignore_errors = True)
+
 
 class WorkingDirectoryForTest:
     def __init__(self):
@@ -0,0 +1,150 @@
+
+import os
+import struct
+import unittest
+from unittest.mock import patch
+
+import twotone.tools.matroska as matroska
+import twotone.tools.utils as utils
+from common import WorkingDirectoryForTest
+
+
+def element(element_id: int, payload: bytes) -> bytes:
+    id_bytes = element_id.to_bytes((element_id.bit_length() + 7) // 8, "big")
+    size = (1 << 56) | len(payload)                        # 8 bytes long size
+
+    return id_bytes + size.to_bytes(8, "big") + payload
+
+
+def uint(element_id: int, value: int) -> bytes:
+    return element(element_id, value.to_bytes(max(1, (value.bit_length() + 7) // 8), "big"))
+
+
+def string(element_id: int, value: str) -> bytes:
+    return element(element_id, value.encode("utf-8"))
+
+
+def track(number: int, track_type: int, codec: str, language: str = None, default: int = None, default_duration: int = None, video: bytes = None) -> bytes:
+    payload = uint(matroska.TRACK_NUMBER, number) + uint(matroska.TRACK_UID, 1000 + number) + uint(matroska.TRACK_TYPE, track_type)
+    payload += string(matroska.CODEC_ID, codec)
+
+    if language is not None:
+        payload += string(matroska.LANGUAGE, language)
+    if default is not None:
+        payload += uint(matroska.FLAG_DEFAULT, default)
+    if default_duration is not None:
+        payload += uint(matroska.DEFAULT_DURATION, default_duration)
+    if track_type == 1:
+        payload += element(matroska.VIDEO, uint(matroska.PIXEL_WIDTH, 1920) + uint(matroska.PIXEL_HEIGHT, 1080) + (video or b""))
+
+    return element(matroska.TRACK_ENTRY, payload)
+
+
+def seek_head(entries: [(int, int)]) -> bytes:
+    """ SeekHead with (element id, position) entries. Its size does not depend on positions """
+    seeks = b"".join(element(matroska.SEEK, element(matroska.SEEK_ID, element_id.to_bytes(4, "big")) +
+                                            element(matroska.SEEK_POSITION, position.to_bytes(8, "big")))
+                     for element_id, position in entries)
+    return element(matroska.SEEK_HEAD, seeks)
+
+
+def build_mkv(secondary_seek_head: bool = False, default_duration: int = 41708333, video: bytes = None) -> bytes:
+    """
+        Matroska file with tags placed after cluster, so they can be found only with SeekHead.
+        With secondary_seek_head, Tags are listed in second SeekHead (placed after cluster too) only.
+    """
+    header = element(matroska.EBML, string(matroska.DOC_TYPE, "matroska"))
+
+    info = element(matroska.INFO, uint(matroska.TIMESTAMP_SCALE, 1000000) + element(matroska.DURATION, struct.pack(">d", 61500.0)))
+    tracks = element(matroska.TRACKS,
+                     track(1, 1, "V_MPEG4/ISO/AVC", default_duration = default_duration, video = video) +
+                     track(2, 2, "A_AAC", language = "und") +
+                     track(3, 17, "S_TEXT/UTF8", language = "pol", default = 0) +
+                     track(4, 17, "S_TEXT/UTF8"))
+    cluster = element(matroska.CLUSTER, b"\0" * 64)
+    tags = element(matroska.TAGS, element(matroska.TAG,
+                   element(matroska.TARGETS, uint(matroska.TAG_TRACK_UID, 1003)) +
+                   element(matroska.SIMPLE_TAG, string(matroska.TAG_NAME, "DURATION") + string(matroska.TAG_STRING, "00:01:00.500000000"))))
+
+    if secondary_seek_head:
+        secondary_position = len(seek_head([(matroska.SEEK_HEAD, 0)])) + len(info) + len(tracks) + len(cluster)
+        tags_position = secondary_position + len(seek_head([(matroska.TAGS, 0)]))
+        segment = seek_head([(matroska.SEEK_HEAD, secondary_position)]) + info + tracks + cluster + \
+                  seek_head([(matroska.TAGS, tags_position)]) + tags
+    else:
+        tags_position = len(seek_head([(matroska.TAGS, 0)])) + len(info) + len(tracks) + len(cluster)
+        segment = seek_head([(matroska.TAGS, tags_position)]) + info + tracks + cluster + tags
+
+    return header + element(matroska.SEGMENT, segment)
+
+
+class MatroskaTests(unittest.TestCase):
+
+    def test_headers_are_read_without_ffprobe(self):
+        with WorkingDirectoryForTest() as td:
+            video = os.path.join(td.path, "video.mkv")
+            with open(video, "wb") as video_file:
+                video_file.write(build_mkv())
+
+            with patch("twotone.tools.utils.start_process") as start_process:
+                video_info = utils.get_video_data(video)
+                duration = utils.get_video_duration(video)
+                resolution = utils.get_video_resolution(video)
+                start_process.assert_not_called()
+
+            self.assertEqual(duration, 61500)
+            self.assertEqual(resolution, (1920, 1080))
+            self.assertEqual(video_info.video_tracks, [utils.VideoTrack(fps = "24000/1001", length = 61500)])
+            self.assertEqual(video_info.subtitles, [
+                utils.Subtitle(language = "pol", default = 0, length = 60500, tid = 2, format = "subrip"),
+                utils.Subtitle(language = "eng", default = 1, length = None, tid = 3, format = "subrip"),
+            ])
+
+            info = matroska.read_info(video)
+            self.assertNotIn("tags", info["streams"][1])
+
+    def test_tags_listed_in_secondary_seek_head_are_read(self):
+        with WorkingDirectoryForTest() as td:
+            video = os.path.join(td.path, "video.mkv")
+            with open(video, "wb") as video_file:
+                video_file.write(build_mkv(secondary_seek_head = True))
+
+            info = matroska.read_info(video)
+            self.assertEqual(info["streams"][2]["tags"], {"DURATION": "00:01:00.500000000", "language": "pol"})
+
+    def test_untrusted_frame_rate_falls_back_to_ffprobe(self):
+        ffprobe_output = '{"format": {"duration": "61.5"}, "streams": [{"index": 0, "codec_type": "video", "r_frame_rate": "25/1"}]}'
+
+        for mkv in [build_mkv(default_duration = 20000000, video = uint(matroska.FLAG_INTERLACED, 1)),     # field duration of 25i video
+                    build_mkv(default_duration = 33333000)]:                                               # irregular rate
+            with WorkingDirectoryForTest() as td:
+                video = os.path.join(td.path, "video.mkv")
+                with open(video, "wb") as video_file:
+                    video_file.write(mkv)
+
+                with self.assertRaises(ValueError):
+                    matroska.read_info(video)
+
+                with patch("twotone.tools.utils.start_process", return_value = utils.ProcessResult(0, ffprobe_output, "")) as start_process, \
+                     patch.object(utils, "_probe_cache_enabled", False):
+                    self.assertEqual(utils.get_video_data(video).video_tracks, [utils.VideoTrack(fps = "25/1", length = 61500)])
+                    start_process.assert_called_once()
+
+    def test_other_files_fall_back_to_ffprobe(self):
+        with WorkingDirectoryForTest() as td:
+            video = os.path.join(td.path, "video.mkv")
+            with open(video, "wb") as video_file:
+                video_file.write(b"RIFF" + b"\0" * 64)
+
+            with self.assertRaises(ValueError):
+                matroska.read_info(video)
+
+            ffprobe_output = '{"format": {"duration": "2.0"}, "streams": []}'
+            with patch("twotone.tools.utils.start_process", return_value = utils.ProcessResult(0, ffprobe_output, "")) as start_process, \
+                 patch.object(utils, "_probe_cache_enabled", False):
+                self.assertEqual(utils.get_video_duration(video), 2000)
+                start_process.assert_called_once()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -33,14 +33,14 @@ class SimpleSubtitlesMerge(unittest.TestCase):
             hashes_before = hashes(td.path)
             self.assertEqual(len(hashes_before), 2)
             try:
-                run_twotone("merge", [td.path], ["--no-dry-run"])
+                run_twotone("merge", [td.path], ["--no-dry-run", "--no-probe-cache"])
             except RuntimeError:
                 pass
 
             hashes_after = hashes(td.path)
 
             self.assertEqual(hashes_before, hashes_after)
-            self.assertEqual(mock_start_process.call_count, 3)
+            self.assertEqual(mock_start_process.call_count, 2)           # ffprobe + mkvmerge (subtitles are converted natively)
 
 
     def test_no_changes_when_ffprobe_exits_with_error(self):
@@ -60,7 +60,7 @@ class SimpleSubtitlesMerge(unittest.TestCase):
             hashes_before = hashes(td.path)
             self.assertEqual(len(hashes_before), 2)
             try:
-                run_twotone("merge", [td.path], ["--no-dry-run"])
+                run_twotone("merge", [td.path], ["--no-dry-run", "--no-probe-cache"])
             except RuntimeError:
                 pass
 
@@ -79,14 +79,17 @@ class SimpleSubtitlesMerge(unittest.TestCase):
             else:
                 return self._start_process.__func__(cmd, args)
 
-        with patch("twotone.tools.utils.start_process") as mock_start_process, WorkingDirectoryForTest() as td:
+        # ffmpeg is used only when native subtitles conversion fails
+        with patch("twotone.tools.utils.start_process") as mock_start_process, \
+             patch("twotone.tools.subtitle_formats.convert_to_subrip", side_effect = ValueError("unsupported")), \
+             WorkingDirectoryForTest() as td:
             mock_start_process.side_effect = start_process
             add_test_media("Blue_Sky_and_Clouds_Timelapse.*(?:mov|srt)", td.path)
 
             hashes_before = hashes(td.path)
             self.assertEqual(len(hashes_before), 2)
             try:
-                run_twotone("merge", [td.path], ["--no-dry-run"])
+                run_twotone("merge", [td.path], ["--no-dry-run", "--no-probe-cache"])
             except RuntimeError:
                 pass
 
@@ -1,7 +1,10 @@
 
 import os
 import unittest
+from unittest.mock import patch
 
+import twotone.tools.cache as cache
+import twotone.tools.merge as merge
 import twotone.tools.utils as utils
 from common import WorkingDirectoryForTest, list_files, add_test_media, run_twotone
 
@@ -85,5 +88,47 @@ class SimpleSubtitlesMerge(unittest.TestCase):
             self.assertEqual(tracks.subtitles[1].default, 0)
 
 
+class LanguageGuessing(unittest.TestCase):
+
+    def test_sample_has_no_timings_nor_markup(self):
+        data = "1\n00:00:01,000 --> 00:00:02,500\n<i>Hello</i> World\n\n2\n00:00:03,000 --> 00:00:04,000\n{\\an8}How are|you?\n"
+        self.assertEqual(merge.Merge._language_sample(data.encode("utf-8"), "utf-8"), "Hello World How are you?")
+
+        data = "{10}{20}Hello|World\n00:00:06:Good bye\n"
+        self.assertEqual(merge.Merge._language_sample(data.encode("utf-8"), "utf-8"), "Hello World Good bye")
+
+    def test_results_are_cached(self):
+        with WorkingDirectoryForTest() as td:
+            subtitle = os.path.join(td.path, "subtitle.txt")
+            with open(subtitle, "w", encoding = "utf-8") as sf:
+                sf.write("00:00:00:Witaj Świecie\n")
+                sf.write("00:00:06:To jest przykładowy tekst po polsku\n")
+
+            def guess_language() -> str:
+                merger = merge.Merge(dry_run = True, language = "auto", lang_priority = "")
+                merger._language_cache = cache.LanguageCache(td.path)
+                return merger._guess_language(subtitle, "utf-8")
+
+            self.assertEqual(guess_language(), "pl")
+
+            with patch.object(merge, "_get_language_identifier") as identifier:
+                self.assertEqual(guess_language(), "pl")
+                identifier.assert_not_called()
+
+            # same bytes decoded differently are classified again
+            with patch.object(merge, "_get_language_identifier") as identifier:
+                identifier.return_value.classify.return_value = ("cs", 1.0)
+                merger = merge.Merge(dry_run = True, language = "auto", lang_priority = "")
+                merger._language_cache = cache.LanguageCache(td.path)
+                self.assertEqual(merger._guess_language(subtitle, "cp1250"), "cs")
+
+    def test_cache_can_be_disabled(self):
+        merger = merge.Merge(dry_run = True, language = "auto", lang_priority = "", use_language_cache = False)
+
+        with patch.object(cache, "LanguageCache") as language_cache:
+            self.assertIsNone(merger._get_language_cache())
+            language_cache.assert_not_called()
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -86,6 +86,24 @@ class SubtitlesMerge(unittest.TestCase):
                 self.assertEqual(len(tracks.video_tracks), 1)
                 self.assertEqual(len(tracks.subtitles), 1)
 
+    def test_many_videos_conversion_in_parallel(self):
+        with WorkingDirectoryForTest() as td:
+            add_test_media(get_default_media_set_regex(), td.path)
+
+            files_before = list_files(td.path)
+            self.assertEqual(len(files_before), 2 * 13)         # 13 videos and 13 subtitles expected
+
+            run_twotone("merge", [td.path, "--jobs", "4"], ["--no-dry-run"])
+
+            files_after = list_files(td.path)
+            self.assertEqual(len(files_after), 1 * 13)          # 13 mkv videos expected
+
+            for video in files_after:
+                self.assertEqual(video[-4:], ".mkv")
+                tracks = utils.get_video_data(video)
+                self.assertEqual(len(tracks.video_tracks), 1)
+                self.assertEqual(len(tracks.subtitles), 1)
+
     def test_subtitles_language(self):
         with WorkingDirectoryForTest() as td:
 
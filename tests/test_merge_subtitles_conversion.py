@@ -2,8 +2,71 @@
 import os
 import unittest
 
+import twotone.tools.subtitle_formats as subtitle_formats
 import twotone.tools.utils as utils
-from common import WorkingDirectoryForTest, list_files, add_test_media, generate_microdvd_subtitles, run_twotone
+from common import WorkingDirectoryForTest, current_path, list_files, add_test_media, generate_microdvd_subtitles, run_twotone
+
+
+class NativeConversion(unittest.TestCase):
+
+    @staticmethod
+    def _convert(input_path: str, output_path: str, fps: float) -> [subtitle_formats.Cue]:
+        info = utils.sniff_subtitle(input_path)
+        subtitle_formats.convert_to_subrip(input_path, info.encoding, info.format, output_path, fps)
+
+        with open(output_path, "r", encoding = "utf-8") as output_file:
+            return subtitle_formats.parse_subrip(output_file.read())
+
+    def test_microdvd_is_converted_with_video_fps(self):
+        with WorkingDirectoryForTest() as td:
+            input_path = os.path.join(td.path, "subtitles.txt")
+            generate_microdvd_subtitles(input_path, length = 1, fps = 25)
+
+            cues = self._convert(input_path, os.path.join(td.path, "subtitles.srt"), 25)
+
+            # entries without text are dropped
+            self.assertEqual(cues, [subtitle_formats.Cue(0, 480, "0")])
+
+    def test_subtitles_without_text_are_not_converted(self):
+        with WorkingDirectoryForTest() as td:
+            input_path = os.path.join(td.path, "subtitles.sub")
+            with open(input_path, "w") as subtitles_file:
+                subtitles_file.write("{0}{25}\n{25}{50}{y:i}\n{50}{100}\n")
+
+            output_path = os.path.join(td.path, "subtitles.srt")
+            with self.assertRaises(ValueError):
+                subtitle_formats.convert_to_subrip(input_path, "utf-8", "microdvd", output_path, 25)
+
+            self.assertFalse(os.path.exists(output_path))
+
+    def test_microdvd_fps_header_is_respected(self):
+        with WorkingDirectoryForTest() as td:
+            input_path = os.path.join(td.path, "subtitles.sub")
+            with open(input_path, "w") as subtitles_file:
+                subtitles_file.write("{1}{1}25.000\n{25}{50}first|line\n{50}{100}{y:i}second\n")
+
+            cues = self._convert(input_path, os.path.join(td.path, "subtitles.srt"), 60)
+            self.assertEqual(cues, [subtitle_formats.Cue(1000, 2000, "first\nline"), subtitle_formats.Cue(2000, 4000, "second")])
+
+    def test_tmplayer_cues_last_until_next_one(self):
+        with WorkingDirectoryForTest() as td:
+            input_path = os.path.join(current_path, "subtitles_txt", "herd-of-horses-in-fog-13642605.txt")
+            cues = self._convert(input_path, os.path.join(td.path, "subtitles.srt"), 25)
+
+            self.assertEqual(cues[0], subtitle_formats.Cue(1000, 2000, "a"))
+            self.assertEqual(cues[1].start, cues[0].end)
+            self.assertEqual(cues[-1].end - cues[-1].start, subtitle_formats.last_cue_duration)
+
+    def test_subrip_round_trip(self):
+        with WorkingDirectoryForTest() as td:
+            input_path = os.path.join(current_path, "subtitles", "moon.srt")
+            cues = self._convert(input_path, os.path.join(td.path, "subtitles.srt"), 25)
+
+            with open(input_path, "r", encoding = "utf-8") as input_file:
+                timings = utils.subrip_time_pattern.findall(input_file.read())
+
+            self.assertEqual([(cue.start, cue.end) for cue in cues],
+                             [(utils.time_to_ms(start), utils.time_to_ms(end)) for start, end in timings])
 
 
 class SubtitlesConversion(unittest.TestCase):
@@ -0,0 +1,78 @@
+
+import json
+import os
+import unittest
+from unittest.mock import patch
+
+import twotone.tools.quality_metrics as quality_metrics
+import twotone.twotone as twotone
+from twotone.tools.transcode import Transcoder
+from common import WorkingDirectoryForTest
+
+
+class QualityMetricsTests(unittest.TestCase):
+
+    def _write_stats(self, directory: str, content: str) -> str:
+        stats_file = os.path.join(directory, "stats")
+        with open(stats_file, "w") as stats:
+            stats.write(content)
+
+        return stats_file
+
+    def test_psnr(self):
+        psnr = quality_metrics.create("psnr", threads = 4)
+        self.assertEqual(psnr.ffmpeg_options(), ["-filter_complex_threads", "4"])
+        self.assertEqual(psnr.filter("0:v", "1:v", "/stats"), "[0:v][1:v]psnr=stats_file='/stats'")
+
+        with WorkingDirectoryForTest() as td:
+            stats_file = self._write_stats(td.path,
+                "n:1 mse_avg:0.53 mse_y:0.71 mse_u:0.19 mse_v:0.17 psnr_avg:50.00 psnr_y:48.00 psnr_u:55.30 psnr_v:55.82\n"
+                "n:2 mse_avg:0.00 mse_y:0.00 mse_u:0.00 mse_v:0.00 psnr_avg:inf psnr_y:inf psnr_u:inf psnr_v:inf\n")
+
+            # identical frames count as upper bound of metric's range
+            self.assertAlmostEqual(psnr.parse(stats_file), 75.0)
+            self.assertAlmostEqual(psnr.parse(stats_file, luma_only = True), 74.0)
+
+    def test_vmaf(self):
+        vmaf = quality_metrics.create("vmaf", threads = 4, vmaf_model = "vmaf_4k_v0.6.1")
+        self.assertEqual(vmaf.config(), "vmaf:vmaf_4k_v0.6.1")
+
+        # distorted video goes first, subsampling is done by libvmaf
+        self.assertEqual(vmaf.filter("reference", "distorted", "/stats", subsample = 5),
+                         "[distorted][reference]libvmaf=model=version=vmaf_4k_v0.6.1:log_path='/stats':log_fmt=json:n_threads=4:n_subsample=5")
+
+        with WorkingDirectoryForTest() as td:
+            stats_file = self._write_stats(td.path, json.dumps({"pooled_metrics": {"vmaf": {"min": 90.1, "mean": 96.5}}}))
+            self.assertEqual(vmaf.parse(stats_file), 96.5)
+
+        with self.assertRaises(ValueError):
+            quality_metrics.create("vmaf", vmaf_model = "unknown")
+
+    def test_transcoder_targets(self):
+        self.assertEqual(Transcoder().target_quality, 0.98)
+        self.assertEqual(Transcoder(target_ssim = 0.99).target_quality, 0.99)
+        self.assertEqual(Transcoder(metric = "vmaf").target_quality, quality_metrics.Vmaf.default_target)
+        self.assertEqual(Transcoder(metric = "psnr", target_quality = 40).target_quality, 40)
+
+        transcoder = Transcoder(metric = "vmaf", quality_stride = 3, quality_planes = "luma")
+        self.assertEqual(transcoder._measurement_config(), "libx265:veryfast:vmaf:vmaf_v0.6.1:stride=3")
+        self.assertEqual(Transcoder(quality_planes = "luma")._measurement_config(), "libx265:veryfast:ssim:luma")
+        self.assertEqual(transcoder._journal_parameters(), "libx265:vmaf:vmaf_v0.6.1=95.0")
+        self.assertEqual(transcoder._quality_filter("/stats"),
+                         "[1:v][0:v]libvmaf=model=version=vmaf_v0.6.1:log_path='/stats':log_fmt=json:n_subsample=3")
+
+    def test_target_is_validated_against_metric_range(self):
+        with self.assertRaises(ValueError):
+            Transcoder(metric = "ssim", target_quality = 98)
+
+        for args in [["--target", "98"], ["--metric", "vmaf", "--target", "0.98"], ["--target", "0.98", "--metric", "psnr"]]:
+            with self.assertRaises(RuntimeError):
+                twotone.execute(["transcode", *args, "/videos"])
+
+        with patch.object(Transcoder, "transcode") as transcode:
+            twotone.execute(["transcode", "--target", "98", "--metric", "vmaf", "/videos"])
+            transcode.assert_called_once_with("/videos")
+
+
+if __name__ == '__main__':
+    unittest.main()
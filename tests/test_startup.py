@@ -0,0 +1,79 @@
+
+import os
+import re
+import subprocess
+import sys
+import unittest
+
+from common import current_path
+
+
+# total time (in microseconds) of all imports done by 'twotone <tool> --help'
+import_time_budget = 1000 * 1000
+
+# modules which are slow to import and are needed by some tools only
+heavy_modules = ["cchardet", "langid", "numpy", "requests", "tqdm"]
+
+tool_modules = {
+    "concatenate": "twotone.tools.concatenate",
+    "melt": "twotone.tools.melt",
+    "merge": "twotone.tools.merge",
+    "subtitles_fix": "twotone.tools.subtitles_fixer",
+    "transcode": "twotone.tools.transcode",
+}
+
+
+def imports_for_help(tool: str = None) -> dict:
+    """ Run 'twotone <tool> --help' (or 'twotone --help' when no tool is given) with -X importtime. Returns {module: (self time, cumulative time)} """
+    tool_args = [] if tool is None else [tool]
+    process = subprocess.run([sys.executable, "-X", "importtime", "-m", "twotone", *tool_args, "--help"],
+                             cwd = os.path.dirname(current_path), capture_output = True, text = True)
+
+    if process.returncode != 0:
+        raise RuntimeError(f"twotone failed: {process.stderr}")
+
+    result = {}
+    for line in process.stderr.splitlines():
+        match = re.fullmatch(r"import time:\s*(\d+) \|\s*(\d+) \|( *)(\S+)", line)
+        if match:
+            result[match.group(4)] = (int(match.group(1)), int(match.group(2)))
+
+    return result
+
+
+class Startup(unittest.TestCase):
+
+    def test_only_selected_tool_is_imported(self):
+        for tool, tool_module in tool_modules.items():
+            with self.subTest(tool = tool):
+                imports = imports_for_help(tool)
+
+                self.assertIn(tool_module, imports)
+                for other_module in tool_modules.values():
+                    if other_module != tool_module:
+                        self.assertNotIn(other_module, imports)
+
+                self.assertNotIn("langid", imports)
+                self.assertNotIn("cchardet", imports)
+
+    def test_no_tool_code_is_imported_for_main_help(self):
+        imports = imports_for_help()
+
+        self.assertNotIn("twotone.tools.utils", imports)
+        for module in [*tool_modules.values(), *heavy_modules]:
+            self.assertNotIn(module, imports)
+
+    def test_help_fits_latency_budget(self):
+        for tool in ["concatenate", "transcode"]:
+            with self.subTest(tool = tool):
+                imports = imports_for_help(tool)
+
+                for module in heavy_modules:
+                    self.assertNotIn(module, imports)
+
+                total = sum(self_time for self_time, _ in imports.values())
+                self.assertLess(total, import_time_budget)
+
+
+if __name__ == '__main__':
+    unittest.main()
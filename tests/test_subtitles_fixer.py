@@ -3,8 +3,11 @@ import logging
 import os
 import unittest
 import tempfile
+from unittest.mock import patch
 
+import twotone.tools.subtitle_formats as subtitle_formats
 import twotone.tools.utils as utils
+from twotone.tools.subtitles_fixer import Fixer
 
 from common import WorkingDirectoryForTest, add_test_media, hashes, current_path, generate_microdvd_subtitles, run_twotone
 
@@ -66,6 +69,38 @@ def create_broken_video_with_incompatible_subtitles(output_video_path: str, inpu
         utils.start_process("ffmpeg", ["-hide_banner", "-i", input_video, "-i", subtitle_path, "-map", "0", "-map", "1", "-c:v", "copy", "-c:a", "copy", output_video_path])
 
 
+class SubtitlesResolvers(unittest.TestCase):
+
+    def test_resolvers_edit_document(self):
+        content = "1\n00:00:01,000 --> 00:00:02,000\na\n\n2\n00:00:09,000 --> 00:00:30,000\nb\n"
+        video_track = utils.VideoTrack(fps = "25/1", length = 10000)
+        fixer = Fixer(really_fix = False)
+
+        document = subtitle_formats.SubtitleDocument.from_text(content)
+        resolver = fixer._get_resolver(document, video_track.length)
+        self.assertEqual(resolver, fixer._long_tail_resolver)
+        self.assertEqual(resolver(video_track, document).last(), subtitle_formats.Cue(9000, 10000, "b"))
+
+        document = subtitle_formats.SubtitleDocument.from_text(content).shift(10000)
+        resolver = fixer._get_resolver(document, video_track.length)
+        self.assertEqual(resolver, fixer._fps_scale_resolver)
+        self.assertEqual(resolver(video_track, document).first().start, int(11000 * utils.ffmpeg_default_fps / 25))
+
+
+class SubtitlesFixerJournal(unittest.TestCase):
+
+    def test_outcome_is_not_recorded_in_dry_run(self):
+        video_info = utils.VideoInfo([utils.VideoTrack(fps = "25/1", length = 10000)],
+                                     [utils.Subtitle("eng", default = 1, length = 9000, tid = 2, format = "subrip")], "/video.mkv")
+
+        with patch("twotone.tools.utils.record_processing_outcome") as record_processing_outcome:
+            self.assertIsNone(Fixer(really_fix = False)._check_if_broken(video_info))
+            record_processing_outcome.assert_not_called()
+
+            self.assertIsNone(Fixer(really_fix = True)._check_if_broken(video_info))
+            record_processing_outcome.assert_called_once_with("/video.mkv", "subtitles_fix", "", "no issues")
+
+
 class SubtitlesFixer(unittest.TestCase):
 
     def setUp(self):
@@ -93,8 +128,8 @@ class SubtitlesFixer(unittest.TestCase):
 
             self.assertNotEqual(hashes_before, hashes_after)
 
-            # run again - there should be no changes
-            run_twotone("subtitles_fix", [td.path], ["-r"])
+            # run again (without journal, so file is analysed again) - there should be no changes
+            run_twotone("subtitles_fix", [td.path], ["-r", "--no-journal"])
             hashes_after_after = hashes(td.path)
             self.assertEqual(hashes_after, hashes_after_after)
 
@@ -109,8 +144,8 @@ class SubtitlesFixer(unittest.TestCase):
 
             self.assertNotEqual(hashes_before, hashes_after)
 
-            # run again - there should be no changes
-            run_twotone("subtitles_fix", [td.path], ["-r"])
+            # run again (without journal, so file is analysed again) - there should be no changes
+            run_twotone("subtitles_fix", [td.path], ["-r", "--no-journal"])
             hashes_after_after = hashes(td.path)
             self.assertEqual(hashes_after, hashes_after_after)
 
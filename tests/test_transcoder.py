@@ -1,22 +1,495 @@
 
-import unittest
 import logging
+import os
+import unittest
+from unittest.mock import patch
 
+import twotone.tools.cache as cache
+import twotone.tools.utils as utils
 import twotone.twotone as twotone
-from twotone.tools.transcode import Transcoder
+from twotone.tools.transcode import CrfDecision, Transcoder, exact_quality
 from common import WorkingDirectoryForTest, get_video, add_test_media, hashes, run_twotone
 
 
+class CrfSearchTests(unittest.TestCase):
+
+    @staticmethod
+    def _ssim_curve(crf: int) -> float:
+        # smooth, monotonically decreasing curve resembling SSIM(CRF)
+        return 1.0 - 0.00012 * crf ** 1.8
+
+    def _search(self, strategy: str, target: float):
+        evaluated = []
+
+        def evaluate(crf, exact = False):
+            evaluated.append(crf)
+            return self._ssim_curve(crf)
+
+        transcoder = Transcoder(target_ssim = target, crf_search = strategy)
+        search = getattr(transcoder, Transcoder.crf_search_strategies[strategy])
+        best_crf, _ = search(evaluate)
+
+        return best_crf, evaluated
+
+    def test_interpolation_matches_exhaustive_search(self):
+        for target in [0.90, 0.95, 0.97, 0.98, 0.99, 0.995]:
+            expected = max(crf for crf in range(52) if self._ssim_curve(crf) >= target)
+
+            best_crf, evaluated = self._search("interpolation", target)
+            self.assertEqual(best_crf, expected)
+            self.assertEqual(len(evaluated), len(set(evaluated)))
+
+            best_crf, _ = self._search("bisection", target)
+            self.assertEqual(best_crf, expected)
+
+    def test_interpolation_needs_fewer_evaluations(self):
+        _, interpolation_evaluations = self._search("interpolation", 0.98)
+        _, bisection_evaluations = self._search("bisection", 0.98)
+
+        self.assertLess(len(interpolation_evaluations), len(bisection_evaluations))
+
+    def test_sanity_check(self):
+        def exact_evaluations(strategy: str, curve):
+            transcoder = Transcoder(target_ssim = 0.98, crf_search = strategy)
+            search = getattr(transcoder, Transcoder.crf_search_strategies[strategy])
+            evaluated = []
+
+            def evaluate(crf, exact = False):
+                if exact:
+                    evaluated.append(crf)
+                return curve(crf)
+
+            try:
+                search(evaluate)
+            except RuntimeError:
+                pass
+
+            return evaluated
+
+        # bisection always checks top quality first
+        self.assertEqual(exact_evaluations("bisection", self._ssim_curve), [0])
+
+        # interpolation checks it only when target was not met
+        self.assertEqual(exact_evaluations("interpolation", self._ssim_curve), [])
+        self.assertEqual(exact_evaluations("interpolation", lambda crf: self._ssim_curve(crf) - 0.05), [0])
+
+    def test_decisions_are_not_used_as_qualities(self):
+        # evaluations stopped early tell only whether target is met
+        for strategy in Transcoder.crf_search_strategies:
+            transcoder = Transcoder(target_ssim = 0.98, crf_search = strategy)
+            search = getattr(transcoder, Transcoder.crf_search_strategies[strategy])
+            evaluate = lambda crf, exact = False: self._ssim_curve(crf) if exact else CrfDecision(self._ssim_curve(crf) >= 0.98)
+
+            best_crf, best_result = search(evaluate)
+            self.assertEqual(best_crf, 17)
+            self.assertIsNone(exact_quality(best_result))
+
+    def test_unreachable_quality(self):
+        for strategy in Transcoder.crf_search_strategies:
+            transcoder = Transcoder(target_ssim = 0.9995, crf_search = strategy)
+            search = getattr(transcoder, Transcoder.crf_search_strategies[strategy])
+
+            with self.assertRaises(RuntimeError):
+                search(lambda crf, exact = False: self._ssim_curve(crf) - 0.001)
+
+        with self.assertRaises(ValueError):
+            Transcoder(target_ssim = 1.01)
+
+
+class SegmentsExtractionTests(unittest.TestCase):
+
+    def test_segments_are_extracted_in_batches(self):
+        segments = [(i * 10, i * 10 + 5) for i in range(10)]
+
+        with patch("twotone.tools.utils.start_process", return_value = utils.ProcessResult(0, "", "")) as start_process:
+            output_files = Transcoder(threads = 8, extraction = "lossless")._extract_segments("/video.mp4", segments, "/output", batch_size = 8)
+
+        self.assertEqual(len(output_files), 10)
+        self.assertEqual(len(set(output_files)), 10)
+        self.assertEqual(start_process.call_count, 2)
+
+        first_batch_args = start_process.call_args_list[0].args[1]
+        self.assertEqual(first_batch_args.count("-i"), 8)
+        self.assertEqual([first_batch_args[i + 1] for i, arg in enumerate(first_batch_args) if arg == "-map"],
+                         [f"{i}:v:0" for i in range(8)])
+        self.assertEqual(output_files[:8], [arg for arg in first_batch_args if arg.startswith("/output/")])
+
+    def test_segments_are_copied_unless_source_is_damaged(self):
+        segments = [(i * 10, i * 10 + 5) for i in range(3)]
+
+        def extraction_args(probe_result: utils.ProcessResult):
+            with patch("twotone.tools.utils.start_process", side_effect = [probe_result, utils.ProcessResult(0, "", "")]) as start_process:
+                output_files = Transcoder(threads = 8)._extract_segments("/video.mp4", segments, "/output")
+
+            probe_args, extraction_args = [call.args[1] for call in start_process.call_args_list]
+            self.assertIn("-xerror", probe_args)
+            self.assertEqual(len(output_files), 3)
+
+            return output_files, extraction_args
+
+        output_files, args = extraction_args(utils.ProcessResult(0, "", ""))
+        self.assertEqual(args[args.index("-c:v") + 1], "copy")
+        self.assertTrue(all(file.endswith(".mkv") for file in output_files))
+
+        output_files, args = extraction_args(utils.ProcessResult(0, "", "Invalid NAL unit size"))
+        self.assertEqual(args[args.index("-c:v") + 1], "libx265")
+        self.assertTrue(all(file.endswith(".mp4") for file in output_files))
+
+
+class SceneSelectionTests(unittest.TestCase):
+
+    def test_segments_are_centred_on_detected_scene_changes(self):
+        scene_changes = [1.0, 30.0, 32.0, 120.5]
+
+        def ffmpeg(process, args, on_stderr_line = None):
+            for pts_time in scene_changes:
+                on_stderr_line(f"[Parsed_showinfo_2 @ 0x55d0] n:   0 pts:  {int(pts_time * 1000)} pts_time:{pts_time} duration: 1")
+            return utils.ProcessResult(0, "", "")
+
+        with patch("twotone.tools.utils.start_process", side_effect = ffmpeg) as start_process:
+            segments = Transcoder()._select_scenes("/video.mp4", segment_duration = 5)
+
+        # key frames only are used for detection
+        args = start_process.call_args.args[1]
+        self.assertEqual(args[args.index("-skip_frame") + 1], "nokey")
+
+        self.assertEqual(segments, [(0, 3.5), (27.5, 34.5), (118.0, 123.0)])
+        for scene_change in scene_changes:
+            self.assertTrue(any(start < scene_change < end for start, end in segments))
+
+    def test_failed_detection_is_reported(self):
+        with patch("twotone.tools.utils.start_process", return_value = utils.ProcessResult(1, "", "Invalid data found")):
+            with self.assertRaises(RuntimeError):
+                Transcoder()._select_scenes("/video.mp4")
+
+
+class CrfSearchCacheTests(unittest.TestCase):
+
+    def test_measurements_and_results_are_reused(self):
+        with WorkingDirectoryForTest() as td:
+            video = os.path.join(td.path, "video.mp4")
+            with open(video, "wb") as video_file:
+                video_file.write(b"video")
+
+            transcoder = Transcoder()
+            transcoder._search_cache = cache.CrfSearchCache(os.path.join(td.path, "cache"))
+
+            with patch("twotone.tools.utils.get_video_duration", return_value = 10000), \
+                 patch.object(Transcoder, "_transcode_segment_and_compare",
+                              side_effect = lambda wd, segment, crf, threads, cancellation = None: CrfSearchTests._ssim_curve(crf)) as measure:
+
+                self.assertEqual(transcoder.find_optimal_crf(video), 17)
+                first_run_encodes = measure.call_count
+                self.assertGreater(first_run_encodes, 0)
+
+                # same target: stored result is used
+                self.assertEqual(transcoder.find_optimal_crf(video), 17)
+                self.assertEqual(measure.call_count, first_run_encodes)
+
+                # different target: stored measurements are reused
+                transcoder.target_quality = 0.97
+                self.assertEqual(transcoder.find_optimal_crf(video), 21)
+                self.assertLess(measure.call_count - first_run_encodes, first_run_encodes)
+
+                # modified file is analysed from scratch
+                with open(video, "ab") as video_file:
+                    video_file.write(b" changed")
+
+                calls_before = measure.call_count
+                self.assertEqual(transcoder.find_optimal_crf(video), 21)
+                self.assertGreater(measure.call_count, calls_before)
+
+            transcoder._search_cache.close()
+
+    def test_results_depend_on_search_setup(self):
+        def result_config(**options):
+            transcoder = Transcoder(**options)
+            with patch("twotone.tools.utils.get_video_duration", return_value = 10000):
+                return transcoder._search_setup("/video.mp4", True, utils.ProbeContext())[2]
+
+        self.assertEqual(result_config(), "libx265:veryfast:ssim:whole:interpolation:crf=0-51:start=26")
+        self.assertNotEqual(result_config(), result_config(crf_search = "bisection"))
+
+        with patch.object(Transcoder, "crf_range", (10, 40)):
+            self.assertEqual(result_config(), "libx265:veryfast:ssim:whole:interpolation:crf=10-40:start=26")
+
+    def test_measurements_depend_on_extraction_mode(self):
+        segments = [(i * 60, i * 60 + 5) for i in range(4)]
+
+        with WorkingDirectoryForTest() as td, \
+             patch("twotone.tools.utils.get_video_duration", return_value = 600000), \
+             patch.object(Transcoder, "_select_scenes", return_value = segments), \
+             patch.object(Transcoder, "_is_source_intact", return_value = True), \
+             patch.object(Transcoder, "_extract_segments", return_value = [f"/segment{i}.mkv" for i in range(4)]), \
+             patch.object(Transcoder, "_transcode_segment_and_compare",
+                          side_effect = lambda wd, segment, crf, threads, cancellation = None: CrfSearchTests._ssim_curve(crf)) as measure:
+
+            video = os.path.join(td.path, "video.mp4")
+            with open(video, "wb") as video_file:
+                video_file.write(b"video")
+
+            transcoder = Transcoder(proxy_search = "never")
+            transcoder._search_cache = cache.CrfSearchCache(os.path.join(td.path, "cache"))
+            self.assertEqual(transcoder.find_optimal_crf(video), 17)
+            copy_encodes = measure.call_count
+
+            # segments extracted in other way are different reference, so nothing is reused
+            transcoder.extraction = "ffv1"
+            self.assertEqual(transcoder.find_optimal_crf(video), 17)
+            self.assertEqual(measure.call_count, 2 * copy_encodes)
+
+            transcoder._search_cache.close()
+
+        self.assertEqual(transcoder._measurement_config("ffv1"), "libx265:veryfast:ssim:extract=ffv1")
+
+
+class EarlyAbortTests(unittest.TestCase):
+
+    def test_evaluation_stops_when_outcome_is_known(self):
+        segments = [(i * 60, i * 60 + 5) for i in range(10)]
+        transcoder = Transcoder(threads = 1, use_search_cache = False, proxy_search = "never")
+
+        with WorkingDirectoryForTest() as td, \
+             patch("twotone.tools.utils.get_video_duration", return_value = 600000), \
+             patch.object(Transcoder, "_select_scenes", return_value = segments), \
+             patch.object(Transcoder, "_is_source_intact", return_value = True), \
+             patch.object(Transcoder, "_extract_segments", return_value = [f"/segment{i}.mp4" for i in range(10)]), \
+             patch.object(Transcoder, "_transcode_segment_and_compare",
+                          side_effect = lambda wd, segment, crf, threads, cancellation = None: CrfSearchTests._ssim_curve(crf)) as measure:
+
+            video = os.path.join(td.path, "video.mp4")
+            with open(video, "wb") as video_file:
+                video_file.write(b"video")
+
+            self.assertEqual(transcoder.find_optimal_crf(video), 17)
+
+        evaluated_crfs = {call.args[2] for call in measure.call_args_list}
+        self.assertLess(measure.call_count, len(evaluated_crfs) * len(segments))
+
+
+    def test_segments_which_cannot_be_measured_are_left_out(self):
+        segments = [(i * 60, i * 60 + 5) for i in range(10)]
+        transcoder = Transcoder(threads = 1, use_search_cache = False, proxy_search = "never")
+
+        def measure(wd, segment, crf, threads, cancellation = None):
+            return None if segment == "/segment0.mp4" else CrfSearchTests._ssim_curve(crf)
+
+        with WorkingDirectoryForTest() as td, \
+             patch("twotone.tools.utils.get_video_duration", return_value = 600000), \
+             patch.object(Transcoder, "_select_scenes", return_value = segments), \
+             patch.object(Transcoder, "_is_source_intact", return_value = True), \
+             patch.object(Transcoder, "_extract_segments", return_value = [f"/segment{i}.mp4" for i in range(10)]), \
+             patch.object(Transcoder, "_transcode_segment_and_compare", side_effect = measure), \
+             self.assertLogs(level = logging.INFO) as logs:
+
+            video = os.path.join(td.path, "video.mp4")
+            with open(video, "wb") as video_file:
+                video_file.write(b"video")
+
+            self.assertEqual(transcoder.find_optimal_crf(video), 17)
+
+        # measured segments make the average, failed one is reported
+        quality = next(float(message.rsplit(" ", 1)[1]) for message in logs.output if "CRF: 17, Average Quality" in message)
+        self.assertAlmostEqual(quality, CrfSearchTests._ssim_curve(17))
+        self.assertTrue(any("Could not measure quality of /segment0.mp4" in message for message in logs.output))
+
+class ProxySearchTests(unittest.TestCase):
+
+    def test_crf_is_found_on_proxies_and_confirmed_at_native_resolution(self):
+        segments = [(i * 60, i * 60 + 5) for i in range(10)]
+
+        def extract_segments(video, segments, output_dir, scale_height = None):
+            return [f"/segment{i}.{scale_height or 'native'}.mp4" for i in range(len(segments))]
+
+        def measure(wd, segment, crf, threads, cancellation = None):
+            # downscaled video looks slightly worse at the same CRF
+            return CrfSearchTests._ssim_curve(crf) - (0.004 if ".540." in segment else 0)
+
+        def find_optimal_crf(proxy_search: str):
+            transcoder = Transcoder(use_search_cache = False, proxy_search = proxy_search)
+
+            with WorkingDirectoryForTest() as td, \
+                 patch("twotone.tools.utils.get_video_duration", return_value = 600000), \
+                 patch("twotone.tools.utils.get_video_resolution", return_value = (3840, 2160)), \
+                 patch.object(Transcoder, "_select_scenes", return_value = segments), \
+                 patch.object(Transcoder, "_is_source_intact", return_value = True), \
+                 patch.object(Transcoder, "_extract_segments", side_effect = extract_segments), \
+                 patch.object(Transcoder, "_transcode_segment_and_compare", side_effect = measure) as measure_mock:
+
+                video = os.path.join(td.path, "video.mp4")
+                with open(video, "wb") as video_file:
+                    video_file.write(b"video")
+
+                best_crf = transcoder.find_optimal_crf(video)
+
+            native_crfs = {call.args[2] for call in measure_mock.call_args_list if ".native." in call.args[1]}
+            return best_crf, native_crfs
+
+        best_crf, native_crfs = find_optimal_crf("never")
+        proxy_best_crf, proxy_native_crfs = find_optimal_crf("auto")
+
+        self.assertEqual(best_crf, 17)
+        self.assertEqual(proxy_best_crf, 17)
+        self.assertLessEqual(len(proxy_native_crfs), 2)                 # calibration and confirmation of single CRF
+        self.assertLess(len(proxy_native_crfs), len(native_crfs))
+
+
+    def test_confirmation_reuses_known_point(self):
+        transcoder = Transcoder(target_ssim = 0.98)
+        curve = CrfSearchTests._ssim_curve
+
+        for known_crf, estimated_crf, expected_crf in [(17, 17, 17), (15, 16, 16), (19, 17, 17), (17, 19, 17), (16, 16, 17)]:
+            evaluated = []
+
+            def evaluate(crf, exact = False):
+                evaluated.append(crf)
+                return curve(crf)
+
+            best_crf, best_quality = transcoder._confirm_crf(evaluate, (known_crf, curve(known_crf)), estimated_crf)
+            self.assertEqual(best_crf, expected_crf)
+            self.assertEqual(best_quality, curve(expected_crf))
+            self.assertLessEqual(len(evaluated), 1)
+
+        # nothing meets target
+        self.assertIsNone(transcoder._confirm_crf(lambda crf, exact = False: curve(crf), (20, curve(20)), 19))
+
+
+class SubsampledMeasurementTests(unittest.TestCase):
+
+    ssim_stats = "n:1 Y:0.991000 U:0.995000 V:0.996000 All:0.993000 (21.549019)\n" \
+                 "n:2 Y:0.989000 U:0.993000 V:0.994000 All:0.991000 (20.457575)\n"
+
+    def test_full_measurement_is_default(self):
+        transcoder = Transcoder()
+
+        self.assertEqual(transcoder._quality_args("a.mkv", "b.mkv", "/stats"),
+                         ["-i", "a.mkv", "-i", "b.mkv", "-lavfi", "[0:v][1:v]ssim=stats_file='/stats'", "-f", "null", "-"])
+        self.assertEqual(transcoder._measurement_config(), "libx265:veryfast:ssim")
+
+        with WorkingDirectoryForTest() as td:
+            stats_file = os.path.join(td.path, "stats")
+            with open(stats_file, "w") as stats:
+                stats.write(self.ssim_stats)
+
+            self.assertAlmostEqual(transcoder._parse_quality(stats_file), 0.992)
+
+    def test_subsampled_measurement(self):
+        transcoder = Transcoder(quality_stride = 4, quality_planes = "luma", quality_downscale = 720)
+
+        quality_filter = transcoder._quality_filter("/stats")
+        self.assertIn("[0:v]select='not(mod(n,4))',scale=-2:'min(720,ih)',extractplanes=y[reference]", quality_filter)
+        self.assertIn("[1:v]select='not(mod(n,4))',scale=-2:'min(720,ih)',extractplanes=y[distorted]", quality_filter)
+        self.assertIn("[reference][distorted]ssim=stats_file='/stats'", quality_filter)
+        self.assertEqual(transcoder._measurement_config(), "libx265:veryfast:ssim:stride=4:luma:scale=720")
+
+        # final verification is never subsampled
+        self.assertEqual(transcoder._quality_filter("/stats", subsampled = False), "[0:v][1:v]ssim=stats_file='/stats'")
+
+        with WorkingDirectoryForTest() as td:
+            stats_file = os.path.join(td.path, "stats")
+            with open(stats_file, "w") as stats:
+                stats.write(self.ssim_stats)
+
+            self.assertAlmostEqual(transcoder._parse_quality(stats_file), 0.990)
+            self.assertAlmostEqual(transcoder._parse_quality(stats_file, subsampled = False), 0.992)
+
+
+class ProcessingJournalTests(unittest.TestCase):
+
+    def test_processed_files_are_skipped(self):
+        with WorkingDirectoryForTest() as td:
+            video = os.path.join(td.path, "video.mp4")
+            with open(video, "wb") as video_file:
+                video_file.write(b"video")
+
+            journal = cache.ProcessingJournal(os.path.join(td.path, "cache"))
+
+            def probe_many(paths, probe = None, interruptible = None):
+                return ((path, utils.VideoInfo([utils.VideoTrack("25/1", 10000)], [], path)) for path in paths)
+
+            with patch.object(utils, "_processing_journal", journal), \
+                 patch("twotone.tools.utils.probe_many", side_effect = probe_many), \
+                 patch.object(Transcoder, "_find_video_files", return_value = [video]), \
+                 patch.object(Transcoder, "find_optimal_crf", return_value = 20) as find_optimal_crf, \
+                 patch.object(Transcoder, "_final_transcode", return_value = "kept original: encoded file larger"):
+
+                Transcoder(live_run = True).transcode(td.path)
+                self.assertEqual(find_optimal_crf.call_count, 1)
+
+                # file kept as it was, nothing to do
+                Transcoder(live_run = True).transcode(td.path)
+                self.assertEqual(find_optimal_crf.call_count, 1)
+
+                # different parameters or forced processing
+                Transcoder(live_run = True, target_ssim = 0.99).transcode(td.path)
+                self.assertEqual(find_optimal_crf.call_count, 2)
+
+                Transcoder(live_run = True, reprocess = True).transcode(td.path)
+                self.assertEqual(find_optimal_crf.call_count, 3)
+
+                # modified file is processed again
+                with open(video, "ab") as video_file:
+                    video_file.write(b" changed")
+
+                Transcoder(live_run = True).transcode(td.path)
+                self.assertEqual(find_optimal_crf.call_count, 4)
+
+            journal.close()
+
+
+class ThreadBudgetSharingTests(unittest.TestCase):
+
+    def test_final_transcoding_shares_budget_only_with_pending_search(self):
+        with WorkingDirectoryForTest() as td:
+            videos = [os.path.join(td.path, f"video_{i}.mp4") for i in range(3)]
+            for video in videos:
+                with open(video, "wb") as video_file:
+                    video_file.write(b"video")
+
+            transcoder = Transcoder(live_run = True, threads = 8)
+            transcoder._search_cache = cache.CrfSearchCache(os.path.join(td.path, "cache"))
+
+            # optimal CRF of last video is known already, so there is no search to share CPU with after first one
+            result_config = f"{transcoder._measurement_config()}:whole:interpolation:crf=0-51:start=26"
+            transcoder._search_cache.put_result(cache.file_fingerprint(videos[2]), result_config, transcoder.target_quality, 20)
+
+            final_transcodings = []
+
+            def final_transcode(file, crf, threads):
+                final_transcodings.append((os.path.basename(file), threads, transcoder.budget._available))
+                return "transcoded"
+
+            def probe_many(paths, probe = None, interruptible = None):
+                return ((path, utils.VideoInfo([utils.VideoTrack("25/1", 10000)], [], path)) for path in paths)
+
+            with patch.object(utils, "_processing_journal_enabled", False), \
+                 patch("twotone.tools.utils.probe_many", side_effect = probe_many), \
+                 patch("twotone.tools.utils.get_video_duration", return_value = 10000), \
+                 patch.object(transcoder, "_find_video_files", return_value = videos), \
+                 patch.object(transcoder, "find_optimal_crf", return_value = 20), \
+                 patch.object(transcoder, "_final_transcode", side_effect = final_transcode), \
+                 patch.object(transcoder, "_needs_search", wraps = transcoder._needs_search) as needs_search:
+                transcoder.transcode(td.path)
+
+            # only next file is checked
+            self.assertEqual([call.args[0] for call in needs_search.call_args_list], videos[1:])
+
+            self.assertEqual(final_transcodings, [("video_0.mp4", 4, 4), ("video_1.mp4", 8, 0), ("video_2.mp4", 8, 0)])
+            self.assertEqual(transcoder.budget._available, 8)
+
+            transcoder._search_cache.close()
+
+
 class TranscoderTests(unittest.TestCase):
 
     def test_video_1_for_best_crf(self):
         test_video = get_video("big_buck_bunny_720p_2mb.mp4")
-        best_enc = Transcoder().find_optimal_crf(test_video, allow_segments=False)
+        best_enc = Transcoder(use_search_cache = False).find_optimal_crf(test_video, allow_segments=False)
 
         self.assertEqual(best_enc, 28)
 
     def test_video_with_segments_and_no_segments(self):
-        transcoder = Transcoder()
+        transcoder = Transcoder(use_search_cache = False)
         for test_video, crf in [(get_video("10189155-hd_1920_1080_25fps.mp4"), 27),
                                 (get_video("big_buck_bunny_720p_10mb.mp4"), 29)]:
             best_enc_segments = transcoder.find_optimal_crf(test_video, allow_segments=True)
@@ -25,6 +498,28 @@ class TranscoderTests(unittest.TestCase):
             self.assertEqual(best_enc_no_segments, crf)
             self.assertTrue(abs(best_enc_no_segments - best_enc_segments) < 2)
 
+    def test_subsampled_ssim_matches_full_ssim(self):
+        test_video = get_video("big_buck_bunny_720p_10mb.mp4")
+        full_transcoder = Transcoder(use_search_cache = False)
+        full_crf = full_transcoder.find_optimal_crf(test_video)
+
+        with WorkingDirectoryForTest() as td:
+            full_quality = full_transcoder._transcode_segment_and_compare(td.path, test_video, full_crf)
+
+            # subsampled measurement may deviate by no more than quality difference of single CRF step (chosen CRF stays within ±1 then)
+            tolerance = full_quality - full_transcoder._transcode_segment_and_compare(td.path, test_video, full_crf + 1)
+
+            for options in [{"quality_stride": 4}, {"quality_planes": "luma"}, {"quality_stride": 4, "quality_planes": "luma", "quality_downscale": 360}]:
+                with self.subTest(**options):
+                    transcoder = Transcoder(use_search_cache = False, **options)
+                    crf = transcoder.find_optimal_crf(test_video)
+
+                    quality = transcoder._transcode_segment_and_compare(td.path, test_video, full_crf)
+                    logging.info(f"{options}: SSIM deviation at CRF {full_crf}: {quality - full_quality:+.5f} (tolerance: {tolerance:.5f}), CRF: {crf} (full SSIM: {full_crf})")
+
+                    self.assertLessEqual(abs(quality - full_quality), tolerance)
+                    self.assertLessEqual(abs(crf - full_crf), 1)
+
     def test_transcoding_on_short_videos_dry_run(self):
         with WorkingDirectoryForTest() as td:
             add_test_media("VID_20240412_1815.*", td.path, copy = True)
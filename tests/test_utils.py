@@ -1,7 +1,14 @@
 
+import json
 import os
+import threading
+import time
 import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch
 
+import twotone.tools.cache as cache
+import twotone.tools.subtitle_formats as subtitle_formats
 import twotone.tools.utils as utils
 from common import WorkingDirectoryForTest
 
@@ -24,6 +31,25 @@ class UtilsTests(unittest.TestCase):
         full_path = os.path.join(wd, file)
         self.assertEqual(utils.is_subtitle_conversion_required(full_path), needs_conversion)
 
+    def test_subtitle_sniffing(self):
+        with WorkingDirectoryForTest() as wd:
+            for name, content, encoding, format in [("tmplayer.txt", "00:00:01:Witaj świecie\n", "cp1250", "tmplayer"),
+                                                     ("microdvd.sub", "{1}{25}Zażółć gęślą jaźń\n", "utf-8", "microdvd"),
+                                                     ("subrip.srt", "1\r\n00:00:00,000 --> 00:00:01,000\r\nHello\r\n", "utf-8", "subrip")]:
+                subtitle_path = os.path.join(wd.path, name)
+                with open(subtitle_path, "w", encoding = encoding, newline = "") as subtitle_file:
+                    # make file way bigger than sniffed prefix
+                    subtitle_file.write(content * (utils.subtitle_sniff_size // len(content) * 4))
+
+                info = utils.sniff_subtitle(subtitle_path)
+                self.assertIsNotNone(info)
+                self.assertEqual(info.format, format)
+                self.assertEqual(info.path, subtitle_path)
+                self.assertEqual(utils.file_encoding(subtitle_path), info.encoding)
+
+                with open(subtitle_path, "r", encoding = info.encoding, newline = "") as subtitle_file:
+                    self.assertEqual(subtitle_file.read(len(content)), content)
+
     def test_subtitle_detection(self):
         self._test_content("12:34:56:test", True)
         self._test_content("{1}{2}test", True)
@@ -34,5 +60,435 @@ class UtilsTests(unittest.TestCase):
         self._test_content("{a}{b}:test", False)
 
 
+class ProbeCacheTests(unittest.TestCase):
+
+    @staticmethod
+    def _fake_ffprobe(cmd, args):
+        if "-version" in args:
+            return utils.ProcessResult(0, "ffprobe version 7.1\n", "")
+        else:
+            return utils.ProcessResult(0, '{"format": {"duration": "12.5"}, "streams": []}', "")
+
+    @staticmethod
+    def _duration_probes(mock_start_process) -> int:
+        return sum(1 for call in mock_start_process.call_args_list if "-show_format" in call.args[1])
+
+    def _run_with_cache(self, enabled: bool, test):
+        with WorkingDirectoryForTest() as wd, patch("twotone.tools.utils.start_process") as mock_start_process:
+            mock_start_process.side_effect = self._fake_ffprobe
+            video_path = os.path.join(wd.path, "video.mkv")
+            with open(video_path, "wb") as video_file:
+                video_file.write(b"video")
+
+            probe_cache = cache.ProbeCache(os.path.join(wd.path, "cache"))
+            with patch.object(utils, "_probe_cache", probe_cache), \
+                 patch.object(utils, "_probe_cache_enabled", enabled), \
+                 patch.object(utils, "_ffprobe_version", None):
+                test(video_path, mock_start_process)
+
+            probe_cache.close()
+
+    def test_probe_results_are_reused_until_file_changes(self):
+        def test(video_path, mock_start_process):
+            self.assertEqual(utils.get_video_duration(video_path), 12500)
+            self.assertEqual(utils.get_video_duration(video_path), 12500)
+            self.assertEqual(self._duration_probes(mock_start_process), 1)
+
+            with open(video_path, "ab") as video_file:
+                video_file.write(b" changed")
+
+            self.assertEqual(utils.get_video_duration(video_path), 12500)
+            self.assertEqual(self._duration_probes(mock_start_process), 2)
+
+        self._run_with_cache(True, test)
+
+    def test_disabled_cache_always_probes(self):
+        def test(video_path, mock_start_process):
+            utils.get_video_duration(video_path)
+            utils.get_video_duration(video_path)
+            self.assertEqual(self._duration_probes(mock_start_process), 2)
+
+        self._run_with_cache(False, test)
+
+
+class ProbeContextTests(unittest.TestCase):
+
+    ffprobe_output = json.dumps({
+        "format": {"duration": "10.000000"},
+        "streams": [
+            {"index": 0, "codec_type": "video", "r_frame_rate": "25/1", "avg_frame_rate": "25/1"},
+            {"index": 1, "codec_type": "subtitle", "codec_name": "subrip", "disposition": {"default": 1},
+             "tags": {"language": "pol", "DURATION": "00:00:09.500000000"}},
+        ]
+    })
+
+    def test_single_probe_per_file(self):
+        with patch("twotone.tools.utils.start_process") as mock_start_process, \
+             patch.object(utils, "_probe_cache_enabled", False):
+            mock_start_process.return_value = utils.ProcessResult(0, self.ffprobe_output, "")
+
+            probe = utils.ProbeContext()
+            video_info = utils.get_video_data("video.mkv", probe = probe)
+            duration = utils.get_video_duration("video.mkv", probe = probe)
+            frames = utils.get_video_frames_count("video.mkv", probe = probe)
+
+            self.assertEqual(mock_start_process.call_count, 1)
+            self.assertEqual(duration, 10000)
+            self.assertEqual(frames, 250)
+            self.assertEqual(video_info.video_tracks[0].length, 10000)
+            self.assertEqual(video_info.subtitles[0].length, 9500)
+            self.assertEqual(video_info.subtitles[0].language, "pol")
+
+    def test_malformed_output_gives_no_details(self):
+        with patch("twotone.tools.utils.start_process") as mock_start_process, \
+             patch.object(utils, "_probe_cache_enabled", False):
+            for output in ["{not a json", '{"format": "broken", "streams": "broken"}']:
+                mock_start_process.return_value = utils.ProcessResult(0, output, "")
+
+                self.assertIsNone(utils.get_video_duration("video.avi"))
+                self.assertIsNone(utils.get_video_frames_count("video.avi"))
+                self.assertIsNone(utils.get_video_resolution("video.avi"))
+
+
+class ProcessOutputStreamingTests(unittest.TestCase):
+
+    def test_stderr_lines_are_streamed(self):
+        lines = []
+        result = utils.start_process("sh", ["-c", "for i in 1 2 3 4 5; do echo line$i >&2; done; echo output"],
+                                     on_stderr_line = lines.append, stderr_tail_lines = 2)
+
+        self.assertEqual(result.returncode, 0)
+        self.assertEqual(result.stdout, "output\n")
+        self.assertEqual(lines, [f"line{i}" for i in range(1, 6)])
+        self.assertEqual(result.stderr, "line4\nline5")
+
+
+class PipelineTests(unittest.TestCase):
+
+    def test_producer_output_is_consumed(self):
+        result = utils.start_pipeline("printf", ["a\\nb\\nc\\n"], "wc", ["-l"])
+
+        self.assertEqual(result.returncode, 0)
+        self.assertEqual(result.stdout.strip(), "3")
+
+    def test_failure_of_any_process_is_reported(self):
+        result = utils.start_pipeline("false", [], "cat", [])
+        self.assertNotEqual(result.returncode, 0)
+
+        result = utils.start_pipeline("printf", ["a"], "false", [])
+        self.assertNotEqual(result.returncode, 0)
+
+
+class LibraryIndexTests(unittest.TestCase):
+
+    @staticmethod
+    def _make_old(path: str, age_s: int = 60):
+        # directories modified just before scan are not trusted, pretend they were modified long ago
+        mtime = time.time() - age_s
+        os.utime(path, (mtime, mtime))
+
+    @staticmethod
+    def _normalized(walk):
+        return sorted((root, sorted(dirs), sorted(files)) for root, dirs, files in walk)
+
+    def test_only_modified_directories_are_rescanned(self):
+        with WorkingDirectoryForTest() as wd:
+            library = os.path.join(wd.path, "library")
+            for subdir in ["a", "b", os.path.join("b", "c")]:
+                os.makedirs(os.path.join(library, subdir))
+                with open(os.path.join(library, subdir, "video.mkv"), "w"):
+                    pass
+
+            for root, _, _ in list(os.walk(library)):
+                self._make_old(root)
+
+            index = cache.LibraryIndex(os.path.join(wd.path, "cache"))
+            self.assertEqual(self._normalized(index.walk(library)), self._normalized(os.walk(library)))
+
+            with patch.object(index, "_scan", wraps=index._scan) as mock_scan:
+                self.assertEqual(self._normalized(index.walk(library)), self._normalized(os.walk(library)))
+                self.assertEqual(mock_scan.call_count, 0)
+
+                with open(os.path.join(library, "b", "c", "subtitles.srt"), "w"):
+                    pass
+                self._make_old(os.path.join(library, "b", "c"), age_s=30)
+
+                self.assertEqual(self._normalized(index.walk(library)), self._normalized(os.walk(library)))
+                self.assertEqual(mock_scan.call_count, 1)
+
+            index.close()
+
+    def test_recently_modified_directory_is_not_trusted(self):
+        with WorkingDirectoryForTest() as wd:
+            index = cache.LibraryIndex(os.path.join(wd.path, "cache"))
+            stat = os.stat(wd.path)
+            index.list_directory(wd.path)
+
+            # modification done within the same mtime granularity tick as the scan must not be missed
+            with open(os.path.join(wd.path, "video.mkv"), "w"):
+                pass
+            os.utime(wd.path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
+            self.assertIn("video.mkv", index.list_directory(wd.path).files)
+            index.close()
+
+
+def max_concurrency(events_file: str) -> int:
+    """ Greatest number of calls running at once according to 'start'/'end' lines appended by them to events_file """
+    running = 0
+    peak = 0
+
+    with open(events_file, "r") as events:
+        for event in events.read().split():
+            running += 1 if event == "start" else -1
+            peak = max(peak, running)
+
+    return peak
+
+
+class ProcessRunnerTests(unittest.TestCase):
+
+    def test_results_are_in_calls_order_and_concurrency_is_limited(self):
+        runner = utils.ProcessRunner(limit = 3)
+        finished = []
+
+        with WorkingDirectoryForTest() as wd:
+            events_file = os.path.join(wd.path, "events")
+            calls = [("sh", ["-c", f"echo start >> {events_file}; sleep 0.2; echo end >> {events_file}; echo {i}"]) for i in range(6)]
+
+            results = runner.run_many(calls, on_result = lambda index, result: finished.append(index))
+            peak = max_concurrency(events_file)
+
+        self.assertEqual([result.stdout.strip() for result in results], [str(i) for i in range(6)])
+        self.assertEqual(sorted(finished), list(range(6)))
+        self.assertGreater(peak, 1)
+        self.assertLessEqual(peak, 3)
+
+    def test_results_are_yielded_in_completion_order(self):
+        runner = utils.ProcessRunner(limit = 2)
+
+        with WorkingDirectoryForTest() as wd:
+            # first call cannot finish before second one does
+            fast_done = os.path.join(wd.path, "fast_done")
+            calls = [("sh", ["-c", f"while [ ! -e {fast_done} ]; do sleep 0.05; done; sleep 0.2; echo slow"]),
+                     ("sh", ["-c", f"echo fast; touch {fast_done}"]),
+                     ("sleep", ["10"])]
+
+            start = time.monotonic()
+            results = runner.iter_many(calls)
+            self.assertEqual(next(results), (1, utils.ProcessResult(0, "fast\n", "")))
+            self.assertEqual(next(results), (0, utils.ProcessResult(0, "slow\n", "")))
+
+            # closing generator kills processes which are still running
+            results.close()
+            self.assertLess(time.monotonic() - start, 5)
+
+    def test_timeout_kills_process_group(self):
+        runner = utils.ProcessRunner()
+
+        start = time.monotonic()
+        results = runner.run_many([("sh", ["-c", "sleep 10 & sleep 10"]), ("true", [])], timeout = 0.3)
+
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertNotEqual(results[0].returncode, 0)
+        self.assertEqual(results[1].returncode, 0)
+
+    def test_interruption_cancels_running_processes(self):
+        interruptible = utils.InterruptibleProcess()
+        runner = utils.ProcessRunner(interruptible = interruptible, poll_interval = 0.05)
+        threading.Timer(0.2, lambda: setattr(interruptible, "_work", False)).start()
+
+        start = time.monotonic()
+        with self.assertRaises(SystemExit):
+            runner.run_many([("sleep", ["10"])] * 4)
+
+        self.assertLess(time.monotonic() - start, 5)
+
+
+class CancellationTests(unittest.TestCase):
+
+    def test_cancel_kills_running_and_future_processes(self):
+        cancellation = utils.Cancellation()
+        threading.Timer(0.2, cancellation.cancel).start()
+
+        start = time.monotonic()
+        process_result = utils.start_process("sh", ["-c", "sleep 10 & sleep 10"], cancellation = cancellation)
+        pipeline_result = utils.start_pipeline("sleep", ["10"], "cat", [], cancellation = cancellation)
+
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertNotEqual(process_result.returncode, 0)
+        self.assertNotEqual(pipeline_result.returncode, 0)
+
+
+class ProbeManyTests(unittest.TestCase):
+
+    fake_ffprobe = """#!/bin/sh
+echo start >> "$(dirname "$0")/events"
+sleep 0.2
+echo end >> "$(dirname "$0")/events"
+case "$*" in
+    *broken*) echo "invalid data" >&2; exit 1;;
+esac
+echo '{"format": {"duration": "10.0"}, "streams": [{"codec_type": "video", "r_frame_rate": "25/1", "duration": "10.0"}]}'
+"""
+
+    def test_all_files_are_probed_concurrently(self):
+        paths = [f"/videos/video_{i}.mkv" for i in range(8)] + ["/videos/broken.mkv"]
+        probe = utils.ProbeContext()
+
+        with WorkingDirectoryForTest() as wd:
+            ffprobe = os.path.join(wd.path, "ffprobe")
+            with open(ffprobe, "w") as ffprobe_file:
+                ffprobe_file.write(self.fake_ffprobe)
+            os.chmod(ffprobe, 0o755)
+
+            with patch.dict(os.environ, {"PATH": wd.path + os.pathsep + os.environ["PATH"]}), \
+                 patch.object(utils, "_probe_cache_enabled", False), \
+                 patch("twotone.tools.utils.start_process") as start_process:
+                results = dict(utils.probe_many(paths, jobs = 4, probe = probe))
+
+                # all ffprobe processes are run by ProcessRunner
+                start_process.assert_not_called()
+
+            peak = max_concurrency(os.path.join(wd.path, "events"))
+
+        self.assertEqual(set(results), set(paths))
+        self.assertIsNone(results["/videos/broken.mkv"])
+        self.assertEqual(results["/videos/video_0.mkv"].video_tracks[0].fps, "25/1")
+        self.assertGreater(peak, 1)
+        self.assertLessEqual(peak, 4)
+
+        # results are kept in context
+        with patch("twotone.tools.utils.start_process") as start_process:
+            self.assertEqual(probe.duration("/videos/video_3.mkv"), 10000)
+            start_process.assert_not_called()
+
+    def test_interruption_kills_running_probes(self):
+        paths = [f"/videos/video_{i}.mkv" for i in range(4)]
+        interruptible = utils.InterruptibleProcess()
+        interruptible._work = False
+
+        with WorkingDirectoryForTest() as wd:
+            ffprobe = os.path.join(wd.path, "ffprobe")
+            with open(ffprobe, "w") as ffprobe_file:
+                ffprobe_file.write("#!/bin/sh\nsleep 600\n")
+            os.chmod(ffprobe, 0o755)
+
+            with patch.dict(os.environ, {"PATH": wd.path + os.pathsep + os.environ["PATH"]}), \
+                 patch.object(utils, "_probe_cache_enabled", False):
+                results = []
+                with self.assertRaises(SystemExit):
+                    results.extend(utils.probe_many(paths, probe = utils.ProbeContext(), interruptible = interruptible))
+
+        # no probe finished, all were killed
+        self.assertEqual(results, [])
+
+
+class SubtitleDocumentTests(unittest.TestCase):
+
+    content = "1\n00:00:01,000 --> 00:00:02,500\nfirst\n\n2\n01:00:00,000 --> 01:00:01,000\nsecond\nline\n"
+
+    @staticmethod
+    def _reference_scaling(content: str, multiplier: float) -> str:
+        # scaling done cue by cue
+        def multiply_time(match):
+            time_from, time_to = map(utils.time_to_ms, match.groups())
+            return f"{utils.ms_to_time(time_from * multiplier)} --> {utils.ms_to_time(time_to * multiplier)}"
+
+        return utils.subrip_time_pattern.sub(multiply_time, content)
+
+    def test_scaling_matches_per_cue_conversion(self):
+        content = "".join(f"{i + 1}\n{utils.ms_to_time(i * 1237)} --> {utils.ms_to_time(i * 1237 + 999)}\nline {i}\n\n" for i in range(2000))
+
+        for multiplier in [1, utils.ffmpeg_default_fps / 25, 25 / utils.ffmpeg_default_fps, 0.5]:
+            self.assertEqual(utils.alter_subrip_subtitles_times(content, multiplier), self._reference_scaling(content, multiplier))
+
+    def test_cues_access(self):
+        document = subtitle_formats.SubtitleDocument.from_text(self.content)
+
+        self.assertEqual(len(document), 2)
+        self.assertEqual(document.starts.tolist(), [1000, 3600000])
+        self.assertEqual(document.ends.tolist(), [2500, 3601000])
+        self.assertEqual(document.first(), subtitle_formats.Cue(1000, 2500, "first"))
+        self.assertEqual(document.last(), subtitle_formats.Cue(3600000, 3601000, "second\nline"))
+        self.assertEqual(document.to_text(), self.content)
+
+        self.assertEqual(len(subtitle_formats.SubtitleDocument.from_text("no cues")), 0)
+        self.assertEqual(subtitle_formats.SubtitleDocument.from_text("no cues").to_text(), "no cues")
+
+    def test_mixed_timing_widths(self):
+        # lengths of timings sum up to a multiple of fixed width timing length, but each timing has different layout
+        content = "1\n100:00:00,000 --> 1:00:00,000\na\n\n2\n1:00:00,000 --> 100:00:00,000\nb\n\n3\n00:00:01,000 --> 00:00:02,000\nc\n"
+        document = subtitle_formats.SubtitleDocument.from_text(content)
+
+        self.assertEqual(document.times.tolist(), [[360000000, 3600000], [3600000, 360000000], [1000, 2000]])
+
+    def test_transformations(self):
+        document = subtitle_formats.SubtitleDocument.from_text(self.content).shift(-1500)
+        self.assertEqual(document.to_text(), self.content.replace("00:00:01,000 --> 00:00:02,500", "00:00:00,000 --> 00:00:01,000")
+                                                         .replace("01:00:00,000 --> 01:00:01,000", "00:59:58,500 --> 00:59:59,500"))
+
+        # piecewise map: first hour is stretched twice
+        document = subtitle_formats.SubtitleDocument.from_text(self.content).piecewise([0, 3600000], [0, 7200000])
+        self.assertEqual(document.times.tolist(), [[2000, 5000], [7200000, 7202000]])
+
+        # long hours are supported
+        document = subtitle_formats.SubtitleDocument.from_text(self.content).shift(99 * 3600 * 1000)
+        self.assertEqual(document.last().start, 100 * 3600 * 1000)
+        self.assertEqual(subtitle_formats.SubtitleDocument.from_text(document.to_text()).times.tolist(), document.times.tolist())
+
+    def test_edits_are_saved_in_place(self):
+        with WorkingDirectoryForTest() as td:
+            path = os.path.join(td.path, "subtitles.srt")
+            with open(path, "w", encoding = "utf-8") as subtitles_file:
+                subtitles_file.write(self.content)
+
+            document = subtitle_formats.SubtitleDocument.load(path)
+            last = document.last()
+            document.set_times(len(document) - 1, last.start, last.start + 5000)
+
+            with patch("twotone.tools.subtitle_formats.SubtitleDocument.to_bytes") as to_bytes:
+                document.save()
+                to_bytes.assert_not_called()
+
+            with open(path, "r", encoding = "utf-8") as subtitles_file:
+                self.assertEqual(subtitles_file.read(), self.content.replace("01:00:01,000", "01:00:05,000"))
+
+            # timing which does not fit in place makes whole file rewritten
+            document.shift(99 * 3600 * 1000).save()
+            self.assertEqual(subtitle_formats.SubtitleDocument.load(path).times.tolist(), document.times.tolist())
+            self.assertEqual(subtitle_formats.SubtitleDocument.load(path).last().text, "second\nline")
+
+
+class ThreadBudgetTests(unittest.TestCase):
+
+    def test_reservations_never_exceed_budget(self):
+        budget = utils.ThreadBudget(4)
+        lock = threading.Lock()
+        in_use = []
+        peak = []
+
+        def job(threads: int):
+            with budget.reserve(threads) as reserved:
+                with lock:
+                    in_use.append(reserved)
+                    peak.append(sum(in_use))
+                time.sleep(0.01)
+                with lock:
+                    in_use.remove(reserved)
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            list(executor.map(job, [1, 2, 3, 4, 8, 2, 1, 3]))
+
+        self.assertLessEqual(max(peak), 4)
+
+    def test_reserve_available_takes_what_is_left(self):
+        budget = utils.ThreadBudget(6)
+
+        with budget.reserve(4):
+            with budget.reserve_available(6) as threads:
+                self.assertEqual(threads, 2)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,278 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+
+
+FileFingerprint = namedtuple("FileFingerprint", "path size mtime_ns")
+
+
+def cache_dir() -> str:
+    """ Directory for persistent twotone data (follows XDG base directory specification) """
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "twotone")
+
+
+def file_fingerprint(path: str) -> FileFingerprint:
+    real_path = os.path.realpath(path)
+    stat = os.stat(real_path)
+
+    return FileFingerprint(real_path, stat.st_size, stat.st_mtime_ns)
+
+
+class SqliteStore:
+    """
+        Thin, thread safe wrapper over sqlite database kept in cache directory.
+        Derived classes provide schema and domain specific accessors.
+    """
+
+    def __init__(self, name: str, schema: str, directory: str = None):
+        directory = cache_dir() if directory is None else directory
+        os.makedirs(directory, exist_ok = True)
+
+        self.path = os.path.join(directory, f"{name}.sqlite")
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(self.path, timeout = 30, check_same_thread = False, isolation_level = None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.executescript(schema)
+
+    def _execute(self, query: str, params = ()) -> list:
+        with self._lock:
+            return self._connection.execute(query, params).fetchall()
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+class ProbeCache(SqliteStore):
+    """
+        ffprobe results keyed by file path, size, modification time and ffprobe version.
+        Entry for a file is replaced as soon as any of these changes.
+    """
+
+    def __init__(self, directory: str = None):
+        super().__init__("probe", """
+            CREATE TABLE IF NOT EXISTS probes (
+                path TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                tool_version TEXT NOT NULL,
+                data TEXT NOT NULL,
+                PRIMARY KEY (path, kind)
+            );
+        """, directory)
+
+    def get(self, fingerprint: FileFingerprint, kind: str, tool_version: str):
+        rows = self._execute("SELECT data FROM probes WHERE path = ? AND kind = ? AND size = ? AND mtime_ns = ? AND tool_version = ?",
+                             (fingerprint.path, kind, fingerprint.size, fingerprint.mtime_ns, tool_version))
+
+        return json.loads(rows[0][0]) if rows else None
+
+    def put(self, fingerprint: FileFingerprint, kind: str, tool_version: str, data):
+        self._execute("INSERT OR REPLACE INTO probes (path, kind, size, mtime_ns, tool_version, data) VALUES (?, ?, ?, ?, ?, ?)",
+                      (fingerprint.path, kind, fingerprint.size, fingerprint.mtime_ns, tool_version, json.dumps(data)))
+
+
+class CrfSearchCache(SqliteStore):
+    """
+        Results of CRF search: selected segments, quality measured for each segment and CRF, and final optimal CRFs.
+        Everything is keyed by file fingerprint, so modified files are analysed from scratch.
+        'config' describes how measurements were done (codec, preset, metric etc.).
+    """
+
+    def __init__(self, directory: str = None):
+        super().__init__("crf_search", """
+            CREATE TABLE IF NOT EXISTS segments (
+                path TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                segments TEXT NOT NULL,
+                PRIMARY KEY (path, size, mtime_ns)
+            );
+            CREATE TABLE IF NOT EXISTS measurements (
+                path TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                segment TEXT NOT NULL,
+                config TEXT NOT NULL,
+                crf INTEGER NOT NULL,
+                quality REAL NOT NULL,
+                PRIMARY KEY (path, size, mtime_ns, segment, config, crf)
+            );
+            CREATE TABLE IF NOT EXISTS results (
+                path TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                config TEXT NOT NULL,
+                target REAL NOT NULL,
+                crf INTEGER,
+                PRIMARY KEY (path, size, mtime_ns, config, target)
+            );
+        """, directory)
+
+    def get_segments(self, fingerprint: FileFingerprint) -> list or None:
+        rows = self._execute("SELECT segments FROM segments WHERE path = ? AND size = ? AND mtime_ns = ?", fingerprint)
+        return [tuple(segment) for segment in json.loads(rows[0][0])] if rows else None
+
+    def put_segments(self, fingerprint: FileFingerprint, segments: list):
+        self._execute("INSERT OR REPLACE INTO segments (path, size, mtime_ns, segments) VALUES (?, ?, ?, ?)",
+                      (*fingerprint, json.dumps(segments)))
+
+    def get_quality(self, fingerprint: FileFingerprint, segment: str, config: str, crf: int) -> float or None:
+        rows = self._execute("SELECT quality FROM measurements WHERE path = ? AND size = ? AND mtime_ns = ? AND segment = ? AND config = ? AND crf = ?",
+                             (*fingerprint, segment, config, crf))
+        return rows[0][0] if rows else None
+
+    def put_quality(self, fingerprint: FileFingerprint, segment: str, config: str, crf: int, quality: float):
+        self._execute("INSERT OR REPLACE INTO measurements (path, size, mtime_ns, segment, config, crf, quality) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                      (*fingerprint, segment, config, crf, quality))
+
+    def get_result(self, fingerprint: FileFingerprint, config: str, target: float) -> (bool, int or None):
+        """ Returns tuple: (result found, optimal crf). Optimal CRF is None when no CRF met the target """
+        rows = self._execute("SELECT crf FROM results WHERE path = ? AND size = ? AND mtime_ns = ? AND config = ? AND target = ?",
+                             (*fingerprint, config, target))
+        return (True, rows[0][0]) if rows else (False, None)
+
+    def put_result(self, fingerprint: FileFingerprint, config: str, target: float, crf: int or None):
+        self._execute("INSERT OR REPLACE INTO results (path, size, mtime_ns, config, target, crf) VALUES (?, ?, ?, ?, ?, ?)",
+                      (*fingerprint, config, target, crf))
+
+
+class LanguageCache(SqliteStore):
+    """ Languages detected for subtitles, keyed by hash of text sample used for detection """
+
+    def __init__(self, directory: str = None):
+        super().__init__("languages", """
+            CREATE TABLE IF NOT EXISTS languages (
+                hash TEXT PRIMARY KEY,
+                language TEXT NOT NULL
+            );
+        """, directory)
+
+    def get(self, sample_hash: str) -> str or None:
+        rows = self._execute("SELECT language FROM languages WHERE hash = ?", (sample_hash,))
+        return rows[0][0] if rows else None
+
+    def put(self, sample_hash: str, language: str):
+        self._execute("INSERT OR REPLACE INTO languages (hash, language) VALUES (?, ?)", (sample_hash, language))
+
+
+DirectoryListing = namedtuple("DirectoryListing", "subdirs files")
+
+
+class LibraryIndex(SqliteStore):
+    """
+        Listings of scanned directories with their modification times and stats of files they contain.
+        Directory is read again only when its modification time changes.
+
+        Listings of directories which were modified shortly before they were scanned are not trusted
+        as further modifications done in the same timestamp granularity window would be undetectable.
+    """
+
+    racy_window_ns = 2 * 1000 * 1000 * 1000             # 2s (coarsest mtime granularity of common filesystems)
+
+    def __init__(self, directory: str = None):
+        super().__init__("library_index", """
+            CREATE TABLE IF NOT EXISTS directories (
+                path TEXT PRIMARY KEY,
+                mtime_ns INTEGER NOT NULL,
+                scanned_ns INTEGER NOT NULL,
+                listing TEXT NOT NULL
+            );
+        """, directory)
+
+    def list_directory(self, path: str) -> DirectoryListing:
+        """
+            List directory content.
+            Returns DirectoryListing with subdirs: {name: is_symlink} and files: {name: (size, mtime_ns)}
+        """
+        path = os.path.abspath(path)
+        mtime_ns = os.stat(path).st_mtime_ns
+        rows = self._execute("SELECT mtime_ns, scanned_ns, listing FROM directories WHERE path = ?", (path,))
+
+        if rows:
+            cached_mtime_ns, scanned_ns, listing = rows[0]
+            if cached_mtime_ns == mtime_ns and mtime_ns < scanned_ns - self.racy_window_ns:
+                subdirs, files = json.loads(listing)
+                return DirectoryListing(subdirs, {name: tuple(stat) for name, stat in files.items()})
+
+        return self._scan(path, mtime_ns, json.loads(rows[0][2])[0] if rows else {})
+
+    def walk(self, top: str, followlinks: bool = False):
+        """ os.walk equivalent (top-down) using stored listings for unchanged directories """
+        try:
+            listing = self.list_directory(top)
+        except OSError:
+            return
+
+        yield top, list(listing.subdirs), list(listing.files)
+
+        for name, is_symlink in listing.subdirs.items():
+            if followlinks or not is_symlink:
+                yield from self.walk(os.path.join(top, name), followlinks)
+
+    def _scan(self, path: str, mtime_ns: int, previous_subdirs: dict) -> DirectoryListing:
+        scanned_ns = time.time_ns()
+        subdirs = {}
+        files = {}
+
+        with os.scandir(path) as it:
+            for entry in it:
+                try:
+                    if entry.is_dir():
+                        subdirs[entry.name] = entry.is_symlink()
+                    elif entry.is_file():
+                        stat = entry.stat()
+                        files[entry.name] = (stat.st_size, stat.st_mtime_ns)
+                except OSError:
+                    # entry vanished or is a broken symlink
+                    continue
+
+        self._execute("INSERT OR REPLACE INTO directories (path, mtime_ns, scanned_ns, listing) VALUES (?, ?, ?, ?)",
+                      (path, mtime_ns, scanned_ns, json.dumps([subdirs, files])))
+
+        # forget about removed subdirectories (and everything below them)
+        for name in previous_subdirs.keys() - subdirs.keys():
+            removed = os.path.join(path, name)
+            self._execute("DELETE FROM directories WHERE path = ? OR path LIKE ? ESCAPE '\\'",
+                          (removed, self._escape_like(removed + os.sep) + "%"))
+
+        return DirectoryListing(subdirs, files)
+
+    @staticmethod
+    def _escape_like(value: str) -> str:
+        return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+class ProcessingJournal(SqliteStore):
+    """
+        Outcomes of processing files by tools. Each entry describes state of file (fingerprint) after processing,
+        so file which was not modified since then does not need to be processed again with the same parameters.
+    """
+
+    def __init__(self, directory: str = None):
+        super().__init__("journal", """
+            CREATE TABLE IF NOT EXISTS journal (
+                path TEXT NOT NULL,
+                tool TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                parameters TEXT NOT NULL,
+                outcome TEXT NOT NULL,
+                PRIMARY KEY (path, tool)
+            );
+        """, directory)
+
+    def get(self, fingerprint: FileFingerprint, tool: str, parameters: str) -> str or None:
+        rows = self._execute("SELECT outcome FROM journal WHERE path = ? AND tool = ? AND size = ? AND mtime_ns = ? AND parameters = ?",
+                             (fingerprint.path, tool, fingerprint.size, fingerprint.mtime_ns, parameters))
+        return rows[0][0] if rows else None
+
+    def record(self, fingerprint: FileFingerprint, tool: str, parameters: str, outcome: str):
+        self._execute("INSERT OR REPLACE INTO journal (path, tool, size, mtime_ns, parameters, outcome) VALUES (?, ?, ?, ?, ?, ?)",
+                      (fingerprint.path, tool, fingerprint.size, fingerprint.mtime_ns, parameters, outcome))
@@ -4,8 +4,6 @@ import logging
 import os
 import re
 from collections import defaultdict
-from tqdm import tqdm
-from tqdm.contrib.logging import logging_redirect_tqdm
 
 from . import utils
 
@@ -91,8 +89,8 @@ class Concatenate(utils.InterruptibleProcess):
             logging.info(f"\t->{common_name}")
 
         logging.info("Starting concatenation")
-        with logging_redirect_tqdm():
-            for output, details in tqdm(sorted_videos.items(), desc="Concatenating", unit="movie", **utils.get_tqdm_defaults()):
+        with utils.logging_redirect_tqdm():
+            for output, details in utils.tqdm(sorted_videos.items(), desc="Concatenating", unit="movie", **utils.get_tqdm_defaults()):
                 self._check_for_stop()
 
                 input_files = [video for video, _ in details]
@@ -0,0 +1,343 @@
+
+import os
+import struct
+from fractions import Fraction
+
+
+# Element IDs (see https://www.matroska.org/technical/elements.html)
+EBML = 0x1A45DFA3
+DOC_TYPE = 0x4282
+SEGMENT = 0x18538067
+SEEK_HEAD = 0x114D9B74
+SEEK = 0x4DBB
+SEEK_ID = 0x53AB
+SEEK_POSITION = 0x53AC
+INFO = 0x1549A966
+TIMESTAMP_SCALE = 0x2AD7B1
+DURATION = 0x4489
+TRACKS = 0x1654AE6B
+TRACK_ENTRY = 0xAE
+TRACK_NUMBER = 0xD7
+TRACK_UID = 0x73C5
+TRACK_TYPE = 0x83
+FLAG_DEFAULT = 0x88
+LANGUAGE = 0x22B59C
+CODEC_ID = 0x86
+DEFAULT_DURATION = 0x23E383
+VIDEO = 0xE0
+PIXEL_WIDTH = 0xB0
+PIXEL_HEIGHT = 0xBA
+FLAG_INTERLACED = 0x9A
+TAGS = 0x1254C367
+TAG = 0x7373
+TARGETS = 0x63C0
+TAG_TRACK_UID = 0x63C5
+SIMPLE_TAG = 0x67C8
+TAG_NAME = 0x45A3
+TAG_LANGUAGE = 0x447A
+TAG_DEFAULT = 0x4484
+TAG_STRING = 0x4487
+CLUSTER = 0x1F43B675
+
+track_types = {1: "video", 2: "audio", 17: "subtitle"}
+
+# Matroska codec ID -> ffprobe's codec name
+codec_names = {
+    "V_MPEG4/ISO/AVC": "h264",
+    "V_MPEGH/ISO/HEVC": "hevc",
+    "V_AV1": "av1",
+    "V_VP8": "vp8",
+    "V_VP9": "vp9",
+    "V_MPEG1": "mpeg1video",
+    "V_MPEG2": "mpeg2video",
+    "V_MPEG4/ISO/ASP": "mpeg4",
+    "V_MPEG4/ISO/SP": "mpeg4",
+    "V_MPEG4/ISO/AP": "mpeg4",
+    "V_THEORA": "theora",
+    "A_AAC": "aac",
+    "A_AC3": "ac3",
+    "A_EAC3": "eac3",
+    "A_DTS": "dts",
+    "A_FLAC": "flac",
+    "A_MPEG/L2": "mp2",
+    "A_MPEG/L3": "mp3",
+    "A_OPUS": "opus",
+    "A_TRUEHD": "truehd",
+    "A_VORBIS": "vorbis",
+    "S_TEXT/UTF8": "subrip",
+    "S_TEXT/SSA": "ass",
+    "S_TEXT/ASS": "ass",
+    "S_TEXT/WEBVTT": "webvtt",
+    "S_VOBSUB": "dvd_subtitle",
+    "S_HDMV/PGS": "hdmv_pgs_subtitle",
+    "S_DVBSUB": "dvb_subtitle",
+}
+
+max_element_size = 16 * 1024 * 1024             # Info, Tracks and Tags are small, anything bigger means broken file
+
+
+def _read_vint(data: bytes, pos: int, keep_marker: bool) -> (int, int):
+    """ Read EBML variable size integer. Returns (value, position after it). Unknown size is returned as -1 """
+    if pos >= len(data):
+        raise ValueError("Unexpected end of data")
+
+    first = data[pos]
+    length = 8 - first.bit_length() + 1
+    if length > 8 or pos + length > len(data):
+        raise ValueError("Invalid variable size integer")
+
+    value = int.from_bytes(data[pos:pos + length], "big")
+
+    if not keep_marker:
+        value &= (1 << (7 * length)) - 1
+        if value == (1 << (7 * length)) - 1:
+            value = -1
+
+    return value, pos + length
+
+
+def _elements(data: bytes):
+    """ Yields (id, payload) of all elements in data """
+    pos = 0
+    while pos < len(data):
+        element_id, pos = _read_vint(data, pos, keep_marker = True)
+        size, pos = _read_vint(data, pos, keep_marker = False)
+        if size < 0 or pos + size > len(data):
+            raise ValueError("Element exceeds its parent")
+
+        yield element_id, data[pos:pos + size]
+        pos += size
+
+
+def _uint(payload: bytes) -> int:
+    return int.from_bytes(payload, "big")
+
+
+def _float(payload: bytes) -> float:
+    if len(payload) == 4:
+        return struct.unpack(">f", payload)[0]
+    elif len(payload) == 8:
+        return struct.unpack(">d", payload)[0]
+    elif len(payload) == 0:
+        return 0.0
+
+    raise ValueError("Invalid float size")
+
+
+def _string(payload: bytes) -> str:
+    return payload.rstrip(b"\0").decode("utf-8")
+
+
+def _read_element_header(file, position: int) -> (int, int, int):
+    """ Returns (id, size, payload position) of element at given file position """
+    file.seek(position)
+    header = file.read(12)
+    element_id, pos = _read_vint(header, 0, keep_marker = True)
+    size, pos = _read_vint(header, pos, keep_marker = False)
+
+    return element_id, size, position + pos
+
+
+def _read_payload(file, position: int, size: int) -> bytes:
+    if size < 0 or size > max_element_size:
+        raise ValueError("Unsupported element size")
+
+    file.seek(position)
+    payload = file.read(size)
+    if len(payload) != size:
+        raise ValueError("Unexpected end of file")
+
+    return payload
+
+
+def _find_top_level_elements(file, file_size: int) -> dict:
+    """
+        Read Info, Tracks and Tags elements. Returns {id: payload}.
+        Level 1 elements are scanned until first Cluster, then SeekHeads are used for missing ones
+        (SeekHead may point to further SeekHeads, usually placed at the end of file).
+        Raises ValueError when element listed in SeekHead cannot be read.
+    """
+    element_id, size, pos = _read_element_header(file, 0)
+    if element_id != EBML:
+        raise ValueError("Not an EBML file")
+
+    header = dict(_elements(_read_payload(file, pos, size)))
+    if _string(header.get(DOC_TYPE, b"")) not in ["matroska", "webm"]:
+        raise ValueError("Not a Matroska file")
+
+    element_id, size, segment_start = _read_element_header(file, pos + size)
+    if element_id != SEGMENT:
+        raise ValueError("Segment not found")
+
+    segment_end = file_size if size < 0 else min(file_size, segment_start + size)
+    wanted = {INFO, TRACKS, TAGS}
+    payloads = {}
+    seek_positions = {}
+    seek_heads = []                         # positions of SeekHeads to be read
+
+    pos = segment_start
+    while pos < segment_end and wanted - payloads.keys():
+        element_id, size, payload_pos = _read_element_header(file, pos)
+
+        if element_id == CLUSTER or size < 0:
+            break
+        elif element_id in wanted:
+            payloads[element_id] = _read_payload(file, payload_pos, size)
+        elif element_id == SEEK_HEAD:
+            seek_heads.append(pos)
+
+        pos = payload_pos + size
+
+    visited_seek_heads = set()
+    while seek_heads and wanted - payloads.keys() - seek_positions.keys():
+        position = seek_heads.pop(0)
+        if position in visited_seek_heads or position >= segment_end:
+            continue
+
+        visited_seek_heads.add(position)
+        found_id, size, payload_pos = _read_element_header(file, position)
+        if found_id != SEEK_HEAD:
+            raise ValueError("SeekHead entry does not point to SeekHead")
+
+        for seek_id, seek in _elements(_read_payload(file, payload_pos, size)):
+            if seek_id == SEEK:
+                entry = dict(_elements(seek))
+                target_id, _ = _read_vint(entry.get(SEEK_ID, b""), 0, keep_marker = True)
+                target_position = segment_start + _uint(entry.get(SEEK_POSITION, b""))
+
+                if target_id == SEEK_HEAD:
+                    seek_heads.append(target_position)
+                else:
+                    seek_positions.setdefault(target_id, target_position)
+
+    for element_id in wanted - payloads.keys():
+        position = seek_positions.get(element_id, None)
+        if position is None:
+            continue
+
+        found_id, size, payload_pos = _read_element_header(file, position) if position < segment_end else (None, 0, 0)
+        if found_id != element_id:
+            raise ValueError(f"Element {element_id:X} listed in SeekHead not found")
+
+        payloads[element_id] = _read_payload(file, payload_pos, size)
+
+    return payloads
+
+
+def _frame_rate(track: dict) -> Fraction:
+    """
+        Frame rate of video track derived from its DefaultDuration.
+        Raises ValueError when it cannot be trusted to match rate ffprobe would report
+        (unknown, interlaced content which may use field duration, or not a regular rate).
+    """
+    default_duration = _uint(track.get(DEFAULT_DURATION, b""))
+    if default_duration == 0:
+        raise ValueError("Frame rate of video track is unknown")
+
+    video = dict(_elements(track.get(VIDEO, b"")))
+    if _uint(video.get(FLAG_INTERLACED, b"")) == 1:
+        raise ValueError("Frame rate of interlaced video track is ambiguous")
+
+    # DefaultDuration is rounded to nanoseconds, regular rates (like 24000/1001) fit within that rounding
+    fps = Fraction(1000000000, default_duration).limit_denominator(1001)
+    if abs(1000000000 / fps - default_duration) > 1:
+        raise ValueError(f"Irregular frame duration of video track: {default_duration}ns")
+
+    return fps
+
+
+def _track_tags(tags_payload: bytes) -> dict:
+    """ Returns {track uid: {tag name: value}} """
+    result = {}
+
+    for tag_id, tag in _elements(tags_payload):
+        if tag_id != TAG:
+            continue
+
+        track_uids = []
+        values = {}
+        for element_id, payload in _elements(tag):
+            if element_id == TARGETS:
+                track_uids.extend(_uint(uid) for uid_id, uid in _elements(payload) if uid_id == TAG_TRACK_UID)
+            elif element_id == SIMPLE_TAG:
+                simple_tag = dict(_elements(payload))
+                if TAG_NAME in simple_tag and TAG_STRING in simple_tag:
+                    # same naming as ffmpeg uses: NAME for default/undefined language tags, NAME-lang for others
+                    name = _string(simple_tag[TAG_NAME])
+                    value = _string(simple_tag[TAG_STRING])
+                    language = _string(simple_tag.get(TAG_LANGUAGE, b"und"))
+                    is_default = _uint(simple_tag[TAG_DEFAULT]) if TAG_DEFAULT in simple_tag else 1
+
+                    if language not in ["", "und"]:
+                        values[f"{name}-{language}"] = value
+                    if is_default or language in ["", "und"]:
+                        values[name] = value
+
+        for uid in track_uids:
+            result.setdefault(uid, {}).update(values)
+
+    return result
+
+
+def read_info(path: str) -> dict:
+    """
+        Read Matroska headers and return information in the same shape ffprobe's
+        '-show_format -show_streams' json has (only fields used by twotone are filled).
+        Raises ValueError for files which are not Matroska, contain elements which cannot be described
+        or details of which might differ from ffprobe's ones (ffprobe should be used for them).
+    """
+    with open(path, "rb") as file:
+        payloads = _find_top_level_elements(file, os.fstat(file.fileno()).st_size)
+
+    if INFO not in payloads or TRACKS not in payloads:
+        raise ValueError("Segment information or tracks not found")
+
+    info = dict(_elements(payloads[INFO]))
+    timestamp_scale = _uint(info[TIMESTAMP_SCALE]) if TIMESTAMP_SCALE in info else 1000000
+
+    result_format = {}
+    if DURATION in info:
+        result_format["duration"] = f"{_float(info[DURATION]) * timestamp_scale / 1e9:.6f}"
+
+    tags = _track_tags(payloads[TAGS]) if TAGS in payloads else {}
+
+    streams = []
+    for element_id, payload in _elements(payloads[TRACKS]):
+        if element_id != TRACK_ENTRY:
+            continue
+
+        track = dict(_elements(payload))
+        codec_type = track_types.get(_uint(track.get(TRACK_TYPE, b"")), None)
+        codec_id = _string(track.get(CODEC_ID, b""))
+        codec_name = codec_names.get(codec_id, None)
+
+        if codec_type in ["video", "subtitle"] and codec_name is None:
+            raise ValueError(f"Unknown codec: {codec_id}")
+
+        stream = {
+            "index": len(streams),
+            "codec_type": codec_type if codec_type is not None else "data",
+            "codec_name": codec_name if codec_name is not None else codec_id.lower(),
+            "disposition": {"default": _uint(track[FLAG_DEFAULT]) if FLAG_DEFAULT in track else 1},
+        }
+
+        stream_tags = dict(tags.get(_uint(track.get(TRACK_UID, b"")), {}))
+        language = _string(track[LANGUAGE]) if LANGUAGE in track else "eng"
+        if language != "und":
+            stream_tags["language"] = language
+
+        if stream_tags:
+            stream["tags"] = stream_tags
+
+        if codec_type == "video":
+            fps = _frame_rate(track)
+            stream["r_frame_rate"] = stream["avg_frame_rate"] = f"{fps.numerator}/{fps.denominator}"
+
+            video = dict(_elements(track.get(VIDEO, b"")))
+            if PIXEL_WIDTH in video and PIXEL_HEIGHT in video:
+                stream["width"] = _uint(video[PIXEL_WIDTH])
+                stream["height"] = _uint(video[PIXEL_HEIGHT])
+
+        streams.append(stream)
+
+    return {"format": result_format, "streams": streams}
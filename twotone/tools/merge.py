@@ -1,36 +1,66 @@
 
 import argparse
 import glob
-import langid
+import hashlib
 import logging
 import os
+import re
 import shutil
+import sqlite3
 import sys
 import tempfile
-from tqdm import tqdm
-from tqdm.contrib.logging import logging_redirect_tqdm
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 from typing import Dict, List, Tuple
 
-from . import utils
+from . import cache, subtitle_formats, utils
 
 
 work = True
 
+language_sample_size = 16 * 1024                # how many bytes of subtitles are used for language detection
+
+# timestamps, cue numbers and markup which would only confuse language detection
+language_sample_noise = re.compile(
+    r"<[^>]*>"                                  # html like tags
+    r"|\{[^}]*\}"                               # MicroDVD frames and control codes, ASS overrides
+    r"|^[0-9]+\s*$"                             # SubRip cue numbers
+    r"|^[0-9:,.]+\s*-->\s*[0-9:,.]+.*$"          # SubRip timings
+    r"|^[0-9]{1,2}:[0-9]{2}:[0-9]{2}[:=]",      # TMPlayer timestamps
+    re.MULTILINE)
+
+_language_identifier = None
+_language_identifier_lock = threading.Lock()
+
+
+def _get_language_identifier():
+    """ Language detection model is big, load it on first use only (once, shared by all threads) """
+    global _language_identifier
+
+    with _language_identifier_lock:
+        if _language_identifier is None:
+            from langid.langid import LanguageIdentifier, model
+            _language_identifier = LanguageIdentifier.from_modelstring(model)
+
+    return _language_identifier
+
 
 class Merge(utils.InterruptibleProcess):
 
-    def __init__(self, dry_run: bool, language: str, lang_priority: str):
+    def __init__(self, dry_run: bool, language: str, lang_priority: str, jobs: int = 1, use_language_cache: bool = True):
         super().__init__()
         self.dry_run = dry_run
         self.language = language
         self.lang_priority = [] if not lang_priority or lang_priority == "" else lang_priority.split(",")
+        self.jobs = jobs
+        self._language_cache = None
+        self._use_language_cache = use_language_cache
 
-    def _build_subtitle_from_path(self, path: str) -> utils.SubtitleFile:
-        encoding = utils.file_encoding(path)
-        language = self.language if self.language != "auto" else self._guess_language(path, encoding)
+    def _build_subtitle(self, info: utils.SubtitleFileInfo) -> utils.SubtitleFile:
+        language = self.language if self.language != "auto" else self._guess_language(info.path, info.encoding)
 
-        return utils.SubtitleFile(path, language, encoding)
+        return utils.SubtitleFile(info.path, language, info.encoding, info.format)
 
     def _directory_subtitle_matcher(self, dir_path: str) -> Dict[str, List[utils.SubtitleFile]]:
         """
@@ -38,17 +68,17 @@ class Merge(utils.InterruptibleProcess):
         """
         videos = []
         subtitles = []
+        subtitles_info = {}
 
         matches = {}
 
-        with os.scandir(dir_path) as it:
-            for entry in it:
-                if entry.is_file():
-                    path = entry.path
-                    if utils.is_video(path):
-                        videos.append(path)
-                    elif utils.is_subtitle(path):
-                        subtitles.append(path)
+        _, files = utils.list_directory(dir_path)
+        for path in files:
+            if utils.is_video(path):
+                videos.append(path)
+            elif (subtitle_info := utils.sniff_subtitle(path)) is not None:
+                subtitles.append(path)
+                subtitles_info[path] = subtitle_info
 
         # sort both lists by lenght
         videos = sorted(videos, reverse = True, key = lambda k: len(k))
@@ -70,7 +100,7 @@ class Merge(utils.InterruptibleProcess):
                 subtitles.remove(subtitle)
 
             if matching_subtitles:
-                matches[video] = [self._build_subtitle_from_path(subtitle) for subtitle in matching_subtitles]
+                matches[video] = [self._build_subtitle(subtitles_info[subtitle]) for subtitle in matching_subtitles]
 
         if len(subtitles) > 0:
             subtitles_str = '\n'.join(subtitles)
@@ -81,22 +111,18 @@ class Merge(utils.InterruptibleProcess):
 
     def _recursive_subtitle_search(self, path: str) -> [utils.SubtitleFile]:
         found_subtitles = []
-        found_subdirs = []
-
-        with os.scandir(path) as it:
-            for entry in it:
-                if entry.is_dir():
-                    found_subdirs.append(entry.path)
-                elif entry.is_file():
-                    if utils.is_video(entry.path):
-                        # if there is a video file then all possible subtitles at this level (and below) belong to
-                        # it, quit recursion for current directory
-                        return []
-                    elif utils.is_subtitle(entry.path):
-                        found_subtitles.append(entry.path)
+        found_subdirs, files = utils.list_directory(path)
+
+        for file in files:
+            if utils.is_video(file):
+                # if there is a video file then all possible subtitles at this level (and below) belong to
+                # it, quit recursion for current directory
+                return []
+            elif (subtitle_info := utils.sniff_subtitle(file)) is not None:
+                found_subtitles.append(subtitle_info)
 
         # if we got here, then no video was found at this level
-        subtitles = [self._build_subtitle_from_path(subtitle) for subtitle in found_subtitles]
+        subtitles = [self._build_subtitle(subtitle) for subtitle in found_subtitles]
 
         for subdir in found_subdirs:
             sub_subtitles = self._recursive_subtitle_search(subdir)
@@ -111,12 +137,15 @@ class Merge(utils.InterruptibleProcess):
         subtitles = []
         directory = Path(path).parent
 
-        for entry in os.scandir(directory):
-            if entry.is_dir():
-                sub_subtitles = self._recursive_subtitle_search(entry.path)
-                subtitles.extend(sub_subtitles)
-            elif entry.is_file() and utils.is_subtitle(entry.path):
-                subtitle = self._build_subtitle_from_path(entry.path)
+        subdirs, files = utils.list_directory(str(directory))
+
+        for subdir in subdirs:
+            sub_subtitles = self._recursive_subtitle_search(subdir)
+            subtitles.extend(sub_subtitles)
+
+        for file in files:
+            if (subtitle_info := utils.sniff_subtitle(file)) is not None:
+                subtitle = self._build_subtitle(subtitle_info)
                 subtitles.append(subtitle)
 
         return subtitles
@@ -143,42 +172,73 @@ class Merge(utils.InterruptibleProcess):
             output_file = utils.get_unique_file_name(temporary_dir, "srt")
             encoding = subtitle.encoding if subtitle.encoding != "UTF-8-SIG" else "utf-8"
 
-            status = utils.start_process("ffmpeg",
-                                         ["-hide_banner", "-y", "-sub_charenc", encoding, "-i", input_file, output_file])
+            # Subtitles are converted to SubRip natively, with real video's fps used for frame based formats.
+            # ffmpeg is used only for files native converter cannot handle.
+            try:
+                subtitle_formats.convert_to_subrip(input_file, encoding, subtitle.format, output_file, utils.fps_str_to_float(video_fps))
+            except (ValueError, LookupError) as e:
+                logging.debug(f"Native conversion of {input_file} failed ({e}), using ffmpeg")
+                self._convert_subtitle_with_ffmpeg(video_fps, subtitle, encoding, output_file, temporary_dir)
 
-            if status.returncode == 0:
-                # there is no way (as of now) to tell ffmpeg to convert subtitles with proper frame rate in mind.
-                # so here some naive conversion is being done
-                # see: https://trac.ffmpeg.org/ticket/10929
-                #      https://trac.ffmpeg.org/ticket/3287
-                if utils.is_subtitle_microdvd(subtitle):
-                    fps = eval(video_fps)
+            converted_subtitle = utils.SubtitleFile(output_file, subtitle.language, "utf-8", "subrip")
 
-                    # prepare new output file, and use previous one as new input
-                    input_file = output_file
-                    output_file = utils.get_unique_file_name(temporary_dir, "srt")
+        return converted_subtitle
 
-                    utils.fix_subtitles_fps(input_file, output_file, fps)
+    def _convert_subtitle_with_ffmpeg(self, video_fps: str, subtitle: utils.SubtitleFile, encoding: str, output_file: str, temporary_dir: str):
+        status = utils.start_process("ffmpeg",
+                                     ["-hide_banner", "-y", "-sub_charenc", encoding, "-i", subtitle.path, output_file])
 
-            else:
-                raise RuntimeError(f"ffmpeg exited with unexpected error:\n{status.stderr}")
+        if status.returncode != 0:
+            raise RuntimeError(f"ffmpeg exited with unexpected error:\n{status.stderr}")
 
-            converted_subtitle = utils.SubtitleFile(output_file, subtitle.language, "utf-8")
+        # there is no way (as of now) to tell ffmpeg to convert subtitles with proper frame rate in mind.
+        # so here some naive conversion is being done
+        # see: https://trac.ffmpeg.org/ticket/10929
+        #      https://trac.ffmpeg.org/ticket/3287
+        if utils.is_subtitle_microdvd(subtitle):
+            fps = utils.fps_str_to_float(video_fps)
 
-        return converted_subtitle
+            # ffmpeg's output becomes input of fps fixing
+            ffmpeg_output = utils.get_unique_file_name(temporary_dir, "srt")
+            os.replace(output_file, ffmpeg_output)
+
+            utils.fix_subtitles_fps(ffmpeg_output, output_file, fps)
+
+    def _get_language_cache(self) -> cache.LanguageCache or None:
+        if self._use_language_cache and self._language_cache is None:
+            try:
+                self._language_cache = cache.LanguageCache()
+            except (OSError, sqlite3.Error) as e:
+                logging.warning(f"Could not open languages cache, continuing without it: {e}")
+                self._use_language_cache = False
+
+        return self._language_cache
 
     @staticmethod
-    def _guess_language(path: str, encoding: str) -> str:
-        result = ""
+    def _language_sample(data: bytes, encoding: str) -> str:
+        text = data.decode(encoding, errors = "ignore")
+        text = language_sample_noise.sub(" ", text).replace("|", " ")
+
+        return " ".join(text.split())
+
+    def _guess_language(self, path: str, encoding: str) -> str:
+        with open(path, "rb") as sf:
+            data = sf.read(language_sample_size)
 
-        with open(path, "r", encoding=encoding) as sf:
-            content = sf.readlines()
-            content_joined = "".join(content)
-            result = langid.classify(content_joined)[0]
+        # the same bytes decoded with other encoding are other text
+        sample_hash = hashlib.sha256(f"{encoding}\0".encode("utf-8") + data).hexdigest()
+        language_cache = self._get_language_cache()
+
+        result = None if language_cache is None else language_cache.get(sample_hash)
+        if result is None:
+            result = _get_language_identifier().classify(self._language_sample(data, encoding))[0]
+
+            if language_cache is not None:
+                language_cache.put(sample_hash, result)
 
         return result
 
-    def _merge(self, input_video: str, subtitles: [utils.SubtitleFile]):
+    def _merge(self, input_video: str, subtitles: [utils.SubtitleFile], probe: utils.ProbeContext = None):
         logging.info(f"Merging video file: {input_video} with subtitles:")
 
         video_dir, video_name, video_extension = utils.split_path(input_video)
@@ -186,7 +246,8 @@ class Merge(utils.InterruptibleProcess):
         temporary_output_video = video_dir + "/_tt_merge_" + video_name + "." + "mkv"
 
         # collect details about input file
-        input_file_details = utils.get_video_data(input_video)
+        probe = utils.ProbeContext() if probe is None else probe
+        input_file_details = probe.video_data(input_video)
 
         input_files = []
 
@@ -213,15 +274,17 @@ class Merge(utils.InterruptibleProcess):
             # perform
             logging.debug("\tMerge in progress...")
             if not self.dry_run:
-                utils.generate_mkv(input_video=input_video, output_path=temporary_output_video, subtitles=prepared_subtitles)
-
-                # Remove all inputs
-                for input in input_files:
-                    os.remove(input)
+                utils.generate_mkv(input_video=input_video, output_path=temporary_output_video, subtitles=prepared_subtitles, probe=probe)
+                probe.forget(temporary_output_video)
 
                 # rename final file to a proper one
                 shutil.move(temporary_output_video, output_video)
 
+                # Remove all inputs (input video may have been just replaced by output one if it was mkv already)
+                for input in input_files:
+                    if input != output_video:
+                        os.remove(input)
+
         logging.debug("\tDone")
 
     def _process_single_video(self, video_file: str) -> Tuple[str, List[utils.SubtitleFile]]:
@@ -245,7 +308,7 @@ class Merge(utils.InterruptibleProcess):
         logging.debug(f"Finding videos in {path}")
         videos_and_subtitles = {}
 
-        for cd, _, files in os.walk(path, followlinks = True):
+        for cd, _, files in utils.walk(path, followlinks = True):
             video_files = []
             for file in files:
                 self._check_for_stop()
@@ -285,14 +348,53 @@ class Merge(utils.InterruptibleProcess):
         for video in vas:
             logging.debug(video)
 
-        logging.info("Starting merge")
-        with logging_redirect_tqdm():
-            for video, subtitles in tqdm(vas.items(), desc="Merging", unit="video", leave=False, smoothing=0.1, mininterval=.2, disable=utils.hide_progressbar()):
+        # probe all videos upfront (concurrently), merges will reuse results
+        probe = utils.ProbeContext()
+        with utils.logging_redirect_tqdm():
+            probes = utils.probe_many(list(vas), probe = probe, interruptible = self)
+            for video, video_info in utils.tqdm(probes, total=len(vas), desc="Probing videos", unit="video", **utils.get_tqdm_defaults()):
                 self._check_for_stop()
-                self._merge(video, subtitles)
+                if video_info is None or not video_info.video_tracks:
+                    logging.warning(f"Skipping {video}, it does not look like a valid video")
+                    del vas[video]
+
+        logging.info("Starting merge")
+        with utils.logging_redirect_tqdm(), \
+             utils.tqdm(desc="Merging", unit="video", total=len(vas), **utils.get_tqdm_defaults()) as pbar, \
+             ThreadPoolExecutor(max_workers=self.jobs) as executor:
+
+            def merge(video: str, subtitles: List[utils.SubtitleFile]):
+                # do not start new merges when stop was requested. Running ones will be finished.
+                if self._work:
+                    self._merge(video, subtitles, probe)
+                    probe.forget(video)
+
+            futures = [executor.submit(merge, video, subtitles) for video, subtitles in vas.items()]
+
+            try:
+                for future in as_completed(futures):
+                    future.result()
+                    pbar.update(1)
+            except BaseException:
+                for future in futures:
+                    future.cancel()
+                raise
+
+        self._check_for_stop()
 
 
 def setup_parser(parser: argparse.ArgumentParser):
+    def positive_int(value):
+        try:
+            ivalue = int(value)
+        except ValueError:
+            raise argparse.ArgumentTypeError(f"Invalid integer value: {value}")
+
+        if ivalue < 1:
+            raise argparse.ArgumentTypeError(f"Value must be greater than 0. Got {value}")
+
+        return ivalue
+
     parser.add_argument('videos_path',
                         nargs=1,
                         help='Path with videos to combine.')
@@ -305,6 +407,14 @@ def setup_parser(parser: argparse.ArgumentParser):
                              'found subtitles will be ordered so polish goes as first, then german, english and '
                              'french. If there are subtitles in any other language, they will be append at '
                              'the end in undefined order')
+    parser.add_argument("--jobs", "-j",
+                        type=positive_int,
+                        default=1,
+                        help='Number of videos to be merged concurrently. Default: 1')
+    parser.add_argument("--no-language-cache",
+                        action='store_true',
+                        default=False,
+                        help='Do not reuse nor store languages detected for subtitles (with --language auto).')
 
 
 def run(args):
@@ -318,5 +428,7 @@ def run(args):
     logging.info("Searching for movie and subtitle files to be merged")
     two_tone = Merge(dry_run=not args.no_dry_run,
                        language=args.language,
-                       lang_priority=args.languages_priority)
+                       lang_priority=args.languages_priority,
+                       jobs=args.jobs,
+                       use_language_cache=not args.no_language_cache)
     two_tone.process_dir(args.videos_path[0])
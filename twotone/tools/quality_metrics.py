@@ -0,0 +1,183 @@
+
+import json
+import math
+
+from . import utils
+
+
+def _quote_path(path: str) -> str:
+    """ Quote path so it can be used as filter's option in ffmpeg's filtergraph """
+    return "'" + path.replace("'", "'\\''") + "'"
+
+
+def _frame_values(stats_file: str) -> [dict]:
+    """ Parse 'n:1 key:value key:value...' lines written by ssim and psnr filters """
+    frames = []
+
+    with open(stats_file, "r") as stats:
+        for line in stats:
+            frame = {}
+            for item in line.split():
+                key, separator, value = item.partition(":")
+                if separator:
+                    frame[key] = value
+            if frame:
+                frames.append(frame)
+
+    return frames
+
+
+class QualityMetric:
+    """
+        Video quality metric calculated by ffmpeg's filter comparing reference and distorted videos.
+        Filter writes results into a stats file which is parsed when ffmpeg finishes.
+
+        Higher values mean better quality. value_range is used for deciding outcome of partial measurements,
+        top_quality is the lowest value expected for (nearly) lossless encodes.
+        target_range limits requested targets (values out of it were most likely given in scale of another metric).
+    """
+
+    name = None
+    default_target = None
+    value_range = (0.0, 1.0)
+    target_range = (0.0, 1.0)
+    top_quality = None
+
+    # filter reducing video to luma plane (None when metric does not support or need it)
+    luma_filter = "extractplanes=y"
+
+    # True when metric can skip frames on its own (no select filter is needed then)
+    native_subsample = False
+
+    def __init__(self, threads: int = None):
+        self.threads = threads
+
+    def check_available(self):
+        """ Raise RuntimeError if ffmpeg cannot calculate metric """
+        pass
+
+    def config(self) -> str:
+        """ Description of metric's setup. Results of different setups are not comparable """
+        return self.name
+
+    def ffmpeg_options(self) -> [str]:
+        """ Global ffmpeg options needed by metric """
+        return [] if self.threads is None else ["-filter_complex_threads", str(self.threads)]
+
+    def filter(self, reference: str, distorted: str, stats_file: str, subsample: int = 1) -> str:
+        """
+            Filter comparing videos with given labels and writing results to stats_file.
+            subsample is used by metrics with native_subsample only.
+        """
+        raise NotImplementedError()
+
+    def parse(self, stats_file: str, luma_only: bool = False) -> float or None:
+        """ Overall quality from stats file """
+        raise NotImplementedError()
+
+
+class Ssim(QualityMetric):
+    name = "ssim"
+    default_target = 0.98
+    value_range = (0.0, 1.0)
+    top_quality = 0.9975
+
+    def filter(self, reference: str, distorted: str, stats_file: str, subsample: int = 1) -> str:
+        return f"[{reference}][{distorted}]ssim=stats_file={_quote_path(stats_file)}"
+
+    def parse(self, stats_file: str, luma_only: bool = False) -> float or None:
+        # ffmpeg's overall SSIM is an average of frames' SSIMs
+        key = "Y" if luma_only else "All"
+        values = [float(frame[key]) for frame in _frame_values(stats_file) if key in frame]
+
+        return sum(values) / len(values) if values else None
+
+
+class Psnr(QualityMetric):
+    name = "psnr"
+    default_target = 42.0
+    value_range = (0.0, 100.0)
+    target_range = (10.0, 100.0)
+    top_quality = 45.0
+
+    def filter(self, reference: str, distorted: str, stats_file: str, subsample: int = 1) -> str:
+        return f"[{reference}][{distorted}]psnr=stats_file={_quote_path(stats_file)}"
+
+    def parse(self, stats_file: str, luma_only: bool = False) -> float or None:
+        # average of frames' PSNRs. Identical frames have infinite PSNR, upper bound of range is used for them
+        key = "psnr_y" if luma_only else "psnr_avg"
+        values = [min(float(frame[key]), self.value_range[1]) for frame in _frame_values(stats_file) if key in frame]
+
+        return sum(values) / len(values) if values else None
+
+
+class Vmaf(QualityMetric):
+    name = "vmaf"
+    default_target = 95.0
+    value_range = (0.0, 100.0)
+    target_range = (10.0, 100.0)
+    top_quality = 93.0
+
+    # VMAF works on luma only anyway
+    luma_filter = None
+    native_subsample = True
+
+    models = ["vmaf_v0.6.1", "vmaf_v0.6.1neg", "vmaf_4k_v0.6.1"]
+
+    def __init__(self, threads: int = None, model: str = "vmaf_v0.6.1"):
+        super().__init__(threads)
+
+        if model not in self.models:
+            raise ValueError(f"Unknown VMAF model: {model}")
+
+        self.model = model
+
+    def check_available(self):
+        result = utils.start_process("ffmpeg", ["-hide_banner", "-filters"])
+        if not any(line.split()[1:2] == ["libvmaf"] for line in result.stdout.splitlines()):
+            raise RuntimeError("ffmpeg was built without libvmaf, VMAF cannot be used")
+
+    def config(self) -> str:
+        return f"{self.name}:{self.model}"
+
+    def ffmpeg_options(self) -> [str]:
+        return []
+
+    def filter(self, reference: str, distorted: str, stats_file: str, subsample: int = 1) -> str:
+        options = [
+            f"model=version={self.model}",
+            f"log_path={_quote_path(stats_file)}",
+            "log_fmt=json",
+        ]
+
+        if self.threads is not None:
+            options.append(f"n_threads={self.threads}")
+        if subsample > 1:
+            options.append(f"n_subsample={subsample}")
+
+        # libvmaf takes distorted video as its first input
+        return f"[{distorted}][{reference}]libvmaf=" + ":".join(options)
+
+    def parse(self, stats_file: str, luma_only: bool = False) -> float or None:
+        with open(stats_file, "r") as stats:
+            log = json.load(stats)
+
+        try:
+            return float(log["pooled_metrics"]["vmaf"]["mean"])
+        except KeyError:
+            # libvmaf 1.x log format
+            value = log.get("VMAF score", None)
+            return None if value is None or math.isnan(float(value)) else float(value)
+
+
+metrics = {metric.name: metric for metric in [Ssim, Psnr, Vmaf]}
+
+
+def create(name: str, threads: int = None, vmaf_model: str = "vmaf_v0.6.1") -> QualityMetric:
+    if name not in metrics:
+        raise ValueError(f"Unknown quality metric: {name}")
+
+    if name == Vmaf.name:
+        return Vmaf(threads, vmaf_model)
+
+    return metrics[name](threads)
@@ -0,0 +1,374 @@
+
+import numpy as np
+import re
+from collections import namedtuple
+
+
+Cue = namedtuple("Cue", "start end text")                     # start and end in milliseconds
+
+subrip_timing_pattern = re.compile(r"(\d+):(\d{2}):(\d{2})[,.](\d{1,3})\s*-->\s*(\d+):(\d{2}):(\d{2})[,.](\d{1,3})")
+microdvd_line_pattern = re.compile(r"\{(\d+)\}\{(\d*)\}(.*)")
+microdvd_control_code_pattern = re.compile(r"\{[a-zA-Z]:[^}]*\}")
+tmplayer_line_pattern = re.compile(r"(\d{1,2}):(\d{2}):(\d{2})[:=](.*)")
+subrip_timing_split_pattern = re.compile(rb"([0-9]+:[0-9]{2}:[0-9]{2},[0-9]{3} --> [0-9]+:[0-9]{2}:[0-9]{2},[0-9]{3})")
+
+last_cue_duration = 5000                                      # for formats without end times, duration of the last cue
+
+
+def _lines(content: str) -> [str]:
+    return content.replace("\r\n", "\n").replace("\r", "\n").split("\n")
+
+
+def _ms(h: str, m: str, s: str, ms: str = "0") -> int:
+    return (int(h) * 3600 + int(m) * 60 + int(s)) * 1000 + int(ms.ljust(3, "0"))
+
+
+def parse_subrip(content: str) -> [Cue]:
+    cues = []
+    timing = None
+    text = []
+
+    def flush():
+        if timing is not None:
+            cues.append(Cue(timing[0], timing[1], "\n".join(text).strip()))
+
+    for line in _lines(content):
+        match = subrip_timing_pattern.search(line)
+        if match:
+            # cue number (if any) was collected as text of previous cue
+            if text and text[-1].strip().isdigit():
+                text.pop()
+
+            flush()
+            groups = match.groups()
+            timing = (_ms(*groups[:4]), _ms(*groups[4:]))
+            text = []
+        elif timing is not None:
+            text.append(line)
+
+    flush()
+
+    if not cues:
+        raise ValueError("No SubRip cues found")
+
+    return cues
+
+
+def parse_microdvd(content: str, fps: float) -> [Cue]:
+    """
+        Parse MicroDVD subtitles. Frame numbers are converted to time with given fps
+        unless file defines its own fps in the first line ({1}{1}23.976).
+    """
+    entries = []
+
+    for line in _lines(content):
+        match = microdvd_line_pattern.match(line.strip())
+        if match:
+            start, end, text = match.groups()
+            entries.append((int(start), int(end) if end else None, text))
+
+    if not entries:
+        raise ValueError("No MicroDVD cues found")
+
+    first_start, first_end, first_text = entries[0]
+    if first_start in [0, 1] and first_end in [0, 1]:
+        try:
+            fps = float(first_text.strip())
+            entries = entries[1:]
+        except ValueError:
+            pass
+
+    if fps <= 0:
+        raise ValueError(f"Invalid fps: {fps}")
+
+    def to_ms(frame: int) -> int:
+        return round(frame * 1000 / fps)
+
+    cues = []
+    for i, (start, end, text) in enumerate(entries):
+        text = microdvd_control_code_pattern.sub("", text).replace("|", "\n").strip()
+
+        if end is not None:
+            end_ms = to_ms(end)
+        elif i + 1 < len(entries):
+            end_ms = to_ms(entries[i + 1][0])
+        else:
+            end_ms = to_ms(start) + last_cue_duration
+
+        cues.append(Cue(to_ms(start), end_ms, text))
+
+    return cues
+
+
+def parse_tmplayer(content: str) -> [Cue]:
+    """ Parse 'H:MM:SS:text' subtitles. Each cue lasts until next one starts """
+    entries = []
+
+    for line in _lines(content):
+        match = tmplayer_line_pattern.match(line.strip())
+        if match:
+            h, m, s, text = match.groups()
+            entries.append((_ms(h, m, s), text.replace("|", "\n").strip()))
+
+    if not entries:
+        raise ValueError("No TMPlayer cues found")
+
+    cues = []
+    for i, (start, text) in enumerate(entries):
+        end = entries[i + 1][0] if i + 1 < len(entries) else start + last_cue_duration
+        cues.append(Cue(start, end, text))
+
+    return cues
+
+
+def _format_time(ms: int) -> str:
+    h, remainder = divmod(max(0, ms), 3600 * 1000)
+    m, remainder = divmod(remainder, 60 * 1000)
+    s, ms = divmod(remainder, 1000)
+
+    return f"{h:02}:{m:02}:{s:02},{ms:03}"
+
+
+def convert_to_subrip(input_path: str, encoding: str, format: str, output_path: str, fps: float):
+    """
+        Convert subtitles in given format (as detected by utils.sniff_subtitle) to SubRip.
+        fps is used for frame based formats (MicroDVD).
+        Raises ValueError when file cannot be parsed.
+    """
+    with open(input_path, "r", encoding = encoding) as input_file:
+        content = input_file.read()
+
+    # byte order mark
+    content = content.lstrip("\ufeff")
+
+    if format == "subrip":
+        cues = parse_subrip(content)
+    elif format == "microdvd":
+        cues = parse_microdvd(content, fps)
+    elif format == "tmplayer":
+        cues = parse_tmplayer(content)
+    else:
+        raise ValueError(f"Unsupported subtitles format: {format}")
+
+    SubtitleDocument.from_cues(cues).save(output_path)
+
+
+# 'HH:MM:SS,mmm --> HH:MM:SS,mmm' layout. Timings with longer hours are handled by slower, generic code
+_timing_length = 29
+_timing_end_offset = 17
+_timing_template = np.frombuffer(b"00:00:00,000 --> 00:00:00,000", dtype = np.uint8)
+_timing_digit_columns = {3600 * 1000: [0, 1], 60 * 1000: [3, 4], 1000: [6, 7], 1: [9, 10, 11]}
+
+
+def _decode_timing_digits(digits) -> np.ndarray:
+    result = np.zeros(len(digits), dtype = np.int64)
+    for unit, columns in _timing_digit_columns.items():
+        value = np.zeros(len(digits), dtype = np.int64)
+        for column in columns:
+            value = value * 10 + digits[:, column]
+        result += value * unit
+
+    return result
+
+
+def _encode_timing_digits(times, output, offset: int):
+    for unit, columns in _timing_digit_columns.items():
+        value = times // unit
+        times = times - value * unit
+        for column in reversed(columns):
+            value, digit = np.divmod(value, 10)
+            output[:, offset + column] += digit.astype(np.uint8)
+
+
+def _parse_timings(timings: [bytes]) -> np.ndarray:
+    """ Parse 'start --> end' SubRip timings into int64 array of shape (len(timings), 2) """
+    lengths = np.fromiter(map(len, timings), dtype = np.int64, count = len(timings))
+
+    if np.all(lengths == _timing_length):
+        # fixed width timings only ('hh:mm:ss,mmm --> hh:mm:ss,mmm'), hour separators must be in place on both sides
+        raw = np.frombuffer(b"".join(timings), dtype = np.uint8).reshape(-1, _timing_length)
+        fixed_width = np.all(raw[:, [2, _timing_end_offset + 2]] == ord(":"))
+    else:
+        fixed_width = False
+
+    if fixed_width:
+        digits = raw.astype(np.int64) - ord("0")
+        return np.stack([_decode_timing_digits(digits[:, offset:]) for offset in [0, _timing_end_offset]], axis = 1)
+    else:
+        numbers = np.array(re.findall(rb"[0-9]+", b" ".join(timings)), dtype = np.int64).reshape(-1, 2, 4)
+        return (numbers * np.array(list(_timing_digit_columns), dtype = np.int64)).sum(axis = 2)
+
+
+def _format_timings(times: np.ndarray) -> [bytes]:
+    times = np.maximum(times, 0)
+
+    if len(times) == 0:
+        return []
+    elif times.max() < 100 * 3600 * 1000:
+        output = np.tile(_timing_template, (len(times), 1))
+        _encode_timing_digits(times[:, 0], output, 0)
+        _encode_timing_digits(times[:, 1], output, _timing_end_offset)
+
+        joined = output.tobytes()
+        return [joined[i:i + _timing_length] for i in range(0, len(joined), _timing_length)]
+    else:
+        return [f"{_format_time(start)} --> {_format_time(end)}".encode("ascii") for start, end in times.tolist()]
+
+
+class SubtitleDocument:
+    """
+        Parsed SubRip document.
+
+        Content is kept in a single utf-8 buffer. Cues are described by parallel arrays:
+        'times' (int64, shape: cues × 2, milliseconds) and spans (offsets in buffer) of their timings and texts.
+        Times can be modified one by one or transformed in bulk (scale, shift, affine, piecewise maps).
+        Saving to the file document was loaded from rewrites only changed timings when their length did not change.
+    """
+
+    __slots__ = ("path", "times", "_buffer", "_timing_spans", "_text_spans", "_saved_times")
+
+    def __init__(self, data: bytes, path: str = None):
+        pieces = subrip_timing_split_pattern.split(data)
+        lengths = np.fromiter(map(len, pieces), dtype = np.int64, count = len(pieces))
+        ends = np.cumsum(lengths)
+        starts = ends - lengths
+
+        self.path = path
+        self._buffer = bytearray(data)
+        self._timing_spans = np.stack([starts[1::2], ends[1::2]], axis = 1)
+        self._text_spans = np.stack([starts[2::2], ends[2::2]], axis = 1)
+        self.times = _parse_timings(pieces[1::2])
+        self._saved_times = self.times.copy()
+
+    @classmethod
+    def load(cls, path: str):
+        with open(path, "rb") as file:
+            return cls(file.read(), path)
+
+    @classmethod
+    def from_text(cls, content: str):
+        return cls(content.encode("utf-8"))
+
+    @classmethod
+    def from_cues(cls, cues: [Cue]):
+        """ Build document from cues. Cues without text are skipped. Raises ValueError when no cue is left """
+        cues = [cue for cue in cues if cue.text]
+        if not cues:
+            raise ValueError("No cues with text found")
+
+        timings = _format_timings(np.array([[cue.start, cue.end] for cue in cues], dtype = np.int64).reshape(-1, 2))
+        blocks = [b"%d\n%s\n%s\n\n" % (number, timing, cue.text.encode("utf-8"))
+                  for number, (timing, cue) in enumerate(zip(timings, cues), start = 1)]
+
+        return cls(b"".join(blocks))
+
+    def __len__(self):
+        return len(self.times)
+
+    @property
+    def starts(self) -> np.ndarray:
+        return self.times[:, 0]
+
+    @property
+    def ends(self) -> np.ndarray:
+        return self.times[:, 1]
+
+    def text(self, index: int) -> str:
+        begin, end = self._text_spans[index]
+        lines = self._buffer[begin:end].decode("utf-8", errors = "replace").strip().split("\n")
+
+        # drop number of the next cue
+        if index % len(self) != len(self) - 1 and lines[-1].strip().isdigit():
+            lines.pop()
+
+        return "\n".join(lines).strip()
+
+    def cue(self, index: int) -> Cue:
+        start, end = self.times[index]
+        return Cue(int(start), int(end), self.text(index))
+
+    def first(self) -> Cue:
+        return self.cue(0)
+
+    def last(self) -> Cue:
+        return self.cue(-1)
+
+    def set_times(self, index: int, start: int, end: int):
+        self.times[index] = (start, end)
+        return self
+
+    def affine(self, multiplier: float = 1, offset: int = 0):
+        """ time → time × multiplier + offset (fractions of milliseconds are truncated) """
+        self.times = np.floor(self.times * multiplier + offset).astype(np.int64)
+        return self
+
+    def scale(self, multiplier: float):
+        return self.affine(multiplier = multiplier)
+
+    def shift(self, offset: int):
+        self.times = self.times + offset
+        return self
+
+    def piecewise(self, source_points: [int], target_points: [int]):
+        """
+            Map times with piecewise linear function going through (source_point, target_point) pairs.
+            Times outside of source points range are extrapolated with first/last segment.
+        """
+        source = np.asarray(source_points, dtype = np.float64)
+        target = np.asarray(target_points, dtype = np.float64)
+        if len(source) < 2 or len(source) != len(target) or np.any(np.diff(source) <= 0):
+            raise ValueError("At least two points with increasing source times are required")
+
+        times = self.times.astype(np.float64)
+        mapped = np.interp(times, source, target)
+
+        head_slope = (target[1] - target[0]) / (source[1] - source[0])
+        tail_slope = (target[-1] - target[-2]) / (source[-1] - source[-2])
+        mapped = np.where(times < source[0], target[0] + (times - source[0]) * head_slope, mapped)
+        mapped = np.where(times > source[-1], target[-1] + (times - source[-1]) * tail_slope, mapped)
+
+        self.times = np.floor(mapped).astype(np.int64)
+        return self
+
+    def _changed_cues(self) -> np.ndarray:
+        return np.flatnonzero(np.any(self.times != self._saved_times, axis = 1))
+
+    def to_bytes(self) -> bytes:
+        changed = self._changed_cues()
+        if len(changed) == 0:
+            return bytes(self._buffer)
+
+        pieces = []
+        position = 0
+        for (begin, end), timing in zip(self._timing_spans[changed].tolist(), _format_timings(self.times[changed])):
+            pieces.append(self._buffer[position:begin])
+            pieces.append(timing)
+            position = end
+        pieces.append(self._buffer[position:])
+
+        return b"".join(pieces)
+
+    def to_text(self) -> str:
+        return self.to_bytes().decode("utf-8")
+
+    def save(self, path: str = None):
+        path = self.path if path is None else path
+        changed = self._changed_cues()
+        timings = _format_timings(self.times[changed])
+        spans = self._timing_spans[changed].tolist()
+
+        if path == self.path and all(len(timing) == end - begin for timing, (begin, end) in zip(timings, spans)):
+            # only changed timings are written, rest of file stays untouched
+            with open(path, "r+b") as file:
+                for timing, (begin, end) in zip(timings, spans):
+                    file.seek(begin)
+                    file.write(timing)
+                    self._buffer[begin:end] = timing
+
+            self._saved_times = self.times.copy()
+        else:
+            data = self.to_bytes()
+            with open(path, "wb") as file:
+                file.write(data)
+
+            self.__init__(data, path)
@@ -6,16 +6,15 @@ import re
 import shutil
 import sys
 import tempfile
-from tqdm import tqdm
-from tqdm.contrib.logging import logging_redirect_tqdm
 
-from . import utils
+from . import subtitle_formats, utils
 
 
 class Fixer(utils.InterruptibleProcess):
-    def __init__(self, really_fix: bool):
+    def __init__(self, really_fix: bool, reprocess: bool = False):
         super().__init__()
         self._do_fix = really_fix
+        self._reprocess = reprocess
 
     @staticmethod
     def _print_broken_videos(broken_videos_info: [(utils.VideoInfo, [int])]):
@@ -23,37 +22,30 @@ class Fixer(utils.InterruptibleProcess):
         for broken_video in broken_videos_info:
             logging.info(f"{len(broken_video[1])} broken subtitle(s) in {broken_video[0].path} found")
 
-    def _no_resolver(self, video_track: utils.VideoTrack, content: str):
+    def _no_resolver(self, video_track: utils.VideoTrack, document: subtitle_formats.SubtitleDocument):
         logging.error("Cannot fix the file, no idea how to do it.")
         return None
 
-    def _long_tail_resolver(self, video_track: utils.VideoTrack, content: str):
-        timestamps = list(utils.subrip_time_pattern.finditer(content))
-        last_timestamp = timestamps[-1]
-        time_from, time_to = map(utils.time_to_ms, last_timestamp.groups())
+    def _long_tail_resolver(self, video_track: utils.VideoTrack, document: subtitle_formats.SubtitleDocument):
+        last_cue = document.last()
         lenght = video_track.length
-        new_time_to = min(time_from + 5000, lenght)
+        new_time_to = min(last_cue.start + 5000, lenght)
 
-        begin_pos = last_timestamp.start(1)
-        end_pos = last_timestamp.end(2)
+        return document.set_times(len(document) - 1, last_cue.start, new_time_to)
 
-        content = content[:begin_pos] + f"{utils.ms_to_time(time_from)} --> {utils.ms_to_time(new_time_to)}" + content[end_pos:]
-        return content
-
-    def _fps_scale_resolver(self, video_track: utils.VideoTrack, content: str):
+    def _fps_scale_resolver(self, video_track: utils.VideoTrack, document: subtitle_formats.SubtitleDocument):
         target_fps = utils.fps_str_to_float(video_track.fps)
         multiplier = utils.ffmpeg_default_fps / target_fps
 
-        return utils.alter_subrip_subtitles_times(content, multiplier)
+        return document.scale(multiplier)
 
-    def _get_resolver(self, content: str, video_length: int):
-        timestamps = list(utils.subrip_time_pattern.finditer(content))
-        if len(timestamps) == 0:
+    def _get_resolver(self, document: subtitle_formats.SubtitleDocument, video_length: int):
+        if len(document) == 0:
             return self._no_resolver
 
         # check if last subtitle is beyond limit
-        last_timestamp = timestamps[-1]
-        time_from, time_to = map(utils.time_to_ms, last_timestamp.groups())
+        last_cue = document.last()
+        time_from, time_to = last_cue.start, last_cue.end
 
         if time_from < video_length and time_to > video_length:
             return self._long_tail_resolver
@@ -66,19 +58,17 @@ class Fixer(utils.InterruptibleProcess):
     def _fix_subtitle(self, broken_subtitle, video_info: utils.VideoInfo) -> bool:
         video_track = video_info.video_tracks[0]
 
-        with open(broken_subtitle, 'r', encoding='utf-8') as file:
-            content = file.read()
+        document = subtitle_formats.SubtitleDocument.load(broken_subtitle)
 
         # figure out what is broken
-        resolver = self._get_resolver(content, video_track.length)
-        new_content = resolver(video_track, content)
+        resolver = self._get_resolver(document, video_track.length)
+        fixed_document = resolver(video_track, document)
 
-        if new_content is None:
+        if fixed_document is None:
             logging.warning("Subtitles not fixed")
             return False
         else:
-            with open(broken_subtitle, 'w', encoding='utf-8') as file:
-                file.write(new_content)
+            fixed_document.save()
             return True
 
     def _extract_all_subtitles(self,video_file: str, subtitles: [utils.Subtitle], wd: str) -> [utils.SubtitleFile]:
@@ -100,8 +90,8 @@ class Fixer(utils.InterruptibleProcess):
         self._print_broken_videos(broken_videos_info)
         logging.info("Fixing videos")
 
-        with logging_redirect_tqdm():
-            for broken_video in tqdm(broken_videos_info, desc="Fixing", unit="video", leave=False, smoothing=0.1, mininterval=.2, disable=utils.hide_progressbar()):
+        with utils.logging_redirect_tqdm():
+            for broken_video in utils.tqdm(broken_videos_info, desc="Fixing", unit="video", leave=False, smoothing=0.1, mininterval=.2, disable=utils.hide_progressbar()):
                 self._check_for_stop()
 
                 video_info = broken_video[0]
@@ -133,18 +123,20 @@ class Fixer(utils.InterruptibleProcess):
 
                             # remove temporary file
                             os.remove(video_without_subtitles)
+
+                            utils.record_processing_outcome(video_file, "subtitles_fix", "", "fixed")
                         else:
                             logging.info("Not applying fixes - dry run mode.")
                     else:
                         logging.debug("Skipping video due to errors")
 
-    def _check_if_broken(self, video_file: str): # -> (utils.VideoInfo, [int]) | None:    // FIXME
+    def _check_if_broken(self, video_info: utils.VideoInfo): # -> (utils.VideoInfo, [int]) | None:    // FIXME
+        video_file = video_info.path
         logging.debug(f"Processing file {video_file}")
 
         def diff(a, b):
             return abs(a - b) / max(a, b)
 
-        video_info = utils.get_video_data(video_file)
         video_length = video_info.video_tracks[0].length
 
         if video_length is None:
@@ -166,29 +158,50 @@ class Fixer(utils.InterruptibleProcess):
 
         if len(broken_subtitiles) == 0:
             logging.debug("No issues found")
+
+            # dry run changes nothing, so it must not affect next runs
+            if self._do_fix:
+                utils.record_processing_outcome(video_file, "subtitles_fix", "", "no issues")
             return None
 
         logging.debug(f"Issues found in {video_file}")
         return (video_info, broken_subtitiles)
 
+    def _already_processed(self, video_file: str) -> bool:
+        if self._reprocess:
+            return False
+
+        outcome = utils.get_processing_outcome(video_file, "subtitles_fix", "")
+        if outcome is None:
+            return False
+
+        logging.debug(f"Skipping {video_file}, already processed ({outcome})")
+        return True
+
     def _process_dir(self, path: str) -> []:
         broken_videos = []
         video_files = []
 
         logging.debug(f"Finding videos in {path}")
-        for cd, _, files in os.walk(path, followlinks = True):
+        for cd, _, files in utils.walk(path, followlinks = True):
             for file in files:
                 self._check_for_stop()
                 file_path = os.path.join(cd, file)
 
-                if utils.is_video(file_path):
+                if utils.is_video(file_path) and not self._already_processed(file_path):
                     video_files.append(file_path)
 
         logging.debug("Analysing videos")
-        with logging_redirect_tqdm():
-            for video in tqdm(video_files, desc="Analysing videos", unit="video", leave=False, smoothing=0.1, mininterval=.2, disable=utils.hide_progressbar()):
+        with utils.logging_redirect_tqdm():
+            # videos are probed concurrently, results come in order of completion
+            probes = utils.probe_many(video_files, interruptible = self)
+            for video_file, video_info in utils.tqdm(probes, total=len(video_files), desc="Analysing videos", unit="video", leave=False, smoothing=0.1, mininterval=.2, disable=utils.hide_progressbar()):
                 self._check_for_stop()
-                broken_video = self._check_if_broken(video)
+                if video_info is None:
+                    logging.warning(f"Skipping {video_file}, it could not be probed")
+                    continue
+
+                broken_video = self._check_if_broken(video_info)
                 if broken_video is not None:
                     broken_videos.append(broken_video)
 
@@ -218,6 +231,6 @@ def run(args):
             logging.debug(f"{tool} path: {path}")
 
     logging.info("Searching for broken files")
-    fixer = Fixer(args.no_dry_run)
+    fixer = Fixer(args.no_dry_run, reprocess = args.reprocess)
     fixer.process_dir(args.videos_path[0])
     logging.info("Done")
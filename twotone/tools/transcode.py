@@ -5,26 +5,118 @@ import os
 import random
 import re
 import shutil
+import sqlite3
 import sys
 import tempfile
+import threading
+from collections import namedtuple
 from concurrent.futures import ThreadPoolExecutor
-from tqdm import tqdm
-from tqdm.contrib.logging import logging_redirect_tqdm
+from contextlib import ExitStack
+
+from . import cache, quality_metrics, utils
+
+# outcome of CRF evaluation stopped as soon as it was known whether target is met. Carries no quality value
+CrfDecision = namedtuple("CrfDecision", "meets_target")
+
+
+def meets_target(result, target) -> bool:
+    """ Check if evaluation result (exact quality or CrfDecision made for the same target) meets target """
+    if isinstance(result, CrfDecision):
+        return result.meets_target
+
+    return result is not None and result >= target
+
+
+def exact_quality(result) -> float or None:
+    """ Quality of evaluation result, None if evaluation was stopped early """
+    return None if isinstance(result, CrfDecision) else result
 
-from . import utils
 
 class Transcoder(utils.InterruptibleProcess):
-    def __init__(self, live_run: bool = False, target_ssim: float = 0.98, codec: str = "libx265"):
+    # available CRF search strategies: name -> method
+    crf_search_strategies = {
+        "interpolation": "_interpolation_crf_search",
+        "bisection": "_bisection_crf_search",
+    }
+
+    crf_range = (0, 51)
+    crf_search_start = 26               # typical result for SSIM ≈ 0.98
+
+    # proxy (coarse-to-fine) search modes: 'auto' uses proxies for videos taller than proxy_auto_min_height
+    proxy_search_modes = ["auto", "always", "never"]
+    proxy_height = 540
+    proxy_auto_min_height = 1080
+
+    # segment extraction modes:
+    #   copy:     stream copy from key frame to key frame (no encoding at all)
+    #   ffv1:     lossless intra-only FFV1 (cheap to encode and to seek in)
+    #   lossless: lossless re-encode with target codec (rebuilds damaged or troublesome videos)
+    extraction_modes = ["copy", "ffv1", "lossless"]
+
+    # planes quality is measured on during CRF search
+    quality_plane_modes = ["all", "luma"]
+
+    def __init__(self, live_run: bool = False, target_ssim: float = 0.98, codec: str = "libx265", threads: int = None, crf_search: str = "interpolation",
+                 fused_measurement: bool = True, use_search_cache: bool = True, reprocess: bool = False, proxy_search: str = "auto",
+                 extraction: str = "copy", quality_stride: int = 1, quality_planes: str = "all", quality_downscale: int = None,
+                 metric: str = "ssim", target_quality: float = None, metric_threads: int = None, vmaf_model: str = "vmaf_v0.6.1"):
+        """
+            Quality is measured with given metric (see quality_metrics.metrics).
+            target_quality is metric's value to reach. When not provided target_ssim is used for SSIM and metric's default target for other metrics.
+        """
         super().__init__()
         self.live_run = live_run
-        self.target_ssim = target_ssim
         self.codec = codec
+        self.fused_measurement = fused_measurement
+        self.use_search_cache = use_search_cache
+        self.reprocess = reprocess
+        self._search_cache = None
+        # CRF search uses whatever is left by final transcoding of previous file running in background
+        self.budget = utils.ThreadBudget(threads if threads is not None else os.cpu_count() or 1)
+
+        self.metric = quality_metrics.create(metric, threads = metric_threads, vmaf_model = vmaf_model)
+
+        if target_quality is None:
+            target_quality = target_ssim if metric == quality_metrics.Ssim.name else self.metric.default_target
+
+        low, high = self.metric.target_range
+        if not low <= target_quality <= high:
+            raise ValueError(f"{self.metric.name.upper()} target must be between {low} and {high}. Got {target_quality}")
+
+        self.target_quality = target_quality
+
+        if crf_search not in self.crf_search_strategies:
+            raise ValueError(f"Unknown CRF search strategy: {crf_search}")
+
+        self.crf_search = crf_search
+
+        if proxy_search not in self.proxy_search_modes:
+            raise ValueError(f"Unknown proxy search mode: {proxy_search}")
+
+        self.proxy_search = proxy_search
+
+        if extraction not in self.extraction_modes:
+            raise ValueError(f"Unknown segment extraction mode: {extraction}")
+
+        self.extraction = extraction
+        self._intact_sources = {}
+
+        if quality_stride < 1:
+            raise ValueError(f"Quality measurement stride must be greater than 0. Got {quality_stride}")
+
+        if quality_planes not in self.quality_plane_modes:
+            raise ValueError(f"Unknown quality measurement planes mode: {quality_planes}")
+
+        # subsampled measurement (used during CRF search only)
+        self.quality_stride = quality_stride
+        self.quality_planes = quality_planes
+        self.quality_downscale = quality_downscale
 
 
     def _find_video_files(self, directory):
         """Find video files with specified extensions."""
         video_files = []
-        for root, _, files in os.walk(directory):
+        for root, _, files in utils.walk(directory):
             for file in files:
                 if utils.is_video(file):
                     video_files.append(os.path.join(root, file))
@@ -36,108 +128,238 @@ class Transcoder(utils.InterruptibleProcess):
             raise RuntimeError(result.stderr)
 
 
-    def _calculate_quality(self, original, transcoded):
-        """Calculate SSIM between original and transcoded video."""
-        args = [
+    def _calculate_quality(self, original, transcoded, cancellation: utils.Cancellation = None, subsampled = True):
+        """
+            Calculate quality of transcoded video (in comparison to original one) with configured metric.
+            When subsampled is set, configured subsampling (frames stride, planes, downscale) is applied.
+        """
+        with tempfile.TemporaryDirectory() as stats_dir:
+            stats_file = os.path.join(stats_dir, "stats")
+            args = self._quality_args(original, transcoded, stats_file, subsampled)
+
+            result = utils.start_process("ffmpeg", args, cancellation = cancellation)
+            if result.returncode != 0:
+                logging.error(f"Quality calculation failed: {result.stderr}")
+                return None
+
+            return self._parse_quality(stats_file, subsampled)
+
+
+    def _quality_filter(self, stats_file: str, subsampled = True):
+        filters = []
+
+        if subsampled and self.quality_stride > 1 and not self.metric.native_subsample:
+            filters.append(f"select='not(mod(n,{self.quality_stride}))'")
+        if subsampled and self.quality_downscale is not None:
+            filters.append(f"scale=-2:'min({self.quality_downscale},ih)'")
+        if subsampled and self.quality_planes == "luma" and self.metric.luma_filter is not None:
+            filters.append(self.metric.luma_filter)
+
+        subsample = self.quality_stride if subsampled else 1
+
+        if not filters:
+            return self.metric.filter("0:v", "1:v", stats_file, subsample)
+
+        # both videos need to be processed the same way
+        chain = ",".join(filters)
+        return f"[0:v]{chain}[reference];[1:v]{chain}[distorted];" + self.metric.filter("reference", "distorted", stats_file, subsample)
+
+
+    def _quality_args(self, original, transcoded, stats_file: str, subsampled = True):
+        return [
+            *self.metric.ffmpeg_options(),
             "-i", original, "-i", transcoded,
-            "-lavfi", "ssim", "-f", "null", "-"
+            "-lavfi", self._quality_filter(stats_file, subsampled), "-f", "null", "-"
         ]
 
-        result = utils.start_process("ffmpeg", args)
-        ssim_line = [line for line in result.stderr.splitlines() if "All:" in line]
 
-        if ssim_line:
-            # Extract the SSIM value immediately after "All:"
-            ssim_value = ssim_line[-1].split("All:")[1].split()[0]
-            try:
-                return float(ssim_value)
-            except ValueError:
-                logging.error(f"Failed to parse SSIM value: {ssim_value}")
-                return None
+    def _parse_quality(self, stats_file: str, subsampled = True):
+        try:
+            return self.metric.parse(stats_file, luma_only = subsampled and self.quality_planes == "luma")
+        except (OSError, ValueError, KeyError) as e:
+            logging.error(f"Failed to parse {self.metric.name.upper()} stats: {e}")
+            return None
 
-        return None
 
+    def _threading_params(self, threads):
+        """ Encoder options limiting number of threads used by encoder to given value """
+        if self.codec == "libx265":
+            # frame threads as x265 would pick them for a pool of given size
+            frame_threads = 6 if threads >= 32 else 5 if threads >= 16 else 3 if threads >= 8 else 2 if threads >= 4 else 1
+            return ["-x265-params", f"pools={threads}:frame-threads={frame_threads}"]
+        else:
+            return ["-threads", str(threads)]
 
-    def _transcode_video(self, input_file, output_file, crf, preset, input_params=[], output_params=[], audio_codec=["-an"], show_progress=False):
+
+    def _transcode_video(self, input_file, output_file, crf, preset, input_params=[], output_params=[], audio_codec=["-an"], show_progress=False, threads=None,
+                         cancellation: utils.Cancellation = None):
         """
         Encode video with a given CRF, preset, and extra parameters.
         By default audio is removed as in most cases this function is being used
-        for finding optimal CRF and quite often audio may alter SSIM results
+        for finding optimal CRF and quite often audio may alter quality measurements
         (in most cases due to interfering with timestamps).
+        When threads is provided, both decoder and encoder are limited to use given number of threads.
         """
 
-        args = [
+        args = self._transcode_args(input_file, output_file, crf, preset, input_params, output_params, audio_codec, threads)
+
+        result = utils.start_process("ffmpeg", args, show_progress=show_progress, cancellation=cancellation)
+        self._validate_ffmpeg_result(result)
+
+
+    def _transcode_args(self, input_file, output_file, crf, preset, input_params, output_params, audio_codec, threads):
+        threading_input_params = [] if threads is None else ["-threads", str(threads)]
+        threading_output_params = [] if threads is None else self._threading_params(threads)
+
+        return [
             "-v", "error", "-stats", "-nostdin",
+            *threading_input_params,
             *input_params,
             "-i", input_file,
             "-c:v", self.codec,
             "-crf", str(crf),
             "-preset", preset,
             "-profile:v", "main10",
+            *threading_output_params,
             *audio_codec,
             *output_params,
             output_file
         ]
 
-        result = utils.start_process("ffmpeg", args, show_progress=show_progress)
-        self._validate_ffmpeg_result(result)
+
+    def _extraction_output_params(self, mode, threads, scale_height = None):
+        """ Output options for extracted segments for given extraction mode. When scale_height is provided video is downscaled to it. """
+        scale_params = [] if scale_height is None else ["-vf", f"scale=-2:{scale_height}"]
+
+        if mode == "copy":
+            return ["-c:v", "copy", "-avoid_negative_ts", "make_zero", "-an"]
+        elif mode == "ffv1":
+            return [*scale_params, "-c:v", "ffv1", "-level", "3", "-slices", "4", "-threads", str(threads), "-an"]
+        else:
+            # video is transcoded with lossless quality to rebuild damaged or troublesome videos
+            return [
+                *scale_params,
+                "-c:v", self.codec,
+                "-crf", "0",
+                "-preset", "veryfast",
+                "-profile:v", "main10",
+                *self._threading_params(threads),
+                "-an"
+            ]
+
+
+    def _is_source_intact(self, video_file: str, segments, probed_segments = 3, probe_duration = 1) -> bool:
+        """
+            Quick integrity probe: first second of a few segments is decoded.
+            Any decoding error means segments cannot be cut without re-encoding.
+        """
+        if video_file not in self._intact_sources:
+            inputs = []
+            outputs = []
+
+            for input_index, (start, _) in enumerate(segments[:probed_segments]):
+                inputs.extend(["-ss", str(start), "-t", str(probe_duration), "-i", video_file])
+                outputs.extend(["-map", f"{input_index}:v:0", "-f", "null", "-"])
+
+            result = utils.start_process("ffmpeg", ["-v", "error", "-xerror", "-nostdin", *inputs, *outputs])
+            self._intact_sources[video_file] = result.returncode == 0 and not result.stderr.strip()
+
+            if not self._intact_sources[video_file]:
+                logging.warning(f"{video_file} failed integrity probe, segments will be re-encoded losslessly")
+
+        return self._intact_sources[video_file]
 
 
-    def _extract_segment(self, video_file, start_time, end_time, output_file):
-        """ Extract video segment. Video is transcoded with lossless quality to rebuild damaged or troublesome videos """
-        self._transcode_video(
-            video_file,
-            output_file,
-            crf=0,
-            preset="veryfast",
-            input_params=["-ss", str(start_time), "-to", str(end_time)]
-        )
+    def _extraction_mode(self, video_file: str, segments, scale_height = None) -> str:
+        mode = self.extraction
 
+        # stream copy cannot scale
+        if mode == "copy" and scale_height is not None:
+            mode = "ffv1"
 
-    def _extract_segments(self, video_file: str, segments, output_dir: str):
+        if mode != "lossless" and not self._is_source_intact(video_file, segments):
+            mode = "lossless"
+
+        return mode
+
+
+    def _extract_segments(self, video_file: str, segments, output_dir: str, batch_size = 8, scale_height = None):
+        """
+            Extract all segments with as few ffmpeg runs as possible.
+            Each ffmpeg run opens the video once per segment (with input seeking, so nothing but segments is decoded)
+            and writes all its segments at once.
+            Segments are downscaled to scale_height when provided.
+        """
         output_files = []
         _, filename, ext = utils.split_path(video_file)
+        filename = filename if scale_height is None else f"{filename}.{scale_height}p"
+
+        mode = self._extraction_mode(video_file, segments, scale_height)
+        # Matroska can hold any codec (copied ones included)
+        ext = ext if mode == "lossless" else "mkv"
 
-        i = 0
-        with logging_redirect_tqdm():
-            for (start, end) in tqdm(segments, desc="Extracting scenes", unit="scene", leave=False, smoothing=0.1, mininterval=.2, disable=utils.hide_progressbar()):
+        with utils.logging_redirect_tqdm(), \
+             utils.tqdm(desc="Extracting scenes", unit="scene", total=len(segments), **utils.get_tqdm_defaults()) as pbar:
+            for batch_start in range(0, len(segments), batch_size):
                 self._check_for_stop()
-                output_file = os.path.join(output_dir, f"{filename}.frag{i}.{ext}")
-                self._extract_segment(video_file, start, end, output_file)
-                output_files.append(output_file)
-                i += 1
+                batch = segments[batch_start:batch_start + batch_size]
+
+                with self.budget.reserve_available(self.budget.total) as threads:
+                    threads_per_segment = max(1, threads // len(batch))
+                    inputs = []
+                    outputs = []
+
+                    for input_index, (start, end) in enumerate(batch):
+                        output_file = os.path.join(output_dir, f"{filename}.frag{batch_start + input_index}.{ext}")
+                        inputs.extend(["-threads", str(threads_per_segment), "-ss", str(start), "-to", str(end), "-i", video_file])
+                        outputs.extend(["-map", f"{input_index}:v:0", *self._extraction_output_params(mode, threads_per_segment, scale_height), output_file])
+                        output_files.append(output_file)
+
+                    result = utils.start_process("ffmpeg", ["-v", "error", "-nostdin", *inputs, *outputs])
+                    self._validate_ffmpeg_result(result)
+
+                pbar.update(len(batch))
 
         return output_files
 
 
     def _select_scenes(self, video_file, segment_duration=5):
         """
-        Select video segments around detected scene changes, merging nearby timestamps.
+        Select video segments around detected scene changes, merging overlapping ones.
+
+        Only key frames are decoded (and downscaled) for scene detection which makes it cheap.
+        Scene change scores are therefore calculated between consecutive key frames, so only scene changes
+        which happen at key frames (encoders usually place key frames there) are detected.
 
         Parameters:
             video_file (str): Path to the input video file.
             segment_duration (int): Minimum duration (in seconds) of each segment.
 
         Returns:
-            list: Full paths to the generated video files.
+            list: (start, end) tuples of segments (centred on scene changes) in seconds.
         """
 
         # FFmpeg command to detect scene changes and log timestamps
-        args = [
-            "-i", video_file,
-            "-vf", "select='gt(scene,0.6)',showinfo",
-            "-vsync", "vfr", "-f", "null", "/dev/null"
-        ]
-
-        result = utils.start_process("ffmpeg", args)
-
-        # Parse timestamps from the ffmpeg output
-        timestamps = []
-        showinfo_output = result.stderr
-        for line in showinfo_output.splitlines():
-            match = re.search(r"pts_time:(\d+(\.\d+)?)", line)
-            if match:
-                timestamps.append(float(match.group(1)))
+        with self.budget.reserve_available(self.budget.total) as threads:
+            args = [
+                "-threads", str(threads),
+                "-skip_frame", "nokey",
+                "-i", video_file,
+                "-vf", "scale=-2:'min(360,ih)',select='gt(scene,0.6)',showinfo",
+                "-vsync", "vfr", "-f", "null", "/dev/null"
+            ]
+
+            # Parse timestamps from the ffmpeg output as it goes (showinfo output may be huge for long videos)
+            timestamps = []
+            pts_time_pattern = re.compile(r"pts_time:(\d+(\.\d+)?)")
+
+            def parse_timestamp(line: str):
+                match = pts_time_pattern.search(line)
+                if match:
+                    timestamps.append(float(match.group(1)))
+
+            result = utils.start_process("ffmpeg", args, on_stderr_line = parse_timestamp)
+            self._validate_ffmpeg_result(result)
 
         # Generate segments with padding
         segments = []
@@ -157,8 +379,8 @@ class Transcoder(utils.InterruptibleProcess):
         return merged_segments
 
 
-    def _select_segments(self, video_file, segment_duration=5):
-        duration = utils.get_video_duration(video_file) / 1000
+    def _select_segments(self, video_file, segment_duration=5, probe: utils.ProbeContext = None):
+        duration = utils.get_video_duration(video_file, probe = probe) / 1000
         num_segments = max(3, min(10, int(duration // 30)))
 
         if duration <= 0 or num_segments <= 0 or segment_duration <= 0:
@@ -207,57 +429,271 @@ class Transcoder(utils.InterruptibleProcess):
         return best_value, best_result
 
 
-    def _transcode_segment_and_compare(self, wd_dir: str, segment_file: str, crf: int) -> float or None:
+    def _interpolation_search(self, eval_func, min_value, max_value, target, start):
+        """
+        Find the greatest value in range for which eval_func returns result >= target.
+        eval_func is expected to be monotonically decreasing (like SSIM as a function of CRF).
+        It may return CrfDecision instead of value, such results are used for bracketing only (never for interpolation).
+
+        Search starts at 'start' and walks with growing steps until the target is bracketed.
+        Then the bracket is narrowed with linear interpolation between its ends
+        (bisection is used whenever interpolation is not possible).
+
+        Returns:
+            Tuple[int, any]: The optimal value and its corresponding evaluation result.
+                             (None, None) if no value in range meets the target.
+        """
+        passing = None              # (value, result) of greatest known value meeting target
+        failing = None              # (value, result) of smallest known value not meeting target
+
+        # bracketing
+        value = min(max(start, min_value), max_value)
+        previous = None
+        step = 4
+        while passing is None or failing is None:
+            result = eval_func(value)
+            quality = exact_quality(result)
+
+            if meets_target(result, target):
+                passing = (value, result)
+                if value == max_value:
+                    return passing
+                direction = 1
+            else:
+                failing = (value, result)
+                if value == min_value:
+                    return None, None
+                direction = -1
+
+            next_value = value + direction * step
+
+            # extrapolate from two last points when possible, going one step beyond the estimate to bracket the target
+            if previous is not None and quality is not None and previous[1] is not None and previous[1] != quality:
+                slope = (quality - previous[1]) / (value - previous[0])
+                if slope < 0:
+                    estimate = round(value + (target - quality) / slope) + direction
+                    next_value = min(max(estimate, value + 1), value + step) if direction > 0 else \
+                                 max(min(estimate, value - 1), value - step)
+
+            previous = (value, quality)
+            value = min(max(next_value, min_value), max_value)
+            step *= 2
+
+        # narrowing
+        while failing[0] - passing[0] > 1:
+            (passing_value, passing_result), (failing_value, failing_result) = passing, failing
+            passing_result, failing_result = exact_quality(passing_result), exact_quality(failing_result)
+
+            if passing_result is not None and failing_result is not None and passing_result > failing_result:
+                fraction = (passing_result - target) / (passing_result - failing_result)
+                value = int(passing_value + fraction * (failing_value - passing_value))
+            else:
+                value = (passing_value + failing_value) // 2
+
+            value = min(max(value, passing_value + 1), failing_value - 1)
+            result = eval_func(value)
+
+            if meets_target(result, target):
+                passing = (value, result)
+            else:
+                failing = (value, result)
+
+        return passing
+
+
+    def _check_top_quality(self, top_quality, target):
+        name = self.metric.name.upper()
+
+        if top_quality < self.metric.top_quality:
+            raise RuntimeError(f"Sanity check failed: top {name} value: {top_quality} < {self.metric.top_quality}")
+
+        if top_quality < target:
+            raise RuntimeError(f"Top {name} value: {top_quality} < requested {name}: {target}")
+
+
+    def _bisection_crf_search(self, evaluate_crf, target = None, sanity_check = True):
+        target = self.target_quality if target is None else target
+
+        if sanity_check:
+            top_quality = evaluate_crf(self.crf_range[0], exact = True)
+            self._check_top_quality(top_quality, target)
+
+        return self._bisection_search(evaluate_crf, min_value = self.crf_range[0], max_value = self.crf_range[1],
+                                      target_condition=lambda result: meets_target(result, target))
+
+
+    def _interpolation_crf_search(self, evaluate_crf, target = None, sanity_check = True):
+        """
+            Unlike bisection, sanity check (exact quality at lowest CRF) is done only when no CRF meets target.
+            Found CRF proves encoder reaches target quality, so extra encode at lowest CRF would be wasted.
+        """
+        target = self.target_quality if target is None else target
+        best_crf, best_quality = self._interpolation_search(evaluate_crf, min_value = self.crf_range[0], max_value = self.crf_range[1],
+                                                            target = target, start = self.crf_search_start)
+
+        # sanity check is needed only when nothing meets the target
+        # (lowest CRF was evaluated by the search already in such case)
+        if best_crf is None and sanity_check:
+            self._check_top_quality(evaluate_crf(self.crf_range[0], exact = True), target)
+
+        return best_crf, best_quality
+
+
+    def _proxy_crf_search(self, search, evaluate_crf, evaluate_proxy_crf) -> (int, float) or None:
+        """
+            Coarse-to-fine CRF search.
+            CRF is searched on downscaled segments first. Difference between native and proxy quality is then measured
+            for found CRF and proxy search is repeated with target corrected by it. Finally CRF is confirmed
+            at native resolution (native measurement made for the difference is reused, so at most 2 CRFs are evaluated at native resolution).
+            Returns None when proxy search was not conclusive, full search at native resolution is needed then.
+        """
+        def proxy_search(target):
+            best_crf, _ = search(lambda crf, exact = False: evaluate_proxy_crf(crf, exact, target), target = target, sanity_check = False)
+            return best_crf
+
+        proxy_crf = proxy_search(self.target_quality)
+        if proxy_crf is None:
+            return None
+
+        native_quality = evaluate_crf(proxy_crf, exact = True)
+        offset = native_quality - evaluate_proxy_crf(proxy_crf, exact = True)
+        logging.info(f"Native and proxy quality difference at CRF {proxy_crf}: {offset}")
+
+        calibrated_crf = proxy_search(min(self.metric.value_range[1], self.target_quality - offset))
+        if calibrated_crf is None:
+            return None
+
+        return self._confirm_crf(evaluate_crf, (proxy_crf, native_quality), calibrated_crf)
+
+
+    def _confirm_crf(self, evaluate_crf, known, crf, max_evaluations = 1) -> (int, float) or None:
+        """
+            Narrow down greatest CRF meeting target at native resolution starting with known (crf, quality) point
+            and CRF estimated on proxies. At most max_evaluations CRFs are evaluated.
+            Returns greatest (crf, quality) known to meet target or None if none does.
+        """
+        passing = None              # (crf, result) of greatest known CRF meeting target
+        failing = None              # smallest known CRF not meeting target
+
+        def update(crf, result):
+            nonlocal passing, failing
+            if meets_target(result, self.target_quality):
+                passing = (crf, result) if passing is None or crf > passing[0] else passing
+            else:
+                failing = crf if failing is None else min(crf, failing)
+
+        update(*known)
+
+        for _ in range(max_evaluations):
+            if passing is not None and failing is not None and failing - passing[0] <= 1:
+                break
+
+            if crf == known[0] or (passing is not None and crf <= passing[0]) or (failing is not None and crf >= failing):
+                # estimate brings nothing new, move towards unknown side
+                if passing is None:
+                    crf = failing - 1
+                elif failing is None:
+                    crf = passing[0] + 1
+                else:
+                    crf = (passing[0] + failing) // 2
+
+            if crf < self.crf_range[0] or crf > self.crf_range[1]:
+                break
+
+            update(crf, evaluate_crf(crf))
+
+        return passing
+
+
+    def _transcode_segment_and_compare(self, wd_dir: str, segment_file: str, crf: int, threads: int = None,
+                                       cancellation: utils.Cancellation = None) -> float or None:
+        if self.fused_measurement:
+            return self._transcode_segment_and_measure(segment_file, crf, threads, cancellation)
+
         _, filename, ext = utils.split_path(segment_file)
 
         transcoded_segment_output = os.path.join(wd_dir, f"{filename}.transcoded.{ext}")
 
-        self._transcode_video(segment_file, transcoded_segment_output, crf, "veryfast", output_params = ["-vsync", "vfr"])
+        self._transcode_video(segment_file, transcoded_segment_output, crf, "veryfast", output_params = ["-vsync", "vfr"], threads = threads,
+                              cancellation = cancellation)
 
-        quality = self._calculate_quality(segment_file, transcoded_segment_output)
+        quality = self._calculate_quality(segment_file, transcoded_segment_output, cancellation)
         return quality
 
-    def _for_segments(self, segments, op, title, unit):
-        with logging_redirect_tqdm(), \
-             tqdm(desc=title, unit=unit, total=len(segments), **utils.get_tqdm_defaults()) as pbar, \
-             tempfile.TemporaryDirectory() as wd_dir, \
-             ThreadPoolExecutor() as executor:
-            def worker(file_path):
-                op(wd_dir, file_path)
-                pbar.update(1)
+    def _transcode_segment_and_measure(self, segment_file: str, crf: int, threads: int = None,
+                                       cancellation: utils.Cancellation = None) -> float or None:
+        """
+            Encode segment and measure its quality without intermediate file.
+            Encoder's output is streamed (as NUT which keeps timestamps intact) directly into quality calculation process.
+        """
+        encode_args = self._transcode_args(segment_file, "-", crf, "veryfast", input_params = [],
+                                           output_params = ["-vsync", "vfr", "-f", "nut"], audio_codec = ["-an"], threads = threads)
+
+        with tempfile.TemporaryDirectory() as stats_dir:
+            stats_file = os.path.join(stats_dir, "stats")
+            quality_args = self._quality_args(segment_file, "pipe:0", stats_file)
+
+            result = utils.start_pipeline("ffmpeg", encode_args, "ffmpeg", quality_args, cancellation = cancellation)
+            self._validate_ffmpeg_result(result)
 
-            for segment in segments:
-                executor.submit(worker, segment)
+            return self._parse_quality(stats_file)
 
-    def _final_transcode(self, input_file, crf):
-        """Perform the final transcoding with the best CRF using the determined extra_params."""
+
+    def _for_segments(self, segments, op, title, unit, cancellation: utils.Cancellation = None):
+        """
+            Run op(wd_dir, segment, threads) for all segments concurrently.
+            Segments share threads left in budget (by final transcoding running in background) equally, so encoders do not oversubscribe CPU.
+            Segments waiting for their turn are skipped once cancellation is cancelled.
+        """
+        with self.budget.reserve_available(self.budget.total) as search_threads:
+            threads_per_job = max(1, search_threads // max(1, len(segments)))
+            jobs = max(1, min(len(segments), search_threads // threads_per_job))
+
+            with utils.logging_redirect_tqdm(), \
+                 utils.tqdm(desc=title, unit=unit, total=len(segments), **utils.get_tqdm_defaults()) as pbar, \
+                 tempfile.TemporaryDirectory() as wd_dir, \
+                 ThreadPoolExecutor(max_workers=jobs) as executor:
+                def worker(file_path):
+                    if cancellation is None or not cancellation.cancelled:
+                        op(wd_dir, file_path, threads_per_job)
+                    pbar.update(1)
+
+                for segment in segments:
+                    executor.submit(worker, segment)
+
+    def _final_transcode(self, input_file, crf, threads) -> str:
+        """
+            Perform the final transcoding with the best CRF using the determined extra_params. Returns outcome description.
+            threads are expected to be reserved in budget by caller.
+        """
         _, basename, ext = utils.split_path(input_file)
 
-        logging.info(f"Starting final transcoding with CRF: {crf}")
+        logging.info(f"Starting final transcoding of {input_file} with CRF: {crf} using {threads} threads")
         final_output_file = f"{basename}.temp.{ext}"
-        self._transcode_video(input_file, final_output_file, crf, "veryslow", audio_codec=["-c:a", "copy"], output_params = ["-vsync", "passthrough"], show_progress=True)
+        self._transcode_video(input_file, final_output_file, crf, "veryslow", audio_codec=["-c:a", "copy"], output_params = ["-vsync", "passthrough"], show_progress=True, threads=threads)
+
+        # Measure quality again after final transcoding
+        final_quality = self._calculate_quality(input_file, final_output_file, subsampled = False)
 
         original_size = os.path.getsize(input_file)
         final_size = os.path.getsize(final_output_file)
         size_reduction = (final_size / original_size) * 100
-
-        # Measure SSIM again after final transcoding
-        final_quality = self._calculate_quality(input_file, final_output_file)
+        name = self.metric.name.upper()
 
         try:
-            if final_quality < self.target_ssim:
+            if final_quality is None or final_quality < self.target_quality:
                 logging.warning(
-                    f"Final CRF: {crf}, SSIM: {final_quality}. "
-                    f"Final transcode resulted in lower SSIM than requested: {final_quality} < {self.target_ssim}"
+                    f"Final CRF: {crf}, {name}: {final_quality}. "
+                    f"Final transcode resulted in lower {name} than requested: {final_quality} < {self.target_quality}"
                 )
-                raise ValueError()
+                raise ValueError("kept original: quality below target")
 
             if final_size > original_size:
                 logging.warning(
-                    f"Final CRF: {crf}, SSIM: {final_quality}. "
+                    f"Final CRF: {crf}, {name}: {final_quality}. "
                     f"Encoded file is larger than the original. Keeping the original file."
                 )
-                raise ValueError()
+                raise ValueError("kept original: encoded file larger")
 
 
             utils.start_process("exiftool", ["-overwrite_original", "-TagsFromFile", input_file, "-all:all>all:all", final_output_file])
@@ -268,93 +704,377 @@ class Transcoder(utils.InterruptibleProcess):
                 shutil.move(final_output_file, input_file)
 
             logging.info(
-                f"Final CRF: {crf}, SSIM: {final_quality}, "
+                f"Final CRF: {crf}, {name}: {final_quality}, "
                 f"encoded Size: {final_size} bytes, "
                 f"size reduced by: {original_size - final_size} bytes "
                 f"({size_reduction:.2f}% of original size)"
             )
 
-        except ValueError:
+            return "transcoded"
+
+        except ValueError as outcome:
             os.remove(final_output_file)
+            return str(outcome)
 
 
 
-    def find_optimal_crf(self, input_file, allow_segments=True):
-        """Find the optimal CRF using bisection."""
-        original_size = os.path.getsize(input_file)
+    def _get_search_cache(self) -> cache.CrfSearchCache or None:
+        if self.use_search_cache and self._search_cache is None:
+            try:
+                self._search_cache = cache.CrfSearchCache()
+            except (OSError, sqlite3.Error) as e:
+                logging.warning(f"Could not open CRF search cache, continuing without it: {e}")
+                self.use_search_cache = False
+
+        return self._search_cache
+
+
+    def _use_proxy(self, input_file: str, probe: utils.ProbeContext) -> bool:
+        if self.proxy_search == "never":
+            return False
+
+        resolution = utils.get_video_resolution(input_file, probe = probe)
+        if resolution is None or resolution[1] <= self.proxy_height:
+            return False
+
+        return self.proxy_search == "always" or resolution[1] > self.proxy_auto_min_height
+
 
-        duration = utils.get_video_duration(input_file)
+    def _measurement_config(self, extraction_mode: str = None) -> str:
+        """
+            Description of how segments are measured. Measurements done with different config are not comparable.
+            extraction_mode is mode segments were extracted with (it changes reference clips), None when whole file is measured.
+        """
+        config = f"{self.codec}:veryfast:{self.metric.config()}"
+
+        if extraction_mode is not None:
+            config += f":extract={extraction_mode}"
+
+        if self.quality_stride > 1:
+            config += f":stride={self.quality_stride}"
+        if self.quality_planes != "all" and self.metric.luma_filter is not None:
+            config += f":{self.quality_planes}"
+        if self.quality_downscale is not None:
+            config += f":scale={self.quality_downscale}"
+
+        return config
+
+
+    def _search_setup(self, input_file, allow_segments, probe: utils.ProbeContext) -> (bool, bool, str) or None:
+        """ Returns (use segments, use proxy, result config) tuple for CRF search of given file or None if file's duration is unknown """
+        duration = utils.get_video_duration(input_file, probe = probe)
         if not duration:
             return None
 
         # convert to seconds
         duration /= 1000
 
-        with tempfile.TemporaryDirectory() as wd_dir:
-            segment_files = []
-            if allow_segments and duration > 30:
-                logging.info(f"Picking segments from {input_file}")
-                segments = self._select_scenes(input_file)
-                if len(segments) < 2:
-                    segments = self._select_segments(input_file)
-
-                segment_files = self._extract_segments(
-                    input_file, segments, wd_dir)
-
-                logging.info(f"Starting CRF bisection for {input_file} "
-                             f"with veryfast preset using {len(segment_files)} segments")
-            else:
-                segment_files = [input_file]
-                logging.info(f"Starting CRF bisection for {input_file} with veryfast preset using whole file")
+        use_segments = allow_segments and duration > 30
+        use_proxy = use_segments and self._use_proxy(input_file, probe)
+        result_config = f"{self._measurement_config(self.extraction if use_segments else None)}:{'segments' if use_segments else 'whole'}{':proxy' if use_proxy else ''}"
 
-            def evaluate_crf(mid_crf):
-                self._check_for_stop()
-                qualities = []
+        # found CRF depends on search too
+        result_config += f":{self.crf_search}:crf={self.crf_range[0]}-{self.crf_range[1]}:start={self.crf_search_start}"
 
-                def get_quality(wd_dir, segment_file):
-                    quality = self._transcode_segment_and_compare(wd_dir, segment_file, mid_crf)
-                    if quality:
-                        qualities.append(quality)
+        return use_segments, use_proxy, result_config
 
-                self._for_segments(segment_files, get_quality, "SSIM calculation", "scene")
 
-                avg_quality = sum(qualities) / len(qualities) if qualities else 0
-                logging.info(f"CRF: {mid_crf}, Average Quality (SSIM): {avg_quality}")
+    def _needs_search(self, input_file, probe: utils.ProbeContext) -> bool:
+        """ True if CRF search for file is going to be performed (its optimal CRF is not known yet) """
+        setup = self._search_setup(input_file, True, probe)
+        if setup is None:
+            return False
 
-                return avg_quality
+        search_cache = self._get_search_cache()
+        if search_cache is None:
+            return True
 
-            top_quality = evaluate_crf(0)
-            if top_quality < 0.9975:
-                raise RuntimeError(f"Sanity check failed: top SSIM value: {top_quality} < 0.9975")
+        try:
+            found, _ = search_cache.get_result(cache.file_fingerprint(input_file), setup[2], self.target_quality)
+        except (OSError, sqlite3.Error):
+            return True
 
-            if top_quality < self.target_ssim:
-                raise RuntimeError(f"Top SSIM value: {top_quality} < requested SSIM: {self.target_ssim}")
+        return not found
 
-            crf_min, crf_max = 0, 51
-            best_crf, best_quality = self._bisection_search(evaluate_crf, min_value = crf_min, max_value = crf_max, target_condition=lambda avg_quality: avg_quality >= self.target_ssim)
 
-            if best_crf is not None and best_quality is not None:
-                logging.info(f"Finished CRF bisection. Optimal CRF: {best_crf} with quality: {best_quality}")
+    def find_optimal_crf(self, input_file, allow_segments=True, probe: utils.ProbeContext = None):
+        """Find the optimal CRF using selected search strategy."""
+        probe = utils.ProbeContext() if probe is None else probe
+        setup = self._search_setup(input_file, allow_segments, probe)
+        if setup is None:
+            return None
+
+        use_segments, use_proxy, result_config = setup
+        search_cache = self._get_search_cache()
+        fingerprint = cache.file_fingerprint(input_file)
+
+        if search_cache is not None:
+            found, best_crf = search_cache.get_result(fingerprint, result_config, self.target_quality)
+            if found:
+                logging.info(f"Using previously found optimal CRF for {input_file}: {best_crf}")
+                self._record_if_unreachable(input_file, best_crf)
+                return best_crf
+
+        with tempfile.TemporaryDirectory() as wd_dir:
+            if use_segments:
+                segments = None if search_cache is None else search_cache.get_segments(fingerprint)
+
+                if segments is None:
+                    logging.info(f"Picking segments from {input_file}")
+                    segments = self._select_scenes(input_file)
+                    if len(segments) < 2:
+                        segments = self._select_segments(input_file, probe = probe)
+
+                    if search_cache is not None:
+                        search_cache.put_segments(fingerprint, segments)
+
+                segment_keys = [f"{start:.3f}-{end:.3f}" for start, end in segments]
+                measurement_config = self._measurement_config(self._extraction_mode(input_file, segments))
+                proxy_measurement_config = \
+                    f"{self._measurement_config(self._extraction_mode(input_file, segments, self.proxy_height))}:proxy{self.proxy_height}" if use_proxy else None
+
+                logging.info(f"Starting CRF {self.crf_search} search for {input_file} "
+                             f"with veryfast preset using {len(segments)} segments{f' ({self.proxy_height}p proxies first)' if use_proxy else ''}")
+            else:
+                segment_keys = ["whole"]
+                measurement_config = self._measurement_config()
+                proxy_measurement_config = None
+                logging.info(f"Starting CRF {self.crf_search} search for {input_file} with veryfast preset using whole file")
+
+            evaluations = 0
+            encodes = 0
+            metric_name = self.metric.name.upper()
+
+            def make_evaluate_crf(config: str, scale_height: int = None):
+                """ Build evaluation function for segments measured with given config (and downscaled to scale_height if provided) """
+
+                # segments are extracted on first use, so no work is done when all needed measurements are known already
+                segment_files = []
+
+                def get_segment_files():
+                    if not segment_files:
+                        segment_files.extend(self._extract_segments(input_file, segments, wd_dir, scale_height = scale_height) if use_segments else [input_file])
+
+                    return segment_files
+
+                # exact qualities of evaluated CRFs and decisions of evaluations stopped early ((crf, target) -> meets target),
+                # so no CRF is evaluated twice
+                measurements = {}
+                decisions = {}
+
+                def evaluate_crf(mid_crf, exact = False, target = None):
+                    """
+                        Returns average quality of all segments encoded with given CRF.
+                        Unless exact value is required, evaluation stops as soon as segments still being measured
+                        cannot change whether the average meets the target (even if they got the best or the worst possible quality).
+                        CrfDecision is returned then, as average of measured segments is not the quality of CRF.
+                    """
+                    nonlocal evaluations, encodes
+                    target = self.target_quality if target is None else target
+
+                    if mid_crf in measurements:
+                        return measurements[mid_crf]
+                    elif not exact and (mid_crf, target) in decisions:
+                        return decisions[(mid_crf, target)]
+
+                    self._check_for_stop()
+                    qualities = {}
+                    failed = set()              # segments which could not be measured, they are left out of average
+                    qualities_lock = threading.Lock()
+                    cancellation = utils.Cancellation()
+
+                    if search_cache is not None:
+                        for key in segment_keys:
+                            quality = search_cache.get_quality(fingerprint, key, config, mid_crf)
+                            if quality is not None:
+                                qualities[key] = quality
+
+                    def decide() -> CrfDecision or None:
+                        measured = sum(qualities.values())
+                        counted = len(segment_keys) - len(failed)
+                        pending = counted - len(qualities)
+                        required = target * counted
+                        worst, best = self.metric.value_range
+
+                        if counted == 0:
+                            return None
+
+                        if measured + pending * worst >= required:
+                            return CrfDecision(meets_target = True)
+                        elif measured + pending * best < required:
+                            return CrfDecision(meets_target = False)
+                        else:
+                            return None
+
+                    def get_quality(wd_dir, segment_file, threads):
+                        nonlocal encodes
+
+                        try:
+                            quality = self._transcode_segment_and_compare(wd_dir, segment_file, mid_crf, threads, cancellation = cancellation)
+                        except RuntimeError:
+                            if cancellation.cancelled:
+                                return
+                            raise
+
+                        key = segment_key[segment_file]
+
+                        if quality is None:
+                            logging.warning(f"Could not measure quality of {segment_file} encoded with CRF {mid_crf}, it is left out")
+                        elif search_cache is not None:
+                            search_cache.put_quality(fingerprint, key, config, mid_crf, quality)
+
+                        with qualities_lock:
+                            if quality is None:
+                                failed.add(key)
+                            else:
+                                qualities[key] = quality
+                                encodes += 1
+
+                            if not exact and not cancellation.cancelled and len(qualities) + len(failed) < len(segment_keys) and decide() is not None:
+                                logging.debug(f"CRF: {mid_crf}, outcome decided after {len(qualities)} of {len(segment_keys)} segments")
+                                cancellation.cancel()
+
+                    missing_keys = [key for key in segment_keys if key not in qualities]
+                    decided_early = bool(missing_keys) and not exact and decide() is not None
+
+                    if missing_keys and not decided_early:
+                        segment_file = dict(zip(segment_keys, get_segment_files()))
+                        segment_key = {segment_file[key]: key for key in missing_keys}
+
+                        title = f"{metric_name} calculation" if scale_height is None else f"{metric_name} calculation ({scale_height}p)"
+                        self._for_segments(list(segment_key), get_quality, title, "scene", cancellation)
+                        decided_early = cancellation.cancelled and len(qualities) + len(failed) < len(segment_keys)
+
+                    evaluations += not any(crf == mid_crf for crf, _ in decisions)
+                    resolution = '' if scale_height is None else f' ({scale_height}p)'
+
+                    if decided_early:
+                        decision = decide()
+                        logging.info(f"CRF: {mid_crf}{resolution}, {'meets' if decision.meets_target else 'does not meet'} target quality ({metric_name}): {target} "
+                                     f"(outcome known after {len(qualities)} of {len(segment_keys)} segments)")
+
+                        decisions[(mid_crf, target)] = decision
+                        return decision
+
+                    avg_quality = sum(qualities.values()) / len(qualities) if qualities else 0
+                    logging.info(f"CRF: {mid_crf}{resolution}, Average Quality ({metric_name}): {avg_quality}")
+
+                    measurements[mid_crf] = avg_quality
+                    return avg_quality
+
+                return evaluate_crf
+
+            search = getattr(self, self.crf_search_strategies[self.crf_search])
+            evaluate_crf = make_evaluate_crf(measurement_config)
+            proxy_result = None
+
+            if use_proxy:
+                evaluate_proxy_crf = make_evaluate_crf(proxy_measurement_config, scale_height = self.proxy_height)
+                proxy_result = self._proxy_crf_search(search, evaluate_crf, evaluate_proxy_crf)
+
+                if proxy_result is None:
+                    logging.info("Proxy search was not conclusive, continuing at native resolution")
+
+            best_crf, best_result = search(evaluate_crf) if proxy_result is None else proxy_result
+            best_quality = exact_quality(best_result)
+
+            if best_crf is not None:
+                quality_info = f"quality: {best_quality}" if best_quality is not None else f"quality meeting target ({self.target_quality})"
+                logging.info(f"Finished CRF {self.crf_search} search. Optimal CRF: {best_crf} with {quality_info}. "
+                             f"Evaluated {evaluations} CRF values ({encodes} encodes)")
             else:
-                logging.warning(f"Finished CRF bisection. Could not find CRF matching desired quality ({self.target_ssim}).")
+                logging.warning(f"Finished CRF {self.crf_search} search. Could not find CRF matching desired quality ({self.target_quality}). "
+                                f"Evaluated {evaluations} CRF values ({encodes} encodes)")
+
+            if search_cache is not None:
+                search_cache.put_result(fingerprint, result_config, self.target_quality, best_crf)
+
+            self._record_if_unreachable(input_file, best_crf)
             return best_crf
 
 
+    def _journal_parameters(self) -> str:
+        return f"{self.codec}:{self.metric.config()}={self.target_quality}"
+
+
+    def _record_if_unreachable(self, file: str, best_crf: int or None):
+        # there is nothing to do with files for which no CRF meets target quality, remember that
+        if best_crf is None and self.live_run:
+            utils.record_processing_outcome(file, "transcode", self._journal_parameters(), "kept original: no CRF meets target")
+
+
+    def _already_processed(self, file: str) -> bool:
+        if self.reprocess:
+            return False
+
+        outcome = utils.get_processing_outcome(file, "transcode", self._journal_parameters())
+        if outcome is None:
+            return False
+
+        logging.info(f"Skipping {file}, already processed ({outcome})")
+        return True
+
+
     def transcode(self, directory: str):
-        logging.info(f"Starting video transcoding with {self.codec}. Target SSIM: {self.target_ssim}")
-        video_files = self._find_video_files(directory)
+        logging.info(f"Starting video transcoding with {self.codec}. Target {self.metric.name.upper()}: {self.target_quality}. Threads: {self.budget.total}")
+        self.metric.check_available()
+        video_files = [file for file in self._find_video_files(directory) if not self._already_processed(file)]
+
+        # probe all files upfront (concurrently) and skip those which are not usable videos
+        probe = utils.ProbeContext()
+        usable_files = set()
+        with utils.logging_redirect_tqdm():
+            probes = utils.probe_many(video_files, probe = probe, interruptible = self)
+            for file, video_info in utils.tqdm(probes, total=len(video_files), desc="Probing videos", unit="video", **utils.get_tqdm_defaults()):
+                self._check_for_stop()
+                if video_info is not None and video_info.video_tracks:
+                    usable_files.add(file)
+                else:
+                    logging.warning(f"Skipping {file}, it does not look like a valid video")
 
-        for file in video_files:
-            self._check_for_stop()
-            logging.info(f"Processing {file}")
-            best_crf = self.find_optimal_crf(file)
-            if best_crf is not None and self.live_run:
-                # increase crf by one as veryslow preset will be used, so result should be above requested quality anyway
-                self._final_transcode(file, best_crf + 1)
-            elif not self.live_run:
-                logging.info(f"Dry run. Skipping final transcoding step.")
+        video_files = [file for file in video_files if file in usable_files]
 
-            logging.info(f"Finished processing {file}")
+        # Final (veryslow) transcoding of a file is done in background while CRF search for next file is performed.
+        # When CRF search is going to be performed for next file, final transcoding and search
+        # take half of threads budget each. Otherwise final transcoding takes all of it.
+        with ThreadPoolExecutor(max_workers=1) as final_transcoding:
+            pending_transcoding = None
+
+            def final_transcode(file, crf, threads, reservation: ExitStack):
+                # threads are returned to budget (so search may use them) as soon as final transcoding is done
+                with reservation:
+                    outcome = self._final_transcode(file, crf, threads)
+
+                utils.record_processing_outcome(file, "transcode", self._journal_parameters(), outcome)
+                logging.info(f"Finished processing {file}")
+
+            for i, file in enumerate(video_files):
+                self._check_for_stop()
+                logging.info(f"Processing {file}")
+                best_crf = self.find_optimal_crf(file, probe = probe)
+                probe.forget(file)
+                if best_crf is not None and self.live_run:
+                    if pending_transcoding is not None:
+                        pending_transcoding.result()
+
+                    # only search for next file can overlap with this final transcoding
+                    search_pending = i + 1 < len(video_files) and self._needs_search(video_files[i + 1], probe)
+                    threads = max(1, self.budget.total // 2) if search_pending else self.budget.total
+
+                    # threads are reserved before next search starts, it is going to use what is left
+                    reservation = ExitStack()
+                    threads = reservation.enter_context(self.budget.reserve(threads))
+
+                    # increase crf by one as veryslow preset will be used, so result should be above requested quality anyway
+                    pending_transcoding = final_transcoding.submit(final_transcode, file, best_crf + 1, threads, reservation)
+                else:
+                    if not self.live_run:
+                        logging.info(f"Dry run. Skipping final transcoding step.")
+
+                    logging.info(f"Finished processing {file}")
+
+            if pending_transcoding is not None:
+                pending_transcoding.result()
 
         logging.info("Video processing completed")
 
@@ -370,10 +1090,81 @@ def setup_parser(parser: argparse.ArgumentParser):
         except ValueError:
             raise argparse.ArgumentTypeError(f"Invalid SSIM value: {value}")
 
+    def positive_int(value):
+        try:
+            ivalue = int(value)
+        except ValueError:
+            raise argparse.ArgumentTypeError(f"Invalid integer value: {value}")
+
+        if ivalue < 1:
+            raise argparse.ArgumentTypeError(f"Value must be greater than 0. Got {value}")
+
+        return ivalue
+
     parser.add_argument("--ssim", "-s",
                         type=valid_ssim_value,
                         default=0.98,
-                        help='Requested SSIM value (video quality). Valid values are between 0 and 1.')
+                        help='Requested SSIM value (video quality) when SSIM metric is used. Valid values are between 0 and 1.')
+    parser.add_argument("--metric",
+                        choices=list(quality_metrics.metrics),
+                        default="ssim",
+                        help='Quality metric used for finding optimal CRF. VMAF requires ffmpeg built with libvmaf. Default: ssim')
+    parser.add_argument("--target",
+                        type=float,
+                        default=None,
+                        help='Requested value of selected metric. Defaults: ' +
+                             ", ".join(f"{name}: {metric.default_target}" for name, metric in quality_metrics.metrics.items() if name != "ssim") +
+                             ' (for SSIM --ssim is used).')
+    parser.add_argument("--metric-threads",
+                        type=positive_int,
+                        default=None,
+                        help='Number of threads used by quality metric filter.')
+    parser.add_argument("--vmaf-model",
+                        choices=quality_metrics.Vmaf.models,
+                        default="vmaf_v0.6.1",
+                        help='VMAF model. Default: vmaf_v0.6.1')
+    parser.add_argument("--crf-search",
+                        choices=list(Transcoder.crf_search_strategies),
+                        default="interpolation",
+                        help='Strategy used for finding optimal CRF. Default: interpolation')
+    parser.add_argument("--no-fused-measurement",
+                        action='store_true',
+                        default=False,
+                        help='Write each encoded segment to a temporary file and measure its quality in a separate pass. '
+                             'By default encoder output is streamed directly into quality measurement.')
+    parser.add_argument("--no-search-cache",
+                        action='store_true',
+                        default=False,
+                        help='Do not reuse nor store results of CRF search. By default measured qualities and found CRFs '
+                             'are stored, so interrupted searches can be resumed and target quality changes reuse previous measurements.')
+    parser.add_argument("--proxy-search",
+                        choices=Transcoder.proxy_search_modes,
+                        default="auto",
+                        help=f'Narrow CRF range on segments downscaled to {Transcoder.proxy_height}p first and confirm found CRF at native resolution. '
+                             f'auto: for videos taller than {Transcoder.proxy_auto_min_height}p only. Default: auto')
+    parser.add_argument("--segment-extraction",
+                        choices=Transcoder.extraction_modes,
+                        default="copy",
+                        help='How segments used for CRF search are extracted. copy: stream copy (from key frame to key frame), '
+                             'ffv1: lossless FFV1, lossless: lossless re-encode with target codec. '
+                             'Sources failing quick integrity probe are always re-encoded losslessly. Default: copy')
+    parser.add_argument("--quality-stride",
+                        type=positive_int,
+                        default=1,
+                        help='Measure quality on every Nth frame only during CRF search. Default: 1 (all frames)')
+    parser.add_argument("--quality-planes",
+                        choices=Transcoder.quality_plane_modes,
+                        default="all",
+                        help='Planes quality is measured on during CRF search (VMAF uses luma only anyway). Default: all')
+    parser.add_argument("--quality-downscale",
+                        type=positive_int,
+                        default=None,
+                        help='Downscale videos to given height (if taller) before measuring quality during CRF search.')
+    parser.add_argument("--threads", "-t",
+                        type=positive_int,
+                        default=os.cpu_count() or 1,
+                        help='Total number of CPU threads all encoders may use at once. '
+                             'Defaults to number of CPUs.')
     parser.add_argument('videos_path',
                         nargs=1,
                         help='Path with videos to transcode.')
@@ -383,5 +1174,23 @@ def run(args):
     if args.verbose:
         logging.getLogger().setLevel(logging.DEBUG)
 
-    transcoder = Transcoder(live_run = args.no_dry_run, target_ssim = args.ssim)
+    # --target depends on --metric, so it is validated once all arguments are known
+    metric = quality_metrics.metrics[args.metric]
+    low, high = metric.target_range
+    if args.target is not None and not low <= args.target <= high:
+        raise RuntimeError(f"{metric.name.upper()} target must be between {low} and {high}. Got {args.target}")
+
+    transcoder = Transcoder(live_run = args.no_dry_run, target_ssim = args.ssim, threads = args.threads, crf_search = args.crf_search,
+                            fused_measurement = not args.no_fused_measurement,
+                            use_search_cache = not args.no_search_cache,
+                            reprocess = args.reprocess,
+                            proxy_search = args.proxy_search,
+                            extraction = args.segment_extraction,
+                            quality_stride = args.quality_stride,
+                            quality_planes = args.quality_planes,
+                            quality_downscale = args.quality_downscale,
+                            metric = args.metric,
+                            target_quality = args.target,
+                            metric_threads = args.metric_threads,
+                            vmaf_model = args.vmaf_model)
     transcoder.transcode(args.videos_path[0])
@@ -1,24 +1,28 @@
 
-import cchardet
+import asyncio
 import json
 import logging
 import math
 import os.path
 import re
 import signal
+import sqlite3
 import subprocess
 import sys
 import tempfile
+import threading
 import uuid
-from collections import namedtuple
+from collections import deque, namedtuple
+from contextlib import ExitStack, closing, contextmanager, nullcontext
 from itertools import islice
 from pathlib import Path
 from typing import List
-from tqdm import tqdm
-from tqdm.contrib.logging import logging_redirect_tqdm
 
+from . import cache, matroska
 
-SubtitleFile = namedtuple("Subtitle", "path language encoding")
+
+SubtitleFile = namedtuple("Subtitle", "path language encoding format", defaults=(None,))
+SubtitleFileInfo = namedtuple("SubtitleFileInfo", "path encoding format")
 Subtitle = namedtuple("Subtitle", "language default length tid format")
 VideoTrack = namedtuple("VideoTrack", "fps length")
 VideoInfo = namedtuple("VideoInfo", "video_tracks subtitles path")
@@ -29,8 +33,31 @@ subtitle_format2 = re.compile("(?:0|1)\n[0-9]{2}:[0-9]{2}:[0-9]{2},[0-9]{3} -->
 microdvd_time_pattern = re.compile("\\{[0-9]+\\}\\{[0-9]+\\}.*")
 subrip_time_pattern = re.compile(r'(\d+:\d{2}:\d{2},\d{3}) --> (\d+:\d{2}:\d{2},\d{3})')
 
+subtitle_sniff_size = 64 * 1024                  # how many bytes of a file are used to recognize subtitles
+
 ffmpeg_default_fps = 23.976                      # constant taken from https://trac.ffmpeg.org/ticket/3287
 
+_probe_cache = None
+_probe_cache_enabled = True
+_ffprobe_version = None
+_library_index = None
+_library_index_enabled = True
+_processing_journal = None
+_processing_journal_enabled = True
+
+def tqdm(*args, **kwargs):
+    """ tqdm progress bar. tqdm is imported on first use only (it is slow to import) """
+    from tqdm import tqdm as tqdm_bar
+
+    return tqdm_bar(*args, **kwargs)
+
+
+def logging_redirect_tqdm():
+    from tqdm.contrib.logging import logging_redirect_tqdm as redirect
+
+    return redirect()
+
+
 def get_tqdm_defaults():
     return {
     'leave': False,
@@ -40,7 +67,48 @@ def get_tqdm_defaults():
 }
 
 
-def start_process(process: str, args: [str], show_progress = False) -> ProcessResult:
+def _progress_handler(process: str, args: [str], stack: ExitStack):
+    """ Returns stderr line handler updating progress bar for ffmpeg processes or None if progress cannot be tracked """
+    if process != "ffmpeg":
+        return None
+
+    index_of_i = args.index("-i")
+    input_file = args[index_of_i + 1]
+
+    if not is_video(input_file):
+        return None
+
+    progress_pattern = re.compile(r"frame= *(\d+)")
+    frames = get_video_frames_count(input_file)
+    stack.enter_context(logging_redirect_tqdm())
+    pbar = stack.enter_context(tqdm(desc="Processing video", unit="frame", total=frames, **get_tqdm_defaults()))
+    last_frame = 0
+
+    def handler(line: str):
+        nonlocal last_frame
+
+        if "frame=" in line:
+            match = progress_pattern.search(line)
+            if match:
+                current_frame = int(match.group(1))
+                delta = current_frame - last_frame
+                pbar.update(delta)
+                last_frame = current_frame
+
+    return handler
+
+
+def start_process(process: str, args: [str], show_progress = False, on_stderr_line = None, stderr_tail_lines = 100,
+                  cancellation = None) -> ProcessResult:
+    """
+        Run process and wait for it to finish.
+
+        When show_progress is set or on_stderr_line callback is provided, stderr is processed line by line while
+        process is running and is not buffered in memory (only last stderr_tail_lines lines are returned in result,
+        which is enough for error reporting).
+
+        Process is killed (with non zero return code as a result) when provided Cancellation gets cancelled.
+    """
     command = [process]
     command.extend(args)
 
@@ -48,82 +116,152 @@ def start_process(process: str, args: [str], show_progress = False) -> ProcessRe
     sub_process = subprocess.Popen(
         command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, bufsize=1, preexec_fn=os.setsid)
 
-    if show_progress:
-        if process == "ffmpeg":
-            index_of_i = args.index("-i")
-            input_file = args[index_of_i + 1]
-
-            if is_video(input_file):
-                progress_pattern = re.compile(r"frame= *(\d+)")
-                frames = get_video_frames_count(input_file)
-                with logging_redirect_tqdm(), \
-                     tqdm(desc="Processing video", unit="frame", total=frames, **get_tqdm_defaults()) as pbar:
-                    last_frame = 0
-                    for line in sub_process.stderr:
-                        line = line.strip()
-                        if "frame=" in line:
-                            match = progress_pattern.search(line)
-                            if match:
-                                current_frame = int(match.group(1))
-                                delta = current_frame - last_frame
-                                pbar.update(delta)
-                                last_frame = current_frame
-
-    stdout, stderr = sub_process.communicate()
+    with ExitStack() as stack:
+        handlers = []
+
+        if cancellation is not None:
+            stack.enter_context(cancellation.register(sub_process))
+
+        if show_progress:
+            progress_handler = _progress_handler(process, args, stack)
+            if progress_handler is not None:
+                handlers.append(progress_handler)
+
+        if on_stderr_line is not None:
+            handlers.append(on_stderr_line)
+
+        if handlers:
+            # read stdout in background so process never blocks on full pipe
+            stdout_content = []
+            stdout_reader = threading.Thread(target=lambda: stdout_content.append(sub_process.stdout.read()))
+            stdout_reader.start()
+
+            stderr_tail = deque(maxlen=stderr_tail_lines)
+            for line in sub_process.stderr:
+                line = line.rstrip("\n")
+                for handler in handlers:
+                    handler(line)
+                stderr_tail.append(line)
+
+            sub_process.wait()
+            stdout_reader.join()
+            sub_process.stdout.close()
+            sub_process.stderr.close()
+
+            stdout = stdout_content[0]
+            stderr = "\n".join(stderr_tail)
+        else:
+            stdout, stderr = sub_process.communicate()
 
     logging.debug(f"Process finished with {sub_process.returncode}")
 
     return ProcessResult(sub_process.returncode, stdout, stderr)
 
 
+def start_pipeline(producer: str, producer_args: [str], consumer: str, consumer_args: [str], cancellation = None) -> ProcessResult:
+    """
+        Start two processes with producer's stdout connected directly to consumer's stdin.
+        Returned result contains consumer's stdout and stderr of both processes.
+        Return code is non zero if any of processes failed (or were killed by provided Cancellation).
+    """
+    logging.debug(f"Starting {producer} with options: {' '.join(producer_args)} | {consumer} with options: {' '.join(consumer_args)}")
+    producer_process = subprocess.Popen(
+        [producer, *producer_args], stdout=subprocess.PIPE, stderr=subprocess.PIPE, preexec_fn=os.setsid)
+    consumer_process = subprocess.Popen(
+        [consumer, *consumer_args], stdin=producer_process.stdout, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        universal_newlines=True, bufsize=1, preexec_fn=os.setsid)
+
+    # consumer owns the pipe now. Closing it here lets producer get SIGPIPE if consumer quits early.
+    producer_process.stdout.close()
+
+    producer_stderr = []
+    producer_stderr_reader = threading.Thread(target=lambda: producer_stderr.append(producer_process.stderr.read()))
+    producer_stderr_reader.start()
+
+    with cancellation.register(producer_process, consumer_process) if cancellation is not None else nullcontext():
+        stdout, stderr = consumer_process.communicate()
+        producer_stderr_reader.join()
+        producer_process.stderr.close()
+        producer_process.wait()
+
+    returncode = producer_process.returncode or consumer_process.returncode
+    logging.debug(f"Processes finished with {producer_process.returncode} and {consumer_process.returncode}")
+
+    return ProcessResult(returncode, stdout, producer_stderr[0].decode(errors="replace") + stderr)
+
+
 def raise_on_error(status: ProcessResult):
     if status.returncode != 0:
         raise RuntimeError(f"Process exited with unexpected error:\n{status.stdout}\n{status.stderr}")
 
 
-def file_encoding(file: str) -> str:
+def _detect_encoding(data: bytes) -> str or None:
+    import cchardet
+
     detector = cchardet.UniversalDetector()
+    detector.feed(data)
+    detector.close()
+
+    return detector.result["encoding"]
 
-    with open(file, 'rb') as file:
-        for line in file.readlines():
-            detector.feed(line)
-            if detector.done:
-                break
-        detector.close()
 
-    encoding = detector.result["encoding"]
+def _read_prefix(file: str) -> bytes:
+    """ Read bounded prefix of file, which is enough for encoding and subtitle format detection """
+    with open(os.path.realpath(file), 'rb') as text_file:
+        return text_file.read(subtitle_sniff_size)
 
-    return encoding
+
+def file_encoding(file: str) -> str:
+    return _detect_encoding(_read_prefix(file))
 
 
 def is_video(file: str) -> bool:
     return Path(file).suffix[1:].lower() in ["mkv", "mp4", "avi", "mpg", "mpeg", "mov", "rmvb"]
 
 
-def is_subtitle(file: str) -> bool:
+def sniff_subtitle(file: str) -> SubtitleFileInfo or None:
+    """
+        Check if file is a subtitle file. Only a bounded prefix of file is read (once)
+        and used for both encoding and format detection.
+        Returns subtitle's details or None if file is not a subtitle.
+    """
     logging.debug(f"Checking file {file} for being subtitle")
     ext = file[-4:]
 
     if ext == ".srt" or ext == ".sub" or ext == ".txt":
-        file = os.path.realpath(file)
-        encoding = file_encoding(file)
+        prefix = _read_prefix(file)
+        encoding = _detect_encoding(prefix)
 
         if encoding:
-            logging.debug(f"\tOpening file with encoding {encoding}")
+            logging.debug(f"\tDecoding file with encoding {encoding}")
 
-            with open(file, 'r', encoding = encoding) as text_file:
-                head = "".join(islice(text_file, 5)).strip()
+            try:
+                # prefix may end in the middle of a multibyte character, ignore such errors
+                text = prefix.decode(encoding, errors = "ignore")
+            except LookupError:
+                logging.debug(f"\tUnknown encoding {encoding}")
+                return None
 
-                for subtitle_format in [subtitle_format1, microdvd_time_pattern, subtitle_format2]:
-                    if subtitle_format.match(head):
-                        logging.debug("\tSubtitle format detected")
-                        return True
+            lines = text.replace("\r\n", "\n").replace("\r", "\n").split("\n")
+            head = "\n".join(lines[:5]).strip()
+
+            for format, subtitle_format in [("tmplayer", subtitle_format1), ("microdvd", microdvd_time_pattern), ("subrip", subtitle_format2)]:
+                if subtitle_format.match(head):
+                    logging.debug("\tSubtitle format detected")
+                    return SubtitleFileInfo(file, encoding, format)
 
     logging.debug("\tNot a subtitle file")
-    return False
+    return None
+
+
+def is_subtitle(file: str) -> bool:
+    return sniff_subtitle(file) is not None
+
 
+def is_subtitle_microdvd(subtitle: SubtitleFile) -> bool:
+    if subtitle.format is not None:
+        return subtitle.format == "microdvd"
 
-def is_subtitle_microdvd(subtitle: Subtitle) -> bool:
     with open(subtitle.path, 'r', encoding = subtitle.encoding) as text_file:
         head = "".join(islice(text_file, 5)).strip()
 
@@ -156,19 +294,9 @@ def fps_str_to_float(fps: str) -> float:
 
 
 def alter_subrip_subtitles_times(content: str, multiplier: float) -> str:
-    def multiply_time(match):
-        time_from, time_to = map(time_to_ms, match.groups())
-        time_from *= multiplier
-        time_to *= multiplier
+    from . import subtitle_formats                  # numpy is heavy, load it only when needed
 
-        time_from_srt = ms_to_time(time_from)
-        time_to_srt = ms_to_time(time_to)
-
-        return f"{time_from_srt} --> {time_to_srt}"
-
-    content = subrip_time_pattern.sub(multiply_time, content)
-
-    return content
+    return subtitle_formats.SubtitleDocument.from_text(content).scale(multiplier).to_text()
 
 
 def fix_subtitles_fps(input_path: str, output_path: str, subtitles_fps: float):
@@ -188,48 +316,168 @@ def fix_subtitles_fps(input_path: str, output_path: str, subtitles_fps: float):
         outfile.write(content)
 
 
-def get_video_duration(video_file):
-    """Get the duration of a video in seconds."""
-    result = start_process("ffprobe", ["-v", "error", "-show_entries", "format=duration", "-of", "default=noprint_wrappers=1:nokey=1", video_file])
+def set_probe_cache_enabled(enabled: bool):
+    global _probe_cache_enabled
+    _probe_cache_enabled = enabled
 
-    try:
-        return int(float(result.stdout.strip())*1000)
-    except ValueError:
-        logging.error(f"Failed to get duration for {video_file}")
+
+def _get_probe_cache() -> cache.ProbeCache or None:
+    global _probe_cache, _probe_cache_enabled
+
+    if not _probe_cache_enabled:
         return None
 
+    if _probe_cache is None:
+        try:
+            _probe_cache = cache.ProbeCache()
+        except (OSError, sqlite3.Error) as e:
+            logging.warning(f"Could not open probe cache, continuing without it: {e}")
+            _probe_cache_enabled = False
+
+    return _probe_cache
+
+
+def get_ffprobe_version() -> str:
+    global _ffprobe_version
+
+    if _ffprobe_version is None:
+        result = start_process("ffprobe", ["-version"])
+        lines = result.stdout.splitlines() if result.returncode == 0 else []
+        _ffprobe_version = lines[0] if lines else ""
+
+    return _ffprobe_version
 
-def get_video_frames_count(video_file: str):
-    result = start_process("ffprobe", ["-v", "error", "-select_streams", "v:0", "-count_packets",
-                           "-show_entries", "stream=nb_read_packets", "-of", "csv=p=0", video_file])
+
+def _probe_cache_get(path: str, kind: str):
+    """
+        Look probe result for given file up in probe cache.
+        Returns (key, data) tuple. Key is needed for storing result with _probe_cache_put (None if cache cannot be used),
+        data is None when there is no valid result stored.
+    """
+    probe_cache = _get_probe_cache()
+    if probe_cache is None:
+        return None, None
 
     try:
-        return int(result.stdout.strip())
-    except ValueError:
-        logging.error(f"Failed to get frame count for {video_file}")
-        return None
+        key = (cache.file_fingerprint(path), get_ffprobe_version())
+        return key, probe_cache.get(key[0], kind, key[1])
+    except (OSError, sqlite3.Error) as e:
+        logging.debug(f"Probe cache lookup for {path} failed: {e}")
+        return None, None
 
 
-def get_video_full_info(path: str) -> str:
-    args = []
-    args.extend(["-v", "quiet"])
-    args.extend(["-print_format", "json"])
-    args.append("-show_format")
-    args.append("-show_streams")
-    args.append(path)
+def _probe_cache_put(key, kind: str, data):
+    probe_cache = _get_probe_cache()
+    if probe_cache is None or key is None or data is None:
+        return
+
+    fingerprint, version = key
+
+    try:
+        probe_cache.put(fingerprint, kind, version, data)
+    except sqlite3.Error as e:
+        logging.debug(f"Could not store probe result for {fingerprint.path}: {e}")
+
+
+def _cached_probe(path: str, kind: str, probe):
+    """
+        Return result of probe() for given file, reusing value stored in probe cache if file did not change since.
+        Results equal to None are not cached.
+    """
+    key, data = _probe_cache_get(path, kind)
+
+    if data is None:
+        data = probe()
+        _probe_cache_put(key, kind, data)
+    else:
+        logging.debug(f"Using cached {kind} probe result for {path}")
+
+    return data
+
 
-    process = start_process("ffprobe", args)
+def _native_video_info(path: str):
+    """ Read video details without launching any process (Matroska only). Returns None if not possible """
+    if Path(path).suffix[1:].lower() in ["mkv", "webm"]:
+        try:
+            return matroska.read_info(path)
+        except (OSError, ValueError) as e:
+            logging.debug(f"Could not read Matroska headers of {path}, using ffprobe: {e}")
 
+    return None
+
+
+def _full_info_args(path: str) -> [str]:
+    return ["-v", "quiet", "-print_format", "json", "-show_format", "-show_streams", path]
+
+
+def _full_info_from_result(process: ProcessResult):
     if process.returncode != 0:
         raise RuntimeError(f"ffprobe exited with unexpected error:\n{process.stderr}")
 
-    output_lines = process.stdout
-    output_json = json.loads(output_lines)
+    return json.loads(process.stdout)
+
+
+def get_video_full_info(path: str) -> str:
+    # Matroska headers can be read directly, which is much faster than launching ffprobe
+    info = _native_video_info(path)
+    if info is not None:
+        return info
+
+    return _cached_probe(path, "full", lambda: _full_info_from_result(start_process("ffprobe", _full_info_args(path))))
+
+
+def _count_video_frames(video_file: str):
+    """ Count frames by reading all packets of first video stream. Slow for big files """
+    def probe():
+        result = start_process("ffprobe", ["-v", "error", "-select_streams", "v:0", "-count_packets",
+                               "-show_entries", "stream=nb_read_packets", "-of", "csv=p=0", video_file])
+
+        try:
+            return int(result.stdout.strip())
+        except ValueError:
+            logging.error(f"Failed to get frame count for {video_file}")
+            return None
+
+    return _cached_probe(video_file, "frames", probe)
 
-    return output_json
 
+def _duration_from_info(info) -> int or None:
+    try:
+        return int(float(info["format"]["duration"])*1000)
+    except (KeyError, ValueError, TypeError):
+        return None
+
+
+def _first_video_stream(info):
+    return next((stream for stream in info["streams"] if stream["codec_type"] == "video"), None)
+
+
+def _frames_estimate_from_info(info) -> int or None:
+    stream = _first_video_stream(info)
+    if stream is None:
+        return None
+
+    # some containers (mp4 for example) store number of frames in their headers
+    nb_frames = stream.get("nb_frames", None)
+    if nb_frames is not None and nb_frames.isdigit():
+        return int(nb_frames)
+
+    duration = _duration_from_info(info)
+    if duration is None:
+        return None
+
+    for fps_key in ["avg_frame_rate", "r_frame_rate"]:
+        try:
+            fps = fps_str_to_float(stream[fps_key])
+        except (KeyError, ZeroDivisionError, SyntaxError):
+            continue
 
-def get_video_data(path: str) -> [VideoInfo]:
+        return round(duration * fps / 1000)
+
+    return None
+
+
+def _video_data_from_info(path: str, info) -> VideoInfo:
 
     def get_length(stream):
 
@@ -248,11 +496,9 @@ def get_video_data(path: str) -> [VideoInfo]:
 
         return length
 
-    output_json = get_video_full_info(path)
-
     subtitles = []
     video_tracks = []
-    for stream in output_json["streams"]:
+    for stream in info["streams"]:
         stream_type = stream["codec_type"]
         if stream_type == "subtitle":
             if "tags" in stream:
@@ -270,20 +516,197 @@ def get_video_data(path: str) -> [VideoInfo]:
             fps = stream["r_frame_rate"]
             length = get_length(stream)
             if length is None:
-                length = get_video_duration(path)
+                length = _duration_from_info(info)
 
             video_tracks.append(VideoTrack(fps=fps, length=length))
 
     return VideoInfo(video_tracks, subtitles, path)
 
 
+class ProbeContext:
+    """
+        Request scoped ffprobe results.
+        Each file is probed (with one 'ffprobe -show_format -show_streams' call) at most once during context's lifetime.
+        Duration, fps, frames count and subtitles details are derived from that single result.
+    """
+
+    def __init__(self):
+        self._infos = {}
+        self._lock = threading.Lock()
+
+    def full_info(self, path: str):
+        key = os.path.realpath(path)
+
+        with self._lock:
+            info = self._infos.get(key, None)
+
+        if info is None:
+            info = get_video_full_info(path)
+            self.store(path, info)
+
+        return info
+
+    def known_info(self, path: str):
+        """ Full info of file if it is known already (or can be obtained without ffprobe). None otherwise """
+        key = os.path.realpath(path)
+
+        with self._lock:
+            info = self._infos.get(key, None)
+
+        if info is None:
+            info = _native_video_info(path)
+
+            if info is not None:
+                self.store(path, info)
+
+        return info
+
+    def store(self, path: str, info):
+        with self._lock:
+            self._infos[os.path.realpath(path)] = info
+
+    def forget(self, path: str):
+        with self._lock:
+            self._infos.pop(os.path.realpath(path), None)
+
+    def video_data(self, path: str) -> VideoInfo:
+        return _video_data_from_info(path, self.full_info(path))
+
+    def duration(self, path: str) -> int or None:
+        duration = _duration_from_info(self.full_info(path))
+
+        if duration is None:
+            logging.error(f"Failed to get duration for {path}")
+
+        return duration
+
+    def resolution(self, path: str) -> (int, int) or None:
+        """ (width, height) of first video stream """
+        stream = _first_video_stream(self.full_info(path))
+
+        try:
+            return int(stream["width"]), int(stream["height"])
+        except (KeyError, TypeError, ValueError):
+            logging.error(f"Failed to get resolution of {path}")
+            return None
+
+    def frames_count(self, path: str, exact: bool = False) -> int or None:
+        if exact:
+            return _count_video_frames(path)
+
+        frames = _frames_estimate_from_info(self.full_info(path))
+
+        if frames is None:
+            logging.error(f"Failed to estimate frame count for {path}")
+
+        return frames
+
+
+def get_video_duration(video_file, probe: ProbeContext = None):
+    """Get the duration of a video in milliseconds."""
+    probe = ProbeContext() if probe is None else probe
+
+    try:
+        return probe.duration(video_file)
+    except (RuntimeError, ValueError, TypeError):
+        # ffprobe failure, malformed ffprobe output or unexpected structure of it
+        logging.error(f"Failed to get duration for {video_file}")
+        return None
+
+
+def get_video_frames_count(video_file: str, exact: bool = False, probe: ProbeContext = None):
+    """
+        Get number of frames in first video stream.
+        By default number of frames is estimated from container's metadata (duration × fps).
+        Use exact = True to count packets which requires reading whole file.
+    """
+    probe = ProbeContext() if probe is None else probe
+
+    try:
+        return probe.frames_count(video_file, exact = exact)
+    except (RuntimeError, ValueError, TypeError):
+        logging.error(f"Failed to get frame count for {video_file}")
+        return None
+
+
+def get_video_resolution(video_file: str, probe: ProbeContext = None) -> (int, int) or None:
+    """ Get (width, height) of first video stream """
+    probe = ProbeContext() if probe is None else probe
+
+    try:
+        return probe.resolution(video_file)
+    except (RuntimeError, ValueError, TypeError):
+        logging.error(f"Failed to get resolution of {video_file}")
+        return None
+
+
+def get_video_data(path: str, probe: ProbeContext = None) -> VideoInfo:
+    probe = ProbeContext() if probe is None else probe
+    return probe.video_data(path)
+
+
+def probe_many(paths: [str], jobs: int = None, probe: ProbeContext = None, interruptible: "InterruptibleProcess" = None):
+    """
+        Probe many files concurrently.
+        Files which cannot be read natively and have no valid probe cache entry are probed with ffprobe processes
+        run by ProcessRunner (at most 'jobs' at once, defaults to number of CPUs).
+        When interruptible is provided, running ffprobe processes are killed as soon as it receives a signal.
+        Yields (path, VideoInfo) pairs in order of completion. VideoInfo is None for files which could not be probed.
+        When probe context is provided, full probe results are kept in it for later use.
+    """
+    probe = ProbeContext() if probe is None else probe
+
+    def video_data(path: str, info) -> VideoInfo or None:
+        try:
+            return _video_data_from_info(path, info)
+        except (ValueError, KeyError, IndexError, TypeError) as e:
+            logging.warning(f"Could not probe {path}: {e}")
+            return None
+
+    to_probe = []                   # (path, probe cache key) of files ffprobe is needed for
+    for path in paths:
+        info = probe.known_info(path)
+
+        if info is None:
+            key, info = _probe_cache_get(path, "full")
+
+            if info is None:
+                to_probe.append((path, key))
+                continue
+
+            probe.store(path, info)
+
+        yield path, video_data(path, info)
+
+    runner = ProcessRunner(limit = jobs, interruptible = interruptible)
+    calls = [("ffprobe", _full_info_args(path)) for path, _ in to_probe]
+
+    with closing(runner.iter_many(calls)) as results:
+        for index, result in results:
+            path, key = to_probe[index]
+
+            try:
+                info = _full_info_from_result(result)
+            except (RuntimeError, ValueError) as e:
+                logging.warning(f"Could not probe {path}: {e}")
+                yield path, None
+                continue
+
+            _probe_cache_put(key, "full", info)
+            probe.store(path, info)
+
+            yield path, video_data(path, info)
+
+
 def split_path(path: str) -> (str, str, str):
     info = Path(path)
 
     return str(info.parent), info.stem, info.suffix[1:]
 
 
-def generate_mkv(input_video: str, output_path: str, subtitles: [SubtitleFile]):
+def generate_mkv(input_video: str, output_path: str, subtitles: [SubtitleFile], probe: ProbeContext = None):
+    probe = ProbeContext() if probe is None else probe
+
     # output
     options = ["-o", output_path]
 
@@ -319,8 +742,8 @@ def generate_mkv(input_video: str, output_path: str, subtitles: [SubtitleFile]):
         raise RuntimeError(f"{cmd} did not create output file")
 
     # validate output file correctness
-    output_file_details = get_video_data(output_path)
-    input_file_details = get_video_data(input_video)
+    output_file_details = probe.video_data(output_path)
+    input_file_details = probe.video_data(input_video)
 
     if not compare_videos(input_file_details.video_tracks, output_file_details.video_tracks) or \
             len(input_file_details.subtitles) + len(subtitles) != len(output_file_details.subtitles):
@@ -370,9 +793,285 @@ class InterruptibleProcess:
             sys.exit(1)
 
 
+class ProcessRunner:
+    """
+        Runs many external processes concurrently from a single thread with asyncio.
+
+        At most 'limit' processes run at the same time. Each process is started in a new session,
+        so whole process group is killed when call times out or when work is interrupted
+        (InterruptibleProcess received a signal).
+    """
+
+    def __init__(self, limit: int = None, interruptible: InterruptibleProcess = None, poll_interval: float = 0.2):
+        self.limit = max(1, limit or os.cpu_count() or 1)
+        self._interruptible = interruptible
+        self._poll_interval = poll_interval
+
+    def run_many(self, calls: [(str, [str])], timeout: float = None, on_result = None) -> [ProcessResult]:
+        """
+            Run all (process, args) calls and return their results in the same order.
+            on_result(index, result) is called (in caller's thread) as soon as each call finishes.
+            Calls exceeding timeout (in seconds) are killed and reported with non zero return code.
+        """
+        calls = list(calls)
+        results = [None] * len(calls)
+
+        for index, result in self.iter_many(calls, timeout):
+            results[index] = result
+            if on_result is not None:
+                on_result(index, result)
+
+        return results
+
+    def iter_many(self, calls: [(str, [str])], timeout: float = None):
+        """
+            Run all (process, args) calls and yield (index, result) pairs in order of completion.
+            Event loop runs only while generator is being advanced. Processes still running
+            when generator is closed (or when work is interrupted) are killed.
+        """
+        calls = list(calls)
+        loop = asyncio.new_event_loop()
+        semaphore = asyncio.Semaphore(self.limit)
+        tasks = {loop.create_task(self.run(semaphore, process, args, timeout)): index for index, (process, args) in enumerate(calls)}
+        pending = set(tasks)
+
+        try:
+            while pending:
+                done, pending = loop.run_until_complete(asyncio.wait(pending, timeout=self._poll_interval, return_when=asyncio.FIRST_COMPLETED))
+
+                # results of finished calls (errors like missing executable are propagated)
+                for task in done:
+                    yield tasks[task], task.result()
+
+                if pending and self._interruptible is not None and not self._interruptible._work:
+                    break
+        finally:
+            for task in pending:
+                task.cancel()
+
+            if pending:
+                loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+
+            loop.close()
+
+        if self._interruptible is not None:
+            self._interruptible._check_for_stop()
+
+    async def run(self, semaphore: asyncio.Semaphore, process: str, args: [str], timeout: float = None) -> ProcessResult:
+        async with semaphore:
+            logging.debug(f"Starting {process} with options: {' '.join(args)}")
+            sub_process = await asyncio.create_subprocess_exec(
+                process, *args, stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+                start_new_session=True)
+
+            try:
+                stdout, stderr = await asyncio.wait_for(sub_process.communicate(), timeout)
+            except asyncio.TimeoutError:
+                self._kill(sub_process)
+                await sub_process.wait()
+                logging.warning(f"{process} did not finish in {timeout}s and was killed")
+                return ProcessResult(sub_process.returncode, "", f"Process killed after {timeout}s timeout")
+            except asyncio.CancelledError:
+                self._kill(sub_process)
+                await sub_process.wait()
+                raise
+
+            logging.debug(f"Process finished with {sub_process.returncode}")
+            return ProcessResult(sub_process.returncode, stdout.decode(errors="replace"), stderr.decode(errors="replace"))
+
+    @staticmethod
+    def _kill(sub_process):
+        try:
+            os.killpg(sub_process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+
+class Cancellation:
+    """
+        Lets one thread stop processes started by other threads (see start_process and start_pipeline).
+        On cancel() process groups of all running registered processes are killed.
+        Processes registered after cancellation are killed immediately.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._processes = set()
+        self.cancelled = False
+
+    def cancel(self):
+        with self._lock:
+            self.cancelled = True
+            processes = list(self._processes)
+
+        for sub_process in processes:
+            ProcessRunner._kill(sub_process)
+
+    @contextmanager
+    def register(self, *processes):
+        with self._lock:
+            self._processes.update(processes)
+            cancelled = self.cancelled
+
+        if cancelled:
+            for sub_process in processes:
+                ProcessRunner._kill(sub_process)
+
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._processes.difference_update(processes)
+
+
+class ThreadBudget:
+    """
+        Global pool of CPU threads shared by concurrently running jobs.
+        Each job reserves some threads for the time it runs and returns them when done.
+    """
+
+    def __init__(self, total: int):
+        self.total = max(1, total)
+        self._available = self.total
+        self._condition = threading.Condition()
+
+    @contextmanager
+    def reserve(self, threads: int):
+        """ Wait until requested number of threads is available and reserve them """
+        threads = max(1, min(threads, self.total))
+
+        with self._condition:
+            self._condition.wait_for(lambda: self._available >= threads)
+            self._available -= threads
+
+        try:
+            yield threads
+        finally:
+            self._release(threads)
+
+    @contextmanager
+    def reserve_available(self, max_threads: int):
+        """ Reserve as many threads as currently available (at least one, up to max_threads) """
+        with self._condition:
+            self._condition.wait_for(lambda: self._available >= 1)
+            threads = max(1, min(max_threads, self._available))
+            self._available -= threads
+
+        try:
+            yield threads
+        finally:
+            self._release(threads)
+
+    def _release(self, threads: int):
+        with self._condition:
+            self._available += threads
+            self._condition.notify_all()
+
+
+def set_library_index_enabled(enabled: bool):
+    global _library_index_enabled
+    _library_index_enabled = enabled
+
+
+def _get_library_index() -> cache.LibraryIndex or None:
+    global _library_index, _library_index_enabled
+
+    if not _library_index_enabled:
+        return None
+
+    if _library_index is None:
+        try:
+            _library_index = cache.LibraryIndex()
+        except (OSError, sqlite3.Error) as e:
+            logging.warning(f"Could not open library index, continuing without it: {e}")
+            _library_index_enabled = False
+
+    return _library_index
+
+
+def walk(path: str, followlinks: bool = False):
+    """
+        os.walk replacement which reads only directories modified since previous run
+        (when library index is enabled)
+    """
+    library_index = _get_library_index()
+
+    if library_index is None:
+        yield from os.walk(path, followlinks = followlinks)
+    else:
+        yield from library_index.walk(path, followlinks)
+
+
+def list_directory(path: str) -> ([str], [str]):
+    """ Returns paths of subdirectories and files in given directory """
+    library_index = _get_library_index()
+
+    if library_index is None:
+        subdirs = []
+        files = []
+        with os.scandir(path) as it:
+            for entry in it:
+                if entry.is_dir():
+                    subdirs.append(entry.path)
+                elif entry.is_file():
+                    files.append(entry.path)
+    else:
+        listing = library_index.list_directory(path)
+        subdirs = [os.path.join(path, name) for name in listing.subdirs]
+        files = [os.path.join(path, name) for name in listing.files]
+
+    return subdirs, files
+
+
+def set_processing_journal_enabled(enabled: bool):
+    global _processing_journal_enabled
+    _processing_journal_enabled = enabled
+
+
+def _get_processing_journal() -> cache.ProcessingJournal or None:
+    global _processing_journal, _processing_journal_enabled
+
+    if not _processing_journal_enabled:
+        return None
+
+    if _processing_journal is None:
+        try:
+            _processing_journal = cache.ProcessingJournal()
+        except (OSError, sqlite3.Error) as e:
+            logging.warning(f"Could not open processing journal, continuing without it: {e}")
+            _processing_journal_enabled = False
+
+    return _processing_journal
+
+
+def get_processing_outcome(path: str, tool: str, parameters: str) -> str or None:
+    """ Returns outcome of previous processing of unmodified file with given tool and parameters (if any) """
+    journal = _get_processing_journal()
+    if journal is None:
+        return None
+
+    try:
+        return journal.get(cache.file_fingerprint(path), tool, parameters)
+    except (OSError, sqlite3.Error) as e:
+        logging.debug(f"Could not read processing journal for {path}: {e}")
+        return None
+
+
+def record_processing_outcome(path: str, tool: str, parameters: str, outcome: str):
+    """ Store outcome of processing. Must be called when file is in its final state """
+    journal = _get_processing_journal()
+    if journal is None:
+        return
+
+    try:
+        journal.record(cache.file_fingerprint(path), tool, parameters, outcome)
+    except (OSError, sqlite3.Error) as e:
+        logging.warning(f"Could not update processing journal for {path}: {e}")
+
+
 def collect_video_files(path: str, interruptible: InterruptibleProcess) -> List[str]:
     video_files = []
-    for cd, _, files in os.walk(path, followlinks = True):
+    for cd, _, files in walk(path, followlinks = True):
         for file in files:
             interruptible._check_for_stop()
             file_path = os.path.join(cd, file)
@@ -1,24 +1,32 @@
 
 import argparse
+import importlib.util
 import logging
 import sys
 
-from .tools import          \
-    concatenate,            \
-    melt,                   \
-    merge,                  \
-    subtitles_fixer,        \
-    transcode
-
+# tool name -> (module, description). Modules are imported only when tool is selected
 TOOLS = {
-    "concatenate": (concatenate.setup_parser, concatenate.run, "Concatenate multifile movies into one file"),
-    "melt": (melt.setup_parser, melt.run, "[Not ready yet] Find same video files and combine them into one containg best of all copies."),
-    "merge": (merge.setup_parser, merge.run, "Merge video files with corresponding subtitles into one MKV file"),
-    "subtitles_fix": (subtitles_fixer.setup_parser, subtitles_fixer.run, "Fixes some specific issues with subtitles. Do not use until you are sure it will help for your problems."),
-    "transcode": (transcode.setup_parser, transcode.run, "Transcode videos from provided directory preserving quality."),
+    "concatenate": (".tools.concatenate", "Concatenate multifile movies into one file"),
+    "melt": (".tools.melt", "[Not ready yet] Find same video files and combine them into one containg best of all copies."),
+    "merge": (".tools.merge", "Merge video files with corresponding subtitles into one MKV file"),
+    "subtitles_fix": (".tools.subtitles_fixer", "Fixes some specific issues with subtitles. Do not use until you are sure it will help for your problems."),
+    "transcode": (".tools.transcode", "Transcode videos from provided directory preserving quality."),
 }
 
 
+def load_tool(tool_name: str):
+    module = importlib.util.resolve_name(TOOLS[tool_name][0], __package__)
+
+    # plain import statement machinery (unlike importlib.import_module) is visible in '-X importtime' reports
+    __import__(module)
+    return sys.modules[module]
+
+
+def _selected_tool(argv) -> str or None:
+    # global options take no values, so first positional argument is tool's name
+    return next((arg for arg in argv if not arg.startswith("-")), None)
+
+
 class CustomFormatter(argparse.HelpFormatter):
     def _split_lines(self, text, width):
         return text.splitlines()
@@ -42,15 +50,35 @@ def execute(argv):
                         action='store_true',
                         default=False,
                         help='Perform actual operation.')
+    parser.add_argument("--no-probe-cache",
+                        action='store_true',
+                        default=False,
+                        help='Do not use nor update persistent cache of video files metadata.')
+    parser.add_argument("--no-library-index",
+                        action='store_true',
+                        default=False,
+                        help='Do not use nor update persistent index of scanned directories (scan whole tree).')
+    parser.add_argument("--no-journal",
+                        action='store_true',
+                        default=False,
+                        help='Do not use nor update persistent journal of processed files (process all files, remember nothing).')
+    parser.add_argument("--reprocess",
+                        action='store_true',
+                        default=False,
+                        help='Process files again even if journal says they were already processed with the same parameters.')
     subparsers = parser.add_subparsers(dest="tool", help="Available tools:")
 
-    for tool_name, (setup_parser, _, desc) in TOOLS.items():
+    selected_tool = _selected_tool(argv)
+
+    for tool_name, (_, desc) in TOOLS.items():
         tool_parser = subparsers.add_parser(
             tool_name,
             help=desc,
             formatter_class=CustomFormatter
         )
-        setup_parser(tool_parser)
+
+        if tool_name == selected_tool:
+            load_tool(tool_name).setup_parser(tool_parser)
 
     args = parser.parse_args(args = argv)
 
@@ -61,8 +89,15 @@ def execute(argv):
     if args.verbose:
         logging.getLogger().setLevel(logging.DEBUG)
 
+    # utils (and its dependencies) are needed once tool is about to run only
+    from .tools import utils
+
+    utils.set_probe_cache_enabled(not args.no_probe_cache)
+    utils.set_library_index_enabled(not args.no_library_index)
+    utils.set_processing_journal_enabled(not args.no_journal)
+
     if args.tool in TOOLS:
-        tool = TOOLS[args.tool][1]
+        tool = load_tool(args.tool).run
         tool(args)
 
     else: